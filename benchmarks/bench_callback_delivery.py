@@ -0,0 +1,110 @@
+"""
+bench_callback_delivery.py
+
+Callback deliveries per second against a local stub HTTP server, which
+answers each request after a fixed delay to simulate client latency, using
+the threads engine (before) versus the asyncio engine (after).
+
+    $ python benchmarks/bench_callback_delivery.py [callbacks] [delay ms]
+"""
+import asyncio
+import json
+import queue
+import sys
+import threading
+import time
+
+from bitcallback.async_pool import AsyncPool
+from bitcallback.callback_task import CallbackManager
+from bitcallback.http_pool import HTTPConnectionPool
+from bitcallback.thread_pool import ThreadPool
+
+CALLBACKS = 2000
+DELAY_MS = 50
+
+# Callback config defaults
+NTHREADS = 4
+CONCURRENCY = 1000
+
+RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n"
+
+
+def start_stub_server(delay):
+    """Start stub HTTP server in a background thread
+
+    Returns:
+        int: Server port
+    """
+    started = threading.Event()
+    port = []
+
+    async def handle(reader, writer):
+        # Keep-alive connections are served until the client closes them
+        try:
+            keep_alive = True
+            while keep_alive:
+                headers = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in headers.lower().split(b'\r\n'):
+                    if line.startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                    elif line == b'connection: close':
+                        keep_alive = False
+                await reader.readexactly(length)
+                await asyncio.sleep(delay)
+                writer.write(RESPONSE)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0, backlog=4096)
+        port.append(server.sockets[0].getsockname()[1])
+        started.set()
+        await server.serve_forever()
+
+    threading.Thread(target=lambda: asyncio.run(serve()), daemon=True).start()
+    started.wait()
+    return port[0]
+
+def deliver(pool, sent_q, url, count):
+    """Send count callbacks and wait until all of them are sent
+
+    Returns:
+        float: Elapsed seconds
+    """
+    payload = json.dumps({'id': 'x'*32, 'txid': 'ab'*32, 'amount': 44,
+                          'confirmed': True}).encode('utf-8')
+    start = time.perf_counter()
+    for n in range(count):
+        pool.add_job((n, payload, url), block=True)
+    for _ in range(count):
+        sent_q.get()
+    elapsed = time.perf_counter()-start
+    pool.close()
+    return elapsed
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CALLBACKS
+    delay = (int(sys.argv[2]) if len(sys.argv) > 2 else DELAY_MS)/1000
+    url = 'http://127.0.0.1:{}/callback'.format(start_stub_server(delay))
+
+    sent_q = queue.Queue()
+    threads = ThreadPool(nthreads=NTHREADS, func=CallbackManager._send_thread_func,
+                         args=(sent_q.put, HTTPConnectionPool()))
+    before = deliver(threads, sent_q, url, count)
+
+    sent_q = queue.Queue()
+    async_pool = AsyncPool(concurrency=CONCURRENCY, func=CallbackManager._send_async_func,
+                           args=(sent_q.put,))
+    after = deliver(async_pool, sent_q, url, count)
+
+    for name, elapsed in (('threads', before), ('asyncio', after)):
+        print("{:>8}: {:8.1f} callbacks/s {:6.2f} s".format(name, count/elapsed, elapsed))
+    print("{:>8}: {:8.2f}x".format('ratio', before/after))
+
+
+if __name__ == '__main__':
+    main()
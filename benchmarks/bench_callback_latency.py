@@ -0,0 +1,129 @@
+"""
+bench_callback_latency.py
+
+Time from CallbackManager.new_callback until the first POST reaches a local
+stub HTTP server, with the previous update loop that polled the sent
+callbacks every UPDATE_PERIOD (before), versus the event driven one that
+wakes up as soon as there is something to do (after). Callbacks are added
+one at a time at random intervals, so they land anywhere in the poll period.
+
+    $ python benchmarks/bench_callback_latency.py [callbacks]
+"""
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import queue
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from bitcallback.callback_task import CallbackManager, UPDATE_PERIOD
+from bitcallback.commands import CallbackData
+from bitcallback.database import make_session_scope
+from bitcallback.models import Callback, Subscription
+
+CALLBACKS = 20
+
+
+class PollingCallbackManager(CallbackManager):
+    """CallbackManager with the previous update loop, sent callbacks were
+    waited for UPDATE_PERIOD before new ones were sent."""
+
+    @staticmethod
+    def _update_func(callback_manager):
+        while not callback_manager._close_flag.is_set():
+            callback_manager._send_ready()
+            callback_manager._close_flag.wait(UPDATE_PERIOD)
+            with callback_manager._lock:
+                sent = list(callback_manager._sent)
+                callback_manager._sent.clear()
+            callback_manager._process_sent(sent)
+
+
+def start_stub_server(received):
+    """Start stub HTTP server in a background thread, it places the arrival
+    time of each request on received.
+
+    Returns:
+        int: Server port
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            received.put(time.perf_counter())
+            self.rfile.read(int(self.headers['Content-Length']))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+def create_db(callback_url):
+    """In memory database with a single subscription
+
+    Returns:
+        tuple: (scoped_session, Subscription)
+    """
+    engine = create_engine('sqlite:///:memory:',
+                           connect_args={'check_same_thread': False},
+                           poolclass=StaticPool)
+    db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False,
+                                             expire_on_commit=False, bind=engine))
+    Callback.metadata.create_all(engine)
+    Subscription.metadata.create_all(engine)
+
+    with make_session_scope(db_session) as session:
+        subscription = Subscription(address='n2SjFgAhHAv8PcTuq5x2e9sugcXDpMTzX7',
+                                    callback_url=callback_url)
+        session.add(subscription)
+    return db_session, subscription
+
+def measure(manager_cls, callback_url, count):
+    """
+    Returns:
+        list: Seconds from new_callback to the POST arrival, for each callback
+    """
+    received = queue.Queue()
+    port = start_stub_server(received)
+    db_session, subscription = create_db(callback_url.format(port))
+    manager = manager_cls(db_session, retries=0, retry_period=3600, nthreads=4)
+
+    latencies = []
+    for _ in range(count):
+        time.sleep(random.uniform(0, UPDATE_PERIOD))
+        callback = CallbackData(id=uuid.uuid4().hex, subscription=subscription,
+                                txid='ab'*32, amount=44)
+        start = time.perf_counter()
+        manager.new_callback(callback)
+        latencies.append(received.get()-start)
+
+    manager.close()
+    return latencies
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else CALLBACKS
+    callback_url = 'http://127.0.0.1:{}/callback'
+
+    results = (('polling', measure(PollingCallbackManager, callback_url, count)),
+               ('events', measure(CallbackManager, callback_url, count)))
+
+    for name, latencies in results:
+        print("{:>8}: median {:8.2f} ms  max {:8.2f} ms".format(
+            name, statistics.median(latencies)*1000, max(latencies)*1000))
+    before, after = (statistics.median(latencies) for _, latencies in results)
+    print("{:>8}: {:8.1f}x".format('ratio', before/after))
+
+
+if __name__ == '__main__':
+    main()
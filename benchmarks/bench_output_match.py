@@ -0,0 +1,54 @@
+"""
+bench_output_match.py
+
+Per output cost of matching transaction outputs against the monitored
+addresses, encoding each output address (before) versus looking up the
+scriptPubKey bytes (after).
+
+    $ python benchmarks/bench_output_match.py
+"""
+import os
+import timeit
+
+import bitcoin
+from bitcoin.core.script import CScript, OP_DUP, OP_HASH160, OP_EQUALVERIFY, OP_CHECKSIG
+from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress
+
+MONITORED = 10000
+OUTPUTS = 10000
+REPEAT = 5
+
+
+def p2pkh_script(pubkey_hash):
+    return CScript([OP_DUP, OP_HASH160, pubkey_hash, OP_EQUALVERIFY, OP_CHECKSIG])
+
+def main():
+    bitcoin.SelectParams('mainnet')
+
+    # Monitored addresses, and outputs where 1% pay to one of them
+    monitored = [str(P2PKHBitcoinAddress.from_bytes(os.urandom(20)))
+                 for _ in range(MONITORED)]
+    outputs = [p2pkh_script(os.urandom(20)) for _ in range(OUTPUTS)]
+    for n in range(0, OUTPUTS, 100):
+        outputs[n] = CBitcoinAddress(monitored[n]).to_scriptPubKey()
+
+    by_addr = set(monitored)
+    by_script = {bytes(CBitcoinAddress(addr).to_scriptPubKey()): addr
+                 for addr in monitored}
+
+    def match_addr():
+        return [addr for addr in (str(CBitcoinAddress.from_scriptPubKey(s)) for s in outputs)
+                if addr in by_addr]
+
+    def match_script():
+        return [by_script[s] for s in outputs if s in by_script]
+
+    assert match_addr() == match_script()
+
+    for name, func in (('address string', match_addr), ('script bytes', match_script)):
+        best = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print("{:>16}: {:8.3f} us/output".format(name, best/OUTPUTS*1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+bench_subscription_memory.py
+
+Memory used by the subscription indexes of the bitmon task (subscriptions
+by id and address, expiration schedule and monitored addresses), storing a
+SubscriptionData for each subscription along with per address sets and
+scripts (before), versus the shared AddressRegistry and array backed
+SubscriptionTable (after).
+
+    $ python benchmarks/bench_subscription_memory.py [subscriptions]
+"""
+from collections import defaultdict
+import datetime
+import heapq
+import random
+import sys
+import time
+import tracemalloc
+
+import bitcoin
+from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress
+
+from bitcallback.bitmon.registry import AddressRegistry
+from bitcallback.bitmon_task import EXPIRATION_TICK
+from bitcallback.commands import SubscriptionData
+from bitcallback.expiration import ExpirationSchedule
+from bitcallback.subscription_table import SubscriptionTable, EPOCH, to_micros
+
+SUBSCRIPTIONS = 1000000
+
+# Subscriptions per address, and distinct callback urls
+SUBS_PER_ADDRESS = 1
+CALLBACK_URLS = 1000
+
+
+def decoded(value):
+    """Copy of a string, as decoded from a database row"""
+    return (value+'.')[:-1]
+
+
+def make_subscriptions(count):
+    """Subscriptions as decoded from the database"""
+    now = datetime.datetime(2020, 1, 1)
+    addrs = [str(P2PKHBitcoinAddress.from_bytes(random.getrandbits(160).to_bytes(20, 'little')))
+             for _ in range(count//SUBS_PER_ADDRESS+1)]
+    urls = ['https://client{}.example.com/callback'.format(n) for n in range(CALLBACK_URLS)]
+
+    return [SubscriptionData(n+1, decoded(addrs[n//SUBS_PER_ADDRESS]),
+                             decoded(urls[n%CALLBACK_URLS]),
+                             now+datetime.timedelta(seconds=random.randrange(30*86400)))
+            for n in range(count)]
+
+def build_before(subscriptions):
+    """Subscription indexes before the address registry"""
+    subs_by_addr = defaultdict(set)
+    subs_by_id = {}
+    monitored = set()
+    monitored_scripts = {}
+
+    # Expiration buckets of ids by tick, and tick by id
+    buckets = defaultdict(set)
+    ticks = {}
+
+    for sub in subscriptions:
+        if sub.address not in subs_by_addr:
+            monitored.add(sub.address)
+            monitored_scripts[bytes(CBitcoinAddress(sub.address).to_scriptPubKey())] = sub.address
+        subs_by_addr[sub.address].add(sub)
+        subs_by_id[sub.id] = sub
+
+        tick = int((sub.expiration-EPOCH).total_seconds())//EXPIRATION_TICK
+        buckets[tick].add(sub.id)
+        ticks[sub.id] = tick
+
+    heap = list(buckets)
+    heapq.heapify(heap)
+    return subs_by_addr, subs_by_id, monitored, monitored_scripts, buckets, ticks, heap
+
+def build_after(subscriptions):
+    """Subscription indexes with the shared address registry"""
+    registry = AddressRegistry()
+    table = SubscriptionTable(registry)
+    expiration = ExpirationSchedule(EXPIRATION_TICK)
+
+    def rows(subscriptions):
+        for sub in subscriptions:
+            row = table.add(sub.id, registry.acquire(sub.address), sub.callback_url,
+                            to_micros(sub.expiration))
+            yield row, sub.expiration
+
+    expiration.schedule_many(rows(subscriptions))
+    return registry, table, expiration
+
+def measure(build, count):
+    """Build indexes from freshly decoded subscriptions, and return the
+    memory still used once the decoded rows are released."""
+    random.seed(count)
+    tracemalloc.start()
+    subscriptions = make_subscriptions(count)
+
+    start = time.perf_counter()
+    result = build(subscriptions)
+    elapsed = time.perf_counter()-start
+    del subscriptions
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    del result
+    return used, elapsed
+
+def main():
+    bitcoin.SelectParams('mainnet')
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else SUBSCRIPTIONS
+
+    before, before_time = measure(build_before, count)
+    after, after_time = measure(build_after, count)
+
+    for name, used, elapsed in (('before', before, before_time), ('after', after, after_time)):
+        print("{:>8}: {:8.1f} MiB {:6.1f} bytes/subscription {:6.2f} s".format(
+            name, used/2**20, used/count, elapsed))
+    print("{:>8}: {:8.2f}x".format('ratio', before/after))
+
+
+if __name__ == '__main__':
+    main()
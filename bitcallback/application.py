@@ -3,12 +3,15 @@
 Create and initialize flask app and async tasks
 """
 import atexit
+import logging
+
 from flask import Flask
+from sqlalchemy import create_engine
 
 from bitcallback.bitmon_task import BitmonTask
 from bitcallback.callback_task import CallbackTask
 
-from bitcallback.models import db
+from bitcallback.models import db, upgrade_schema
 
 
 def create_app(name, config_file):
@@ -18,6 +21,13 @@ def create_app(name, config_file):
     app.config.from_object(config_file)
     #TODO: Use Config from object
 
+    # Add the columns missing from databases created by previous versions,
+    # before the tasks access them.
+    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+    for column in upgrade_schema(engine):
+        logging.getLogger(__name__).info("Added column {}".format(column))
+    engine.dispose()
+
     # Initialize and start bitcoin and callback processes
     app.callback_task = CallbackTask(app.config)
     app.bitmon_task = BitmonTask(app.callback_task, app.config)
@@ -41,5 +51,6 @@ def create_app(name, config_file):
     return app
 
 def create_db():
-    # Create all database tables
+    # Create all database tables, and the columns missing from existing ones
     db.create_all()
+    upgrade_schema(db.engine)
@@ -0,0 +1,117 @@
+"""
+async_http
+
+Minimal asyncio HTTP/1.1 client, only what's needed to POST callbacks
+without blocking a thread for each request.
+"""
+import asyncio
+import json as jsonlib
+import ssl
+from urllib.parse import urlsplit
+
+# Created on first https request, it loads the system certificates
+_ssl_context = None
+
+
+class HTTPError(Exception):
+    """Invalid url or response"""
+
+
+def _get_ssl_context():
+    global _ssl_context
+    if _ssl_context is None:
+        _ssl_context = ssl.create_default_context()
+    return _ssl_context
+
+def build_request(url, body, content_type='application/json'):
+    """Build POST request
+
+    Arguments:
+        url (str): Target url, http or https
+        body (bytes): Request body
+
+    Returns:
+        tuple: (host, port, use_ssl, request bytes)
+
+    Raises:
+        HTTPError: Unsupported url
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise HTTPError("Unsupported url {}".format(url))
+
+    use_ssl = parts.scheme == 'https'
+    try:
+        port = parts.port or (443 if use_ssl else 80)
+    except ValueError:
+        raise HTTPError("Invalid port in url {}".format(url))
+
+    path = parts.path or '/'
+    if parts.query:
+        path += '?'+parts.query
+
+    host = parts.hostname
+    if ':' in host:
+        host = '['+host+']'
+    if parts.port:
+        host += ':{}'.format(parts.port)
+
+    head = ("POST {} HTTP/1.1\r\n"
+            "Host: {}\r\n"
+            "Content-Type: {}\r\n"
+            "Content-Length: {}\r\n"
+            "Connection: close\r\n\r\n").format(path, host, content_type, len(body))
+    return parts.hostname, port, use_ssl, head.encode('latin-1')+body
+
+def parse_status(status_line):
+    """
+    Arguments:
+        status_line (bytes): Response status line
+
+    Returns:
+        int: Response status code
+
+    Raises:
+        HTTPError: Not a valid status line
+    """
+    try:
+        version, status = status_line.split(None, 2)[:2]
+        if not version.startswith(b'HTTP/'):
+            raise ValueError
+        return int(status)
+    except ValueError:
+        raise HTTPError("Invalid response status {!r}".format(status_line[:64]))
+
+async def _post(url, body):
+    host, port, use_ssl, request = build_request(url, body)
+    reader, writer = await asyncio.open_connection(
+            host, port, ssl=_get_ssl_context() if use_ssl else None)
+    try:
+        writer.write(request)
+        await writer.drain()
+
+        # Only the status is needed, the rest of the response is discarded
+        # when the connection is closed.
+        return parse_status(await reader.readline())
+    finally:
+        writer.close()
+
+async def post(url, data=None, json=None, timeout=None):
+    """POST json to url
+
+    Arguments:
+        url (str):
+        data (bytes|None): Request body, already serialized json
+        json: Object serialized as the request body, when there is no data
+        timeout (float|None): Max seconds for the whole request
+
+    Returns:
+        int: Response status code
+
+    Raises:
+        HTTPError: Invalid url or response
+        OSError: Connection error
+        asyncio.TimeoutError: Request timed out
+    """
+    body = data if data is not None else jsonlib.dumps(json).encode('utf-8')
+    return await asyncio.wait_for(_post(url, body), timeout)
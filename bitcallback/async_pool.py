@@ -0,0 +1,116 @@
+"""
+async_pool
+
+Job processing on an asyncio event loop, alternative to ThreadPool for
+jobs that spend most of the time waiting for the network.
+"""
+import asyncio
+import logging
+import threading
+
+import queue
+
+from bitcallback.thread_pool import JOB_QUEUE_MAX_LENGTH
+
+# Default max number of jobs running at the same time
+DEFAULT_CONCURRENCY = 1000
+
+
+logger = logging.getLogger("Callback")
+
+
+class AsyncPool(object):
+    """
+    Job processing pool that runs a coroutine for each job received, on an
+    event loop in a background thread. It has the same interface as
+    ThreadPool, so it can be used in its place.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY,
+                 func=None, args=None, kwargs=None,
+                 maxlen=JOB_QUEUE_MAX_LENGTH):
+        """
+        Arguments:
+            concurrency (int): Max number of jobs running at once
+            func (coroutine function): Job processing function, called as
+                ThreadPool func, func(job, *args, **kwargs)
+            args (list|tuple):
+            kwargs (dict): Extra arguments passed to func each time it's
+                called.
+            maxlen (int): Max number of jobs waiting for a free slot, once
+                concurrency jobs are running.
+        """
+        self._func = func
+        self._args = tuple(args) if args else ()
+        self._kwargs = kwargs if kwargs else {}
+        self._concurrency = concurrency
+
+        # Slots for running and waiting jobs, released once they finish
+        self._slots = threading.Semaphore(concurrency+maxlen)
+        self._close_flag = threading.Event()
+
+        # Event loop thread, the running jobs semaphore is created by it
+        self._loop = asyncio.new_event_loop()
+        self._semaphore = None
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._loop_thread,
+                                        args=(started,), daemon=True)
+        self._thread.start()
+        started.wait()
+
+    def _loop_thread(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        started.set()
+        self._loop.run_forever()
+
+    async def _run(self, job):
+        try:
+            async with self._semaphore:
+                await self._func(job, *self._args, **self._kwargs)
+        except Exception as err:
+            logger.error(err, exc_info=True)
+        finally:
+            self._slots.release()
+
+    def add_job(self, job, block=True, timeout=None):
+        """Add job to the pool, with the same blocking behaviour as
+        ThreadPool.add_job. It raises queue.Full when there isn't a free
+        slot, or the pool is closing.
+        """
+        if self._close_flag.is_set():
+            raise queue.Full
+
+        if not self._slots.acquire(block, timeout if block else None):
+            raise queue.Full
+
+        asyncio.run_coroutine_threadsafe(self._run(job), self._loop)
+
+    async def _shutdown(self, now):
+        """Wait until the running jobs finish, or cancel them"""
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        if now:
+            for task in tasks:
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self, now=True, timeout=None):
+        """
+        Arguments:
+            now(bool): When False it will wait until all jobs are
+                processed, otherwise the running ones are cancelled.
+            timeout(float|None): Max time waiting for the jobs
+        """
+        self._close_flag.set()
+
+        shutdown = asyncio.run_coroutine_threadsafe(self._shutdown(now), self._loop)
+        try:
+            shutdown.result(timeout)
+        except Exception:
+            pass
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+        if not self._thread.is_alive():
+            self._loop.close()
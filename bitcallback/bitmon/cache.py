@@ -1,77 +1,321 @@
+import struct
 import bitcoin
-from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
+from bitcoin.wallet import (CBitcoinAddress, CBitcoinAddressError, P2PKHBitcoinAddress,
+                            P2SHBitcoinAddress, P2WPKHBitcoinAddress, P2WSHBitcoinAddress)
 from bitcoin.core import str_money_value, b2lx, b2x, lx
+from bitcoin.core.script import CScript
 from collections import OrderedDict
 
+# Default max cache memory usage in bytes
+DEFAULT_CACHE_BYTES = 32*1024*1024
+
+# Stored output types, the script is rebuilt from the type and hash
+# when the address is needed.
+TXOUT_NO_STANDARD = 0
+TXOUT_P2PKH = 1
+TXOUT_P2SH = 2
+TXOUT_P2WPKH = 3
+TXOUT_P2WSH = 4
+TXOUT_SPENT = 5
+
+# Transaction entry: number of unspent standard outputs followed by
+# a record for each output (type, hash padded to 32 bytes, value)
+ENTRY_HEADER = struct.Struct('<I')
+TXOUT_RECORD = struct.Struct('<B32sq')
+
+# Returned for outputs without a standard address, or not monitored
+NO_STANDARD_TXOUT = ('NO_STANDARD', None)
+
+# Estimated memory used by each entry besides its outputs (dict slot,
+# key and buffer objects)
+ENTRY_OVERHEAD = 200
+
+# scriptPubKey (prefix, suffix, hash length) for each output type
+_TEMPLATES = {
+    TXOUT_P2PKH: (b'\x76\xa9\x14', b'\x88\xac', 20),
+    TXOUT_P2SH: (b'\xa9\x14', b'\x87', 20),
+    TXOUT_P2WPKH: (b'\x00\x14', b'', 20),
+    TXOUT_P2WSH: (b'\x00\x20', b'', 32),
+}
+
+# Address classes returned by from_scriptPubKey for each output type
+_ADDRESS_TYPES = (
+    (P2PKHBitcoinAddress, TXOUT_P2PKH),
+    (P2SHBitcoinAddress, TXOUT_P2SH),
+    (P2WPKHBitcoinAddress, TXOUT_P2WPKH),
+    (P2WSHBitcoinAddress, TXOUT_P2WSH),
+)
+
+
+
+def _pack_script(script):
+    """Compact representation of a scriptPubKey
+
+    Returns:
+        tuple: (output type, hash)
+    """
+    for txout_type, (prefix, suffix, hash_len) in _TEMPLATES.items():
+        if len(script) == len(prefix)+hash_len+len(suffix) and \
+                script.startswith(prefix) and script.endswith(suffix):
+            return txout_type, bytes(script[len(prefix):len(prefix)+hash_len])
+
+    # Non canonical scripts accepted by from_scriptPubKey (i.e. bare
+    # checksig are converted to P2PKH)
+    try:
+        addr = CBitcoinAddress.from_scriptPubKey(script)
+    except CBitcoinAddressError:
+        return TXOUT_NO_STANDARD, b''
+
+    for cls, txout_type in _ADDRESS_TYPES:
+        if isinstance(addr, cls):
+            return _pack_script(addr.to_scriptPubKey())
+
+    return TXOUT_NO_STANDARD, b''
+
+def _unpack_script(txout_type, txout_hash):
+    """Rebuild the scriptPubKey packed by _pack_script"""
+    prefix, suffix, hash_len = _TEMPLATES[txout_type]
+    return CScript(prefix+txout_hash[:hash_len]+suffix)
 
 
 
 class TxOutCache(object):
-    """Bitcon transactions outputs LRU Cache """
-    
-    def __init__(self, proxy, max_size=10000):
+    """Bitcoin transactions outputs LRU Cache, limited by memory usage.
+    Only standard outputs are stored in compact form, and they are dropped
+    once spent."""
+
+    def __init__(self, proxy, max_bytes=DEFAULT_CACHE_BYTES, disk_cache=None):
         """
         Arguments:
             proxy (bitcoin.rpc.proxy):
-            max_size (int):
+            max_bytes (int): Max estimated memory used by the cache
+            disk_cache (DiskTxOutCache|None): Second tier where evicted
+                entries are stored, consulted before requesting them
+                from bitcoind.
         """
         self._cache = OrderedDict()
         self._proxy = proxy
-        self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._disk = disk_cache
+
+        # Estimated memory used
+        self._size = 0
+
+        # Lookups found in the cache, requested from bitcoind and entries
+        # discarded to make room.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(entry):
+        return ENTRY_OVERHEAD+len(entry)
 
     def _proccess_tx(self, tx):
         """
         Arguments:
-            tx (bitcoin.core.CTransaction): 
+            tx (bitcoin.core.CTransaction):
 
         Returns:
-            list: list of valid transactions outputs
-            [(addr0, value0), ..., (addrN, valueN)]
+            bytearray: Packed transaction outputs
         """
-        outputs = []
-        for txout in tx.vout:
-            try:
-                addr = str(CBitcoinAddress.from_scriptPubKey(txout.scriptPubKey))
-                outputs.append((addr, txout.nValue))
-            except CBitcoinAddressError:
-                outputs.append(('NO_STANDARD', None))
+        entry = bytearray(ENTRY_HEADER.size+TXOUT_RECORD.size*len(tx.vout))
+        unspent = 0
+        for n, txout in enumerate(tx.vout):
+            txout_type, txout_hash = _pack_script(txout.scriptPubKey)
+            if txout_type != TXOUT_NO_STANDARD:
+                unspent += 1
+            TXOUT_RECORD.pack_into(entry, ENTRY_HEADER.size+TXOUT_RECORD.size*n,
+                                   txout_type, txout_hash, txout.nValue)
 
-        return outputs
+        ENTRY_HEADER.pack_into(entry, 0, unspent)
+        return entry
 
     def _load(self, txid):
-        """Load transaction into cache
+        """Load transaction from the disk cache, or request it from bitcoind
 
         Arguments:
-            txid (str): Transaction hash
+            txid (bytes): Transaction hash
+
+        Returns:
+            bytearray: Packed transaction outputs
         """
-        if txid in self._cache:
+        if self._disk is not None:
+            entry = self._disk.pop(txid)
+            if entry is not None:
+                return entry
+
+        return self._proccess_tx(self._proxy.getrawtransaction(txid))
+
+    def _insert(self, txid, entry):
+        """Insert transaction outputs into cache, discarding the least
+        recently used until it fits.
+
+        Arguments:
+            txid (bytes): Transaction hash
+            entry (bytearray): Packed transaction outputs
+        """
+        self._remove(txid)
+        self._cache[txid] = entry
+        self._size += self._entry_size(entry)
+
+        evicted = []
+        while self._size > self._max_bytes and len(self._cache) > 1:
+            evicted.append(self._cache.popitem(last=False))
+            self._size -= self._entry_size(evicted[-1][1])
+            self.evictions += 1
+
+        # Evicted entries are written back to the disk cache
+        if evicted and self._disk is not None:
+            self._disk.put_many(evicted)
+
+    def _remove(self, txid):
+        entry = self._cache.pop(txid, None)
+        if entry is not None:
+            self._size -= self._entry_size(entry)
+
+    def prefetch(self, txids, known=None):
+        """Load several transactions into the cache, those not already
+        cached are requested with batch calls when the proxy supports them.
+
+        Arguments:
+            txids (iterable): Transaction hashes
+            known (dict): {txid: CTransaction} transactions already available
+                that don't have to be requested (i.e. from the same block)
+        """
+        known = known or {}
+        missing = []
+        for txid in set(txids):
+            if txid in self._cache:
+                continue
+            if txid in known:
+                self._insert(txid, self._proccess_tx(known[txid]))
+            else:
+                missing.append(txid)
+
+        if missing and self._disk is not None:
+            found = self._disk.pop_many(missing)
+            for txid, entry in found.items():
+                self._insert(txid, entry)
+            missing = [txid for txid in missing if txid not in found]
+
+        if not missing:
             return
-        
-        tx = self._proxy.getrawtransaction(txid)
-        self._cache[txid] = self._proccess_tx(tx)
 
-        if len(self._cache)>self._max_size:
-            self._cache.popitem(last=False)
+        if not hasattr(self._proxy, 'getrawtransactions'):
+            for txid in missing:
+                self._insert(txid, self._load(txid))
+            return
+
+        # Don't request more than is expected to fit into the cache, the
+        # remaining are loaded when accessed.
+        max_txs = max(self._max_bytes//(ENTRY_OVERHEAD+2*TXOUT_RECORD.size), 1)
+        for txid, tx in self._proxy.getrawtransactions(missing[:max_txs]).items():
+            self._insert(txid, self._proccess_tx(tx))
 
-    def txout(self, txid, n):
+    def txout(self, txid, n, spend=True, scripts=None):
         """
         Arguments:
-            txid (str): Transactions id
+            txid (bytes): Transactions id
             n (int): output number
+            spend (bool): The output is being spent, so it won't be
+                requested again and can be dropped.
+            scripts (dict|None): Monitored addresses by scriptPubKey, when
+                provided the address isn't encoded for other outputs.
+
+        Returns:
+            tuple: (addr, value) or ('NO_STANDARD', None) for outputs without
+                a standard address, or not monitored if scripts is provided.
+
+        Raises:
+            IndexError: If the transaction doesn't have output n
         """
-        if txid not in self._cache:
-            # TODO: Only load into cache transaction with more than
-            # one standard output. If they have only one it was 
-            # consumed by this request.
-            self._load(txid)
+        entry = self._cache.get(txid, None)
+        if entry is None:
+            self.misses += 1
+            entry = self._load(txid)
+            cached = False
         else:
+            self.hits += 1
+            cached = True
+
+        # Checked before unpacking, callers expect IndexError for outputs
+        # the transaction doesn't have.
+        if not 0 <= n < (len(entry)-ENTRY_HEADER.size)//TXOUT_RECORD.size:
+            raise IndexError("Output {} out of range".format(n))
+
+        offset = ENTRY_HEADER.size+TXOUT_RECORD.size*n
+        txout_type, txout_hash, value = TXOUT_RECORD.unpack_from(entry, offset)
+
+        # Requested again after being spent (i.e. reorg)
+        if txout_type == TXOUT_SPENT:
+            self._remove(txid)
+            return self.txout(txid, n, spend, scripts)
+
+        if txout_type == TXOUT_NO_STANDARD:
+            addr, value = NO_STANDARD_TXOUT
+        else:
+            script = _unpack_script(txout_type, txout_hash)
+            if scripts is None:
+                addr = str(CBitcoinAddress.from_scriptPubKey(script))
+            else:
+                addr = scripts.get(script, None)
+                if addr is None:
+                    addr, value = NO_STANDARD_TXOUT
+
+            if spend:
+                entry[offset] = TXOUT_SPENT
+                unspent = ENTRY_HEADER.unpack_from(entry, 0)[0]-1
+                ENTRY_HEADER.pack_into(entry, 0, unspent)
+
+        # Transactions without unspent standard outputs won't be needed
+        unspent = ENTRY_HEADER.unpack_from(entry, 0)[0]
+        if not unspent:
+            self._remove(txid)
+        elif cached:
             # Move last accessed to cache top
             self._cache.move_to_end(txid)
+        else:
+            self._insert(txid, entry)
+
+        return addr, value
+
+    def items(self):
+        """Cached entries from least to most recently used
+
+        Returns:
+            list: [(txid, bytearray), ...]
+        """
+        return list(self._cache.items())
 
-        return self._cache[txid][n]
+    def load(self, entries):
+        """Insert entries previously returned by items(), i.e. restored
+        from a snapshot.
+
+        Arguments:
+            entries (iterable): [(txid, bytearray), ...]
+        """
+        for txid, entry in entries:
+            self._insert(txid, entry)
+
+    @property
+    def size(self):
+        """Estimated memory used in bytes"""
+        return self._size
+
+    def flush(self):
+        """Move all entries to the disk cache, so they are available to
+        the next TxOutCache instance."""
+        if self._disk is not None:
+            self._disk.put_many(self._cache.items())
+        self.purge()
 
     def purge(self):
         self._cache = OrderedDict()
-        
+        self._size = 0
+
+    def __contains__(self, txid):
+        return txid in self._cache
+
     def __len__(self):
         return len(self._cache)
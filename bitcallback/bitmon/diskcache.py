@@ -0,0 +1,230 @@
+"""
+diskcache.py
+
+sqlite backed storage for TxOutCache entries evicted from memory, so they
+survive reconnects and restarts.
+"""
+import logging
+import os
+import sqlite3
+
+# Default max disk cache size in bytes
+DEFAULT_DISK_CACHE_BYTES = 512*1024*1024
+
+# Estimated space used by each row besides its outputs (key and index)
+ROW_OVERHEAD = 80
+
+# Max number of parameters in a single sqlite statement
+MAX_QUERY_PARAMS = 500
+
+
+logger = logging.getLogger("Bitcoin")
+
+
+
+class DiskTxOutCache(object):
+    """Packed transaction outputs stored by txid in a sqlite file. Entries
+    are moved into memory when accessed, and written back when evicted
+    from it, so there is only one live copy of each. The oldest are
+    discarded when max_bytes is exceeded.
+
+    Rows moved into memory aren't deleted right away, the deletes are
+    batched with the next write so lookups don't have to commit, and the
+    entries aren't lost if the process exits before they are written back.
+
+    The file is discarded and the cache starts over empty on any database
+    error, since the entries can always be requested again."""
+
+    def __init__(self, path, max_bytes=DEFAULT_DISK_CACHE_BYTES):
+        """
+        Arguments:
+            path (str): sqlite database file, created if it doesn't exist
+            max_bytes (int): Max estimated size
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        self._conn = None
+
+        # txids of the rows moved into memory, pending deletion
+        self._promoted = set()
+
+        try:
+            self._conn = self._connect(path)
+            self._size = self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(outputs)), 0)+COUNT(*)*? FROM txouts",
+                (ROW_OVERHEAD,)).fetchone()[0]
+        except sqlite3.DatabaseError as err:
+            self._discard(err)
+
+        # Entries read and written
+        self.hits = 0
+        self.writes = 0
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path)
+
+        # Losing the last writes on a crash is acceptable for a cache
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS txouts ("
+                     "txid BLOB PRIMARY KEY, outputs BLOB NOT NULL)")
+        conn.commit()
+        return conn
+
+    def _discard(self, err):
+        """Start over with an empty file after a database error"""
+        logger.error("Discarding disk cache {}: {}".format(self._path, err))
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except sqlite3.Error:
+                pass
+
+        for path in (self._path, self._path+'-wal', self._path+'-shm'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+        self._conn = self._connect(self._path)
+        self._size = 0
+        self._promoted = set()
+
+    @staticmethod
+    def _chunks(txids):
+        """Split txids into (chunk, placeholders) tuples for IN queries"""
+        for start in range(0, len(txids), MAX_QUERY_PARAMS):
+            chunk = txids[start:start+MAX_QUERY_PARAMS]
+            yield chunk, ','.join('?'*len(chunk))
+
+    def pop(self, txid):
+        """Remove entry from the cache
+
+        Arguments:
+            txid (bytes): Transaction hash
+
+        Returns:
+            bytearray|None: Packed outputs or None if not found
+        """
+        return self.pop_many([txid]).get(txid, None)
+
+    def pop_many(self, txids):
+        """Remove several entries from the cache, their rows are deleted
+        with the next write.
+
+        Arguments:
+            txids (iterable): Transaction hashes
+
+        Returns:
+            dict: {txid: bytearray} for the ones found
+        """
+        txids = [txid for txid in txids if txid not in self._promoted]
+        found = {}
+        try:
+            for chunk, marks in self._chunks(txids):
+                rows = self._conn.execute(
+                    "SELECT txid, outputs FROM txouts WHERE txid IN ({})".format(marks),
+                    chunk)
+                for txid, outputs in rows:
+                    found[bytes(txid)] = bytearray(outputs)
+        except sqlite3.DatabaseError as err:
+            self._discard(err)
+            return {}
+
+        self._promoted.update(found)
+        self._size -= sum(len(o)+ROW_OVERHEAD for o in found.values())
+        self.hits += len(found)
+        return found
+
+    def _delete(self, txids):
+        """Delete rows, and the pending deletes of promoted ones
+
+        Arguments:
+            txids (list): Transaction hashes
+        """
+        # Rows not promoted are still accounted for in the size
+        stored = [txid for txid in txids if txid not in self._promoted]
+        for chunk, marks in self._chunks(stored):
+            self._size -= self._conn.execute(
+                "SELECT COALESCE(SUM(LENGTH(outputs)), 0)+COUNT(*)*? "
+                "FROM txouts WHERE txid IN ({})".format(marks),
+                [ROW_OVERHEAD]+chunk).fetchone()[0]
+
+        deleted = list(self._promoted)+stored
+        self._conn.executemany("DELETE FROM txouts WHERE txid=?",
+                               [(txid,) for txid in deleted])
+        self._promoted = set()
+
+    def put_many(self, entries):
+        """Store several entries, discarding the oldest ones if the cache
+        is full.
+
+        Arguments:
+            entries (iterable): [(txid, bytearray), ...]
+        """
+        entries = [(txid, bytes(outputs)) for txid, outputs in entries]
+        if not entries and not self._promoted:
+            return
+
+        try:
+            # Replaced entries are removed first so the size is kept accurate
+            self._delete([txid for txid, _ in entries])
+            self._conn.executemany("INSERT INTO txouts (txid, outputs) VALUES (?, ?)",
+                                   entries)
+            self._size += sum(len(o)+ROW_OVERHEAD for _, o in entries)
+            self.writes += len(entries)
+
+            if self._size > self._max_bytes:
+                self._evict()
+            self._conn.commit()
+        except sqlite3.DatabaseError as err:
+            self._discard(err)
+
+    def put(self, txid, outputs):
+        self.put_many([(txid, outputs)])
+
+    def _evict(self):
+        """Remove oldest entries until the size limit is met"""
+        while self._size > self._max_bytes:
+            rows = self._conn.execute(
+                "SELECT rowid, LENGTH(outputs) FROM txouts ORDER BY rowid LIMIT ?",
+                (MAX_QUERY_PARAMS,)).fetchall()
+            if not rows:
+                break
+
+            evicted = []
+            for rowid, length in rows:
+                evicted.append((rowid,))
+                self._size -= length+ROW_OVERHEAD
+                if self._size <= self._max_bytes:
+                    break
+
+            self._conn.executemany("DELETE FROM txouts WHERE rowid=?", evicted)
+
+    @property
+    def size(self):
+        """Estimated size in bytes"""
+        return self._size
+
+    def close(self):
+        """Apply pending deletes and close the file"""
+        if self._promoted:
+            self.put_many([])
+        self._conn.close()
+
+    def __contains__(self, txid):
+        if txid in self._promoted:
+            return False
+        try:
+            return self._conn.execute("SELECT 1 FROM txouts WHERE txid=?",
+                                      (txid,)).fetchone() is not None
+        except sqlite3.DatabaseError as err:
+            self._discard(err)
+            return False
+
+    def __len__(self):
+        try:
+            count = self._conn.execute("SELECT COUNT(*) FROM txouts").fetchone()[0]
+        except sqlite3.DatabaseError as err:
+            self._discard(err)
+            return 0
+        return count-len(self._promoted)
@@ -0,0 +1,161 @@
+from collections import defaultdict
+
+# Marks outpoints without staged changes
+_MISSING = object()
+
+
+class OutpointIndex(object):
+    """Index of the unspent transaction outputs (txid, n) paying to monitored
+    addresses, used to detect inputs spending them without having to look
+    up the previous transaction.
+
+    Outputs added and spent while blocks are processed are staged, they
+    are only applied with commit() once the blocks are saved, or discarded
+    with rollback() if processing fails, so the index is always consistent
+    with the last saved block."""
+
+    def __init__(self):
+        # {(txid, n): (addr, value)}
+        self._outpoints = {}
+
+        # Outpoints by address, so they can be discarded when an address
+        # is no longer monitored.
+        self._by_addr = defaultdict(set)
+
+        # Staged changes {(txid, n): (addr, value) when added, None when
+        # an indexed output is spent}
+        self._staged = {}
+
+        # Changes since the last commit
+        self._added = {}
+        self._spent = set()
+
+    def _add(self, outpoint, addr, value):
+        # Replaced outputs are deleted before they are stored again
+        if outpoint in self._outpoints:
+            self._remove(outpoint)
+        self._outpoints[outpoint] = (addr, value)
+        self._by_addr[addr].add(outpoint)
+        self._added[outpoint] = (addr, value)
+
+    def _remove(self, outpoint):
+        addr, value = self._outpoints.pop(outpoint)
+
+        addr_outpoints = self._by_addr[addr]
+        addr_outpoints.discard(outpoint)
+        if not addr_outpoints:
+            del self._by_addr[addr]
+
+        # Not stored yet, so there is no need to record it as spent.
+        if self._added.pop(outpoint, None) is None:
+            self._spent.add(outpoint)
+
+        return addr, value
+
+    def add(self, txid, n, addr, value):
+        """Stage output
+
+        Arguments:
+            txid (bytes): Transaction hash
+            n (int): Output number
+            addr (str): Output address
+            value (int): Output value in satoshis
+        """
+        self._staged[(txid, n)] = (addr, value)
+
+    def spend(self, txid, n):
+        """Stage outpoint removal from the index
+
+        Returns:
+            tuple|None: (addr, value) for the spent output, or None when it
+                wasn't indexed
+        """
+        outpoint = (txid, n)
+        txout = self.get(txid, n)
+        if txout is None:
+            return None
+
+        if outpoint in self._outpoints:
+            self._staged[outpoint] = None
+        else:
+            del self._staged[outpoint]
+        return txout
+
+    def commit(self):
+        """Apply staged changes, and reset the changes reported once they
+        have been saved"""
+        for outpoint, txout in self._staged.items():
+            if txout is not None:
+                self._add(outpoint, *txout)
+            elif outpoint in self._outpoints:
+                self._remove(outpoint)
+
+        self._staged = {}
+        self._added, self._spent = {}, set()
+
+    def rollback(self):
+        """Discard staged changes"""
+        self._staged = {}
+
+    def discard_addr(self, addr):
+        """Remove all the outpoints for an address"""
+        for outpoint in list(self._by_addr.get(addr, ())):
+            self._remove(outpoint)
+
+        for outpoint, txout in list(self._staged.items()):
+            if txout is not None and txout[0] == addr:
+                del self._staged[outpoint]
+
+    def load(self, outpoints):
+        """Load previously stored outpoints, they aren't reported as changes.
+
+        Arguments:
+            outpoints (iterable): [(txid, n, addr, value), ...]
+        """
+        for txid, n, addr, value in outpoints:
+            self._outpoints[(txid, n)] = (addr, value)
+            self._by_addr[addr].add((txid, n))
+
+    def changes(self):
+        """Return the changes since the last commit, including the staged
+        ones, to be saved before calling commit.
+
+        Returns:
+            tuple: ({(txid, n): (addr, value)} added, {(txid, n)} spent)
+        """
+        added, spent = dict(self._added), set(self._spent)
+        for outpoint, txout in self._staged.items():
+            if txout is None:
+                if added.pop(outpoint, None) is None:
+                    spent.add(outpoint)
+            else:
+                if outpoint in self._outpoints and outpoint not in added:
+                    spent.add(outpoint)
+                added[outpoint] = txout
+        return added, spent
+
+    def get(self, txid, n):
+        # Also called from the block prefetch thread, so the staged changes
+        # are read with a single lookup on a local reference, as they can be
+        # modified or replaced meanwhile.
+        outpoint = (txid, n)
+        staged = self._staged.get(outpoint, _MISSING)
+        if staged is not _MISSING:
+            return staged
+        return self._outpoints.get(outpoint, None)
+
+    def __contains__(self, outpoint):
+        return self.get(*outpoint) is not None
+
+    def __bool__(self):
+        # Checked by the scanner for each input, without counting them
+        return bool(self._outpoints) or bool(self._staged)
+
+    def __len__(self):
+        size = len(self._outpoints)
+        for outpoint, txout in self._staged.items():
+            if txout is None:
+                size -= 1
+            elif outpoint not in self._outpoints:
+                size += 1
+        return size
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+# Default max number of decoded transactions kept for reuse
+DEFAULT_DECODED_SIZE = 50000
+
+
+
+class MempoolTracker(object):
+    """Track bitcoind mempool contents between polls, so only transactions
+    not present in the previous snapshot are requested and decoded. Decoded
+    transactions are kept so they don't have to be decoded again once
+    confirmed."""
+
+    def __init__(self, max_decoded=DEFAULT_DECODED_SIZE):
+        """
+        Arguments:
+            max_decoded (int): Max number of decoded transactions kept,
+                least recently added are discarded first.
+        """
+        # Transaction hashes in the mempool on the last committed update,
+        # and on the last update until it's committed.
+        self._snapshot = set()
+        self._pending = None
+
+        # Decoded transactions {txid: (CTransaction, prevouts)}
+        self._decoded = OrderedDict()
+        self._max_decoded = max_decoded
+
+    def update(self, txids):
+        """Compare mempool with the snapshot, it isn't replaced until
+        commit is called, once the new transactions have been processed.
+
+        Arguments:
+            txids (iterable): Transaction hashes currently in the mempool
+
+        Returns:
+            list: Transaction hashes not present in the previous snapshot
+        """
+        snapshot = set(txids)
+        new = [txid for txid in snapshot if txid not in self._snapshot]
+        self._pending = snapshot
+        return new
+
+    def commit(self):
+        """Replace snapshot with the last update"""
+        if self._pending is not None:
+            self._snapshot, self._pending = self._pending, None
+
+    def add_decoded(self, txid, tx, prevouts):
+        """
+        Arguments:
+            txid (bytes): Transaction hash
+            tx (bitcoin.core.CTransaction): Decoded transaction
+            prevouts (list): Output spent by each input (addr, value) or None
+                when it wasn't resolved.
+        """
+        self._decoded[txid] = (tx, prevouts)
+        if len(self._decoded) > self._max_decoded:
+            self._decoded.popitem(last=False)
+
+    def pop_decoded(self, txid):
+        """Remove decoded transaction
+
+        Returns:
+            tuple|None: (CTransaction, prevouts) or None if it wasn't decoded
+        """
+        return self._decoded.pop(txid, None)
+
+    def is_decoded(self, txid):
+        return txid in self._decoded
+
+    def __contains__(self, txid):
+        return txid in self._snapshot
+
+    def __len__(self):
+        return len(self._snapshot)
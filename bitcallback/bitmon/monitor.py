@@ -1,9 +1,24 @@
+from collections import namedtuple
 import bitcoin
 import bitcoin.rpc as rpc
-from bitcoin.core import str_money_value, b2lx, b2x, x
+from bitcoin.core import str_money_value, b2lx, b2x, x, COIN, CScript, CTransaction
 from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError, P2SHBitcoinAddress, P2PKHBitcoinAddress
 from .transaction import Transaction
-from .cache import TxOutCache
+from .cache import TxOutCache, DEFAULT_CACHE_BYTES, NO_STANDARD_TXOUT
+from .index import OutpointIndex
+from .registry import AddressRegistry
+from .scanner import scan_block
+from .prefetch import BlockPrefetcher, DEFAULT_PREFETCH_WINDOW
+from .rpc import get_block_hashes
+
+# First bitcoind version whose getblock returns spent outputs (verbosity 3)
+BLOCK_PREVOUTS_VERSION = 230000
+
+# Downloaded and decoded block ready to be processed. Either raw, the serialized
+# block to scan, or vtx the block transactions along with prevouts (script and
+# value of the outputs spent by each transaction or None when not available)
+# and spent_txs ({txid: CTransaction} already downloaded for the spent outputs).
+FetchedBlock = namedtuple('FetchedBlock', ['raw', 'vtx', 'prevouts', 'spent_txs'])
 
 
 
@@ -11,7 +26,11 @@ class TransactionMonitor(object):
     """Monitor blockchains for confirmed transactions where at least
     one of the outputs is for one of the monitored addresses"""
 
-    def __init__(self, proxy, confirmations=1, start_block=-1):
+    def __init__(self, proxy, confirmations=1, start_block=-1, max_blocks=1,
+                 txout_cache=True, outpoint_index=None,
+                 prefetch_proxy=None, prefetch_window=DEFAULT_PREFETCH_WINDOW,
+                 mempool=None, cache_bytes=DEFAULT_CACHE_BYTES, disk_cache=None,
+                 rpc_pool=None):
         """
         Arguments:
             proxy: bitcoin.rpc proxy object
@@ -20,19 +39,56 @@ class TransactionMonitor(object):
                 be larger than the max number of confirmations.
             start_block (int): Number of the block where monitoring
                 starts, -1 for last
+            max_blocks (int|None): Max number of blocks processed by each
+                get_confirmed call, None to process all pending blocks.
+            txout_cache (bool): Resolve inputs not found in the outpoint
+                index with getrawtransaction. When disabled, spends of
+                outputs received before an address was monitored are
+                not detected.
+            outpoint_index (OutpointIndex|None): Index of outputs paying to
+                monitored addresses, shared between monitor instances so
+                it isn't lost on reconnects.
+            prefetch_proxy: bitcoin.rpc proxy connection used to download
+                blocks ahead in a background thread, None to disable.
+            prefetch_window (int): Max number of blocks downloaded ahead
+            mempool (MempoolTracker|None): Mempool state, used to report
+                unconfirmed transactions, None to disable. Shared between
+                monitor instances so they aren't reported again on reconnects.
+            cache_bytes (int): Max memory used by the transaction output cache
+            disk_cache (DiskTxOutCache|None): Persistent second tier for the
+                transaction output cache, shared between monitor instances.
+            rpc_pool (ProxyPool|None): Connections used to request the
+                outputs spent by each block concurrently, it's closed along
+                with the monitor.
         """
         assert confirmations > 0
+        assert max_blocks is None or max_blocks > 0
 
         self._confirmations = confirmations
 
-        # Address being monitored
-        self._monitored = set()
+        # Per call block budget while catching up
+        self._max_blocks = max_blocks
+
+        # Addresses being monitored, by scriptPubKey so outputs can be
+        # matched without encoding their address. It's replaced by the
+        # subscriptions registry with set_registry.
+        self._monitored_scripts = AddressRegistry()
 
         # Bitcoinlib rpc proxy
         self._proxy = proxy
         
+        # Connections for concurrent transaction requests
+        self._rpc_pool = rpc_pool
+
         # Transaction output cache
-        self._cache = TxOutCache(self._proxy, max_size=20000)
+        self._cache = None
+        if txout_cache:
+            self._cache = TxOutCache(rpc_pool or self._proxy, cache_bytes, disk_cache)
+
+        # Unspent outputs for monitored addresses
+        if outpoint_index is None:
+            outpoint_index = OutpointIndex()
+        self._index = outpoint_index
 
         #
         if start_block < 0:
@@ -40,12 +96,148 @@ class TransactionMonitor(object):
 
         self._current_block = start_block
 
-    def _load_block(self, blocknum):
-        blockhash = self._proxy.getblockhash(blocknum)
-        return self._proxy.getblock(blockhash)
+        # Last blockchain height seen, used to report lag
+        self._last_block = self._current_block
+
+        # Spent outputs are included in getblock responses, enabled
+        # by detect_block_prevouts.
+        self._block_prevouts = False
+
+        # Mempool snapshot and transactions decoded from it
+        self._mempool = mempool
+
+        # Background block downloads
+        self._prefetcher = None
+        if prefetch_proxy is not None:
+            self._prefetcher = BlockPrefetcher(
+                prefetch_proxy,
+                lambda proxy, blockhash: self._fetch_block(proxy, blockhash, True),
+                prefetch_window)
+
+    def detect_block_prevouts(self):
+        """Check if bitcoind getblock supports verbosity 3, it includes the
+        output spent by each input, and use it to load blocks.
+
+        Returns:
+            bool: True if supported, False otherwise
+        """
+        version = self._proxy.call('getnetworkinfo')['version']
+        self._block_prevouts = version >= BLOCK_PREVOUTS_VERSION
+        return self._block_prevouts
+
+    def _get_block_hashes(self, heights):
+        """Get hashes for several blocks, using a single batch call when
+        the proxy supports it.
+
+        Arguments:
+            heights (range): block numbers
+
+        Returns:
+            list: [blockhash, blockhash, ...]
+        """
+        return get_block_hashes(self._proxy, heights)
+
+    def _fetch_block(self, proxy, blockhash, spent_txs=False):
+        """Download and decode a block. It doesn't modify the monitor state, so
+        it can be called from the prefetch thread with its own proxy.
+
+        The cache, outpoint index and mempool are only read to skip spent
+        transactions that won't be needed, while the main thread may be
+        updating them. Reads are single lookups so they can't fail, a stale
+        one only costs requesting a transaction that wasn't needed, or
+        loading one that was later when it's accessed.
+
+        Arguments:
+            proxy: bitcoin.rpc proxy object
+            blockhash (bytes):
+            spent_txs (bool): Also download the transactions with outputs
+                spent by the block, if they will be needed.
+
+        Returns:
+            FetchedBlock
+        """
+        # When inputs are only resolved through the outpoint index, the raw
+        # block is scanned and only the transactions involving monitored
+        # addresses are decoded.
+        if self._cache is None and not self._block_prevouts:
+            raw = x(proxy.call('getblock', b2lx(blockhash), 0))
+            return FetchedBlock(raw, None, None, {})
+
+        if self._block_prevouts:
+            block = proxy.call('getblock', b2lx(blockhash), 3)
+            vtx = [CTransaction.deserialize(x(tx['hex'])) for tx in block['tx']]
+            # prevout is missing for coinbase inputs, and when the node
+            # doesn't have the block undo data. Those are resolved through
+            # the outpoint index or TxOutCache.
+            prevouts = [[self._prevout_script(tin['prevout']) if 'prevout' in tin else None
+                         for tin in tx['vin']] for tx in block['tx']]
+            return FetchedBlock(None, vtx, prevouts, {})
+
+        vtx = proxy.getblock(blockhash).vtx
+        if self._rpc_pool is not None:
+            proxy = self._rpc_pool
+        if not spent_txs or not hasattr(proxy, 'getrawtransactions'):
+            return FetchedBlock(None, vtx, None, {})
+
+        block_txids = set(tx.GetTxid() for tx in vtx)
+        missing = set(tin.prevout.hash for tx in vtx if not tx.is_coinbase() and
+                      not self._is_decoded(tx)
+                      for tin in tx.vin if tin.prevout.hash not in block_txids and
+                      tin.prevout.hash not in self._cache and
+                      (tin.prevout.hash, tin.prevout.n) not in self._index)
+        return FetchedBlock(None, vtx, None, proxy.getrawtransactions(missing))
+
+    def _fetch_blocks(self, heights, lastheight):
+        """Generate fetched blocks, from the prefetch thread when enabled
+
+        Arguments:
+            heights (range): Height of the blocks to fetch
+            lastheight (int): Last block height that can be processed
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.set_target(lastheight)
+            for height in heights:
+                yield self._prefetcher.get(height)
+            return
+
+        for blockhash in self._get_block_hashes(heights):
+            yield self._fetch_block(self._proxy, blockhash)
+
+    @staticmethod
+    def _prevout_script(prevout):
+        """Convert getblock prevout into (script, value), the address is only
+        needed if the script is monitored"""
+        return (x(prevout['scriptPubKey']['hex']), int(prevout['value']*COIN))
+
+    def _match_prevouts(self, tx_prevouts):
+        """Convert transaction prevouts (script, value) into the same
+        (addr, value) format used by TxOutCache, the ones not monitored
+        are ignored as non standard, and missing ones (None) kept."""
+        scripts = self._monitored_scripts
+        matched = []
+        for prevout in tx_prevouts:
+            if prevout is None:
+                matched.append(None)
+            elif prevout[0] in scripts:
+                matched.append((scripts[prevout[0]], prevout[1]))
+            else:
+                matched.append(NO_STANDARD_TXOUT)
+        return matched
+
+    def _is_decoded(self, tx):
+        """Check if the transaction inputs were resolved while in the mempool"""
+        return self._mempool is not None and self._mempool.is_decoded(tx.GetTxid())
+
+    def _decoded_prevouts(self, tx):
+        """Outputs spent by a transaction resolved while it was in the
+        mempool, or None if it wasn't seen."""
+        if self._mempool is None:
+            return None
+        decoded = self._mempool.pop_decoded(tx.GetTxid())
+        return decoded[1] if decoded is not None else None
 
     def _is_monitored_addr(self, addr):
-        return addr in self._monitored
+        return self._monitored_scripts.id(addr) is not None
 
     def _is_monitored_transaction(self, tran):
         """Check if transaction has at least one output for a monitored address
@@ -67,57 +259,328 @@ class TransactionMonitor(object):
 
         return False
 
-    def _process_block_transactions(self, block):
-        """Get block Transactions
+    def _get_block_transactions(self, block):
+        """Generate fetched block transactions involving monitored addresses,
+        one at a time as they are processed.
+
+        Arguments:
+            block (FetchedBlock):
+
+        Returns:
+            generator: Transaction
+        """
+        if block.raw is not None:
+            return self._scan_block_transactions(block.raw)
+
+        # Prevouts are matched against the monitored scripts as each
+        # transaction is processed.
+        prevouts = block.prevouts
+        if prevouts is not None:
+            prevouts = (self._match_prevouts(tx_prevouts) for tx_prevouts in prevouts)
+
+        return self._process_block_transactions(block.vtx, prevouts,
+                                                block.spent_txs)
+
+    def _scan_block_transactions(self, raw):
+        """Generate transactions from serialized block, paying to a monitored
+        script or spending an indexed outpoint.
+
+        Arguments:
+            raw (bytes): Serialized block
+
+        Returns:
+            generator: Transaction
+        """
+        for start, end in scan_block(raw, self._monitored_scripts, self._index):
+            tx = CTransaction.deserialize(raw[start:end])
+            tran = Transaction(tx, None, self._index, scripts=self._monitored_scripts)
+
+            # The scanner is lazy, so outputs are indexed before the
+            # remaining transactions are scanned.
+            self._index_outputs(tx)
+
+            if self._is_monitored_transaction(tran):
+                yield tran
+
+    def _process_block_transactions(self, vtx, prevouts=None, spent_txs=None):
+        """Generate block Transactions involving monitored addresses. Outputs
+        are matched first by script, and inputs resolved through the outpoint
+        index when possible, only the remaining ones are looked up in
+        TxOutCache (matching scripts, without encoding their address).
         
         Arguments:
-            block (bitcoin.CBlock)
+            vtx (list): Block transactions [bitcoin.CTransaction, ...]
+            prevouts (iterable|None): Outputs spent by each transaction,
+                (addr, value) or ('NO_STANDARD', None) if not monitored,
+                when provided TxOutCache is only used for the missing
+                ones (None).
+            spent_txs (dict|None): Already downloaded transactions with
+                outputs spent by the block.
 
         Returns:
-            list: [Transaction, Transaction, ....]
+            generator: Transaction
         """
         cache = self._get_cache()
-        return [Transaction(tx, cache) for tx in block.vtx]
+        index = self._index
+
+        # Reuse the inputs resolved for transactions seen in the mempool
+        if prevouts is None:
+            prevouts = [self._decoded_prevouts(tx) for tx in vtx]
+
+            # Request all the outputs spent by the block in as few calls as
+            # possible, before they are accessed one by one. Those found in
+            # the outpoint index don't need to be requested.
+            if cache is not None:
+                block_txs = dict(spent_txs or {})
+                block_txs.update((tx.GetTxid(), tx) for tx in vtx)
+                spent = [tin.prevout.hash for tx, tx_prevouts in zip(vtx, prevouts)
+                         if not tx.is_coinbase() for n, tin in enumerate(tx.vin)
+                         if (tx_prevouts is None or tx_prevouts[n] is None) and
+                         (tin.prevout.hash, tin.prevout.n) not in index]
+                cache.prefetch(spent, known=block_txs)
+
+        for tx, tx_prevouts in zip(vtx, prevouts):
+            tran = Transaction(tx, cache, index, tx_prevouts, self._monitored_scripts)
+
+            # Index outputs for monitored addresses before the next
+            # transaction is processed, it could spend them.
+            if tran.tout:
+                self._index_outputs(tx)
+
+            if self._is_monitored_transaction(tran):
+                yield tran
+
+    def _index_outputs(self, tx):
+        """Add transaction outputs paying to monitored addresses to the
+        outpoint index
+
+        Arguments:
+            tx (bitcoin.core.CTransaction)
+        """
+        txid = tx.GetTxid()
+        scripts = self._monitored_scripts
+        for n, txout in enumerate(tx.vout):
+            addr = scripts.get(txout.scriptPubKey)
+            if addr is not None:
+                self._index.add(txid, n, addr, txout.nValue)
 
     def _get_cache(self):
         return self._cache
 
+    @property
+    def txout_cache(self):
+        return self._cache
+
+    @property
+    def outpoint_index(self):
+        return self._index
+
     @property
     def current_block(self):
         return self._current_block
 
+    @property
+    def lag(self):
+        """Number of blocks pending processing the last time the blockchain
+        was polled"""
+        return max(self._last_block-self._current_block, 0)
+
+    def iter_confirmed(self):
+        """
+        Generate confirmed transactions involving any of the monitored
+        addresses, from all the pending blocks up to the per call block
+        budget. Blocks are counted as processed once all their transactions
+        have been generated.
+
+        Returns:
+            generator: Transaction
+        """ 
+        self._last_block = lastblock = self._proxy.getblockcount()
+
+        pending = max(lastblock-self._current_block, 0)
+        if self._max_blocks is not None:
+            pending = min(pending, self._max_blocks)
+
+        monitored_block = self._current_block-self._confirmations+1
+        heights = range(monitored_block, monitored_block+pending)
+
+        for block in self._fetch_blocks(heights, lastblock-self._confirmations):
+            for tran in self._get_block_transactions(block):
+                yield tran
+     
+            self._current_block += 1
+
     def get_confirmed(self):
         """
-        Get confirmed transactions involving any of the monitored addresses
+        Get confirmed transactions involving any of the monitored addresses,
+        from all the pending blocks up to the per call block budget.
 
         Returns:
             list: [Transaction, Transaction, ...]
         """ 
+        return list(self.iter_confirmed())
+
+    def get_block_range(self, first, last):
+        """
+        Get transactions involving any of the monitored addresses from a
+        range of blocks, independently of the blocks being monitored.
+
+        Arguments:
+            first (int): First block height
+            last (int): Last block height (included)
+
+        Returns:
+            list: [Transaction, Transaction, ...]
+        """
         transactions = []
-        
-        lastblock = self._proxy.getblockcount()
-        if lastblock == self._current_block:
+        for blockhash in self._get_block_hashes(range(first, last+1)):
+            block = self._fetch_block(self._proxy, blockhash)
+            transactions.extend(self._get_block_transactions(block))
+
+        return transactions
+
+    def _get_transactions(self, txids):
+        """Get transactions still available, those not found are ignored
+
+        Arguments:
+            txids (list): Transaction hashes
+
+        Returns:
+            dict: {txid: bitcoin.core.CTransaction}
+        """
+        if hasattr(self._proxy, 'getrawtransactions'):
+            return self._proxy.getrawtransactions(txids, ignore_missing=True)
+
+        txs = {}
+        for txid in txids:
+            try:
+                txs[txid] = self._proxy.getrawtransaction(txid)
+            except IndexError:
+                # Removed from the mempool since it was listed
+                pass
+        return txs
+
+    def _mempool_prevout(self, prevout):
+        """Output spent by a mempool transaction input, the outpoint index
+        isn't modified until the transaction is confirmed.
+
+        Returns:
+            tuple|None: (addr, value) or None if it couldn't be resolved
+        """
+        txout = self._index.get(prevout.hash, prevout.n)
+        if txout is None and self._cache is not None:
+            try:
+                txout = self._cache.txout(prevout.hash, prevout.n, spend=False)
+            except IndexError:
+                # Parent transaction confirmed and not available without
+                # txindex, or replaced.
+                pass
+        return txout
+
+    def get_unconfirmed(self):
+        """
+        Get mempool transactions involving any of the monitored addresses,
+        only those added to the mempool since the last call are requested
+        and decoded.
+
+        Returns:
+            list: [Transaction, Transaction, ...]
+        """
+        if self._mempool is None:
             return []
 
-        if self._current_block < lastblock:
-            monitored_block = self._current_block-self._confirmations+1
-            block = self._load_block(monitored_block)
-            trans = self._process_block_transactions(block)
-            transactions.extend(trans)
-     
-            self._current_block += 1
- 
-        return [t for t in transactions if self._is_monitored_transaction(t)]
+        # Transactions are only marked as seen once they are decoded, so
+        # they are requested again if it fails.
+        new = self._mempool.update(self._proxy.getrawmempool())
+        if not new:
+            self._mempool.commit()
+            return []
+
+        txs = self._get_transactions(new)
+
+        # Request the outputs spent by the new transactions in as few calls
+        # as possible, unconfirmed parents are usually among them.
+        if self._cache is not None:
+            spent = [tin.prevout.hash for tx in txs.values() for tin in tx.vin
+                     if (tin.prevout.hash, tin.prevout.n) not in self._index]
+            try:
+                self._cache.prefetch(spent, known=txs)
+            except IndexError:
+                # Resolved one by one, skipping those not available
+                pass
+
+        transactions = []
+        for txid, tx in txs.items():
+            prevouts = [self._mempool_prevout(tin.prevout) for tin in tx.vin]
+            self._mempool.add_decoded(txid, tx, prevouts)
+
+            tran = Transaction(tx, None, None, prevouts, self._monitored_scripts)
+            if self._is_monitored_transaction(tran):
+                transactions.append(tran)
+
+        self._mempool.commit()
+        return transactions
+
+    def close(self):
+        """Stop background block downloads, and move cached outputs to the
+        disk cache if there is one"""
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        if self._cache is not None:
+            self._cache.flush()
+        if self._rpc_pool is not None:
+            self._rpc_pool.close()
 
     # ADD/DEL Address, text existence
+    @property
+    def registry(self):
+        """Monitored addresses (AddressRegistry)"""
+        return self._monitored_scripts
+
+    def set_registry(self, registry):
+        """Monitor the addresses in a registry shared with their owner,
+        instead of the ones added with add_addr. Addresses removed from it
+        must be discarded with discard_addr.
+
+        Arguments:
+            registry (AddressRegistry):
+        """
+        self._monitored_scripts = registry
+
     def add_addr(self, addr):
         assert isinstance(addr, str)
-        self._monitored.add(addr)
+        self._monitored_scripts.acquire(addr)
+
+    def add_addrs(self, addrs):
+        """Add several addresses in a single pass
+
+        Arguments:
+            addrs (iterable): Addresses (str)
+        """
+        registry = self._monitored_scripts
+        for addr in addrs:
+            assert isinstance(addr, str)
+            registry.acquire(addr)
 
     def del_addr(self, addr):
-        self._monitored.remove(addr)
+        addr_id = self._monitored_scripts.id(addr)
+        if addr_id is not None and self._monitored_scripts.release(addr_id) is not None:
+            self.discard_addr(addr)
+
+    def discard_addr(self, addr):
+        """Discard indexed outputs for an address no longer monitored"""
+        self._index.discard_addr(addr)
+
+    def discard_addrs(self, addrs):
+        """Discard indexed outputs for several addresses no longer monitored
+
+        Arguments:
+            addrs (iterable): Addresses (str)
+        """
+        for addr in addrs:
+            self._index.discard_addr(addr)
 
     def __contains__(self, addr):
-        return addr in self._monitored
+        return self._is_monitored_addr(addr)
 
 
@@ -0,0 +1,241 @@
+import logging
+import os
+import socket
+import struct
+import threading
+
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+# Notification topics published by bitcoind (-zmqpubhashblock, -zmqpubrawblock)
+TOPIC_HASHBLOCK = b'hashblock'
+TOPIC_RAWBLOCK = b'rawblock'
+
+# Unix socket frame header (topic length, body length)
+FRAME_HEADER = struct.Struct('>HI')
+
+# Seconds between reconnection attempts
+RECONNECT_PERIOD = 1
+
+# Max time blocked waiting for messages before checking the close flag
+POLL_TIMEOUT = 0.5
+
+
+logger = logging.getLogger("Bitcoin")
+
+
+def pack_message(topic, body):
+    """Serialize notification for Unix socket transport"""
+    return FRAME_HEADER.pack(len(topic), len(body))+topic+body
+
+def unpack_messages(buff):
+    """Extract all complete notifications from a buffer
+
+    Arguments:
+        buff (bytearray): Received data, the extracted messages are removed
+
+    Returns:
+        list: [(topic, body), ...]
+    """
+    messages = []
+    while len(buff) >= FRAME_HEADER.size:
+        topic_len, body_len = FRAME_HEADER.unpack_from(buff)
+        end = FRAME_HEADER.size+topic_len+body_len
+        if len(buff) < end:
+            break
+
+        topic = bytes(buff[FRAME_HEADER.size:FRAME_HEADER.size+topic_len])
+        body = bytes(buff[FRAME_HEADER.size+topic_len:end])
+        del buff[:end]
+        messages.append((topic, body))
+
+    return messages
+
+
+
+class BlockNotifier(object):
+    """Subscribe to new block notifications in a background thread, calling
+    func each time one is received. Supported urls are bitcoind ZMQ endpoints
+    (tcp://host:port or ipc://path, requires pyzmq) and unix://path for
+    UnixBlockPublisher."""
+
+    def __init__(self, url, func, topics=(TOPIC_HASHBLOCK,)):
+        """
+        Arguments:
+            url (str): Publisher endpoint
+            func (function): Called as func(topic, body) from the notifier thread
+            topics (tuple): Notification topics, a new block only needs to
+                wake up the monitor, so full blocks (rawblock) are ignored
+                by default.
+        """
+        if url.startswith('unix://'):
+            target = BlockNotifier._unix_func
+        elif url.startswith(('tcp://', 'ipc://')):
+            if zmq is None:
+                raise ImportError("pyzmq is required for {} notifications".format(url))
+            target = BlockNotifier._zmq_func
+        else:
+            raise ValueError("Unsupported notification url {}".format(url))
+
+        self._url = url
+        self._func = func
+        self._topics = tuple(topics)
+
+        # Flag used to notify the thread to stop
+        self._close_flag = threading.Event()
+
+        self._thread = threading.Thread(target=target, args=(self,), daemon=True)
+        self._thread.start()
+
+    def _notify(self, topic, body):
+        if topic not in self._topics:
+            return
+        try:
+            self._func(topic, body)
+        except Exception as err:
+            logger.error(err, exc_info=True)
+
+    @staticmethod
+    def _unix_func(notifier):
+        """Unix socket subscriber thread, reconnects when the publisher
+        is restarted"""
+        path = notifier._url[len('unix://'):]
+
+        while not notifier._close_flag.is_set():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(POLL_TIMEOUT)
+            try:
+                sock.connect(path)
+            except OSError:
+                sock.close()
+                notifier._close_flag.wait(RECONNECT_PERIOD)
+                continue
+
+            buff = bytearray()
+            while not notifier._close_flag.is_set():
+                try:
+                    data = sock.recv(65536)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+
+                # Publisher closed the connection
+                if not data:
+                    break
+
+                buff.extend(data)
+                for topic, body in unpack_messages(buff):
+                    notifier._notify(topic, body)
+
+            sock.close()
+
+    @staticmethod
+    def _zmq_func(notifier):
+        """bitcoind ZMQ subscriber thread, ZMQ handles the reconnections"""
+        context = zmq.Context.instance()
+        sock = context.socket(zmq.SUB)
+        for topic in notifier._topics:
+            sock.setsockopt(zmq.SUBSCRIBE, topic)
+        sock.connect(notifier._url)
+
+        try:
+            while not notifier._close_flag.is_set():
+                if not sock.poll(int(POLL_TIMEOUT*1000)):
+                    continue
+                # Messages: [topic, body, sequence number]
+                topic, body = sock.recv_multipart()[:2]
+                notifier._notify(topic, body)
+        finally:
+            sock.close(linger=0)
+
+    def close(self, timeout=None):
+        self._close_flag.set()
+        self._thread.join(timeout)
+
+
+
+class UnixBlockPublisher(object):
+    """Local stand-in for bitcoind block notifications, it publishes messages
+    to every BlockNotifier connected to a Unix socket. Used to test push
+    notifications without a node, or to forward bitcoind -blocknotify."""
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path (str): Unix socket path, removed if it already exists
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._path = path
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._close_flag = threading.Event()
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(POLL_TIMEOUT)
+        self._sock.bind(path)
+        self._sock.listen(5)
+
+        self._thread = threading.Thread(
+            target=UnixBlockPublisher._accept_func,
+            args=(self,),
+            daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return 'unix://'+self._path
+
+    @staticmethod
+    def _accept_func(publisher):
+        """Accept new subscribers"""
+        while not publisher._close_flag.is_set():
+            try:
+                conn, _ = publisher._sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            with publisher._lock:
+                publisher._subscribers.append(conn)
+
+    def publish(self, topic, body):
+        """Send notification to all subscribers, the ones disconnected
+        are discarded"""
+        message = pack_message(topic, body)
+        with self._lock:
+            for conn in list(self._subscribers):
+                try:
+                    conn.sendall(message)
+                except OSError:
+                    conn.close()
+                    self._subscribers.remove(conn)
+
+    def publish_block(self, blockhash):
+        """
+        Arguments:
+            blockhash (bytes): Block hash in RPC byte order, as bitcoind
+                hashblock notifications
+        """
+        self.publish(TOPIC_HASHBLOCK, blockhash)
+
+    def __len__(self):
+        """Number of subscribers"""
+        with self._lock:
+            return len(self._subscribers)
+
+    def close(self):
+        self._close_flag.set()
+        self._thread.join()
+        with self._lock:
+            for conn in self._subscribers:
+                conn.close()
+            self._subscribers = []
+        self._sock.close()
+        if os.path.exists(self._path):
+            os.unlink(self._path)
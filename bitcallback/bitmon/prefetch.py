@@ -0,0 +1,155 @@
+import threading
+import queue
+
+from .rpc import get_block_hashes
+
+# Default number of blocks downloaded ahead of the one being processed
+DEFAULT_PREFETCH_WINDOW = 4
+
+
+
+class BlockPrefetcher(object):
+    """Download and decode blocks in a background thread, ahead of the one
+    being processed, so the next block is ready once the current one has
+    been processed and its callbacks dispatched."""
+
+    def __init__(self, proxy, fetch_func, window=DEFAULT_PREFETCH_WINDOW):
+        """
+        Arguments:
+            proxy: bitcoin.rpc proxy, only used by the prefetch thread
+            fetch_func (function): Called as fetch_func(proxy, blockhash) to
+                download and decode a block, it must not modify any state
+                shared with the main thread.
+            window (int): Max number of blocks fetched ahead, it bounds the
+                memory used while catching up.
+        """
+        assert window > 0
+        self._proxy = proxy
+        self._fetch_func = fetch_func
+        self._window = window
+
+        # Fetched blocks (generation, height, block|exception)
+        self._blocks = queue.Queue(window)
+
+        # Protects next height to fetch, target and generation
+        self._cond = threading.Condition()
+
+        # Next height the prefetch thread will fetch (None until first get)
+        self._next = None
+
+        # Last height available for fetching
+        self._target = -1
+
+        # Next height expected by get
+        self._expected = None
+
+        # Incremented each time the prefetch thread is moved to another
+        # height, to discard blocks fetched before that.
+        self._generation = 0
+
+        # Flag used to notify prefetch thread to stop
+        self._close_flag = threading.Event()
+
+        self._thread = threading.Thread(
+            target=BlockPrefetcher._prefetch_func,
+            args=(self,),
+            daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _prefetch_func(prefetcher):
+        """Function used by the prefetch thread"""
+        while True:
+            with prefetcher._cond:
+                while not prefetcher._close_flag.is_set() and \
+                        (prefetcher._next is None or prefetcher._next > prefetcher._target):
+                    prefetcher._cond.wait()
+
+                if prefetcher._close_flag.is_set():
+                    break
+
+                # Claim up to a window of heights, their hashes are
+                # requested with a single batch call.
+                start, generation = prefetcher._next, prefetcher._generation
+                heights = range(start, min(prefetcher._target, start+prefetcher._window-1)+1)
+                prefetcher._next = heights[-1]+1
+
+            try:
+                blockhashes = get_block_hashes(prefetcher._proxy, heights)
+            except Exception as err:
+                # Raised by get in the main thread, for any of the heights
+                blockhashes = [err]*len(heights)
+
+            for height, blockhash in zip(heights, blockhashes):
+                # Stop once moved to another height
+                if generation != prefetcher._generation:
+                    break
+
+                if isinstance(blockhash, Exception):
+                    block = blockhash
+                else:
+                    try:
+                        block = prefetcher._fetch_func(prefetcher._proxy, blockhash)
+                    except Exception as err:
+                        # Raised by get in the main thread
+                        block = err
+
+                # Wait until there is space in the look-ahead window
+                while not prefetcher._close_flag.is_set():
+                    try:
+                        prefetcher._blocks.put((generation, height, block), timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+
+                if prefetcher._close_flag.is_set():
+                    break
+
+    def set_target(self, height):
+        """Set last block height that can be fetched"""
+        with self._cond:
+            self._target = height
+            self._cond.notify()
+
+    def _reset(self, height):
+        """Restart fetching from height, discarding the blocks already fetched"""
+        with self._cond:
+            self._generation += 1
+            self._next = height
+            self._expected = height
+            self._cond.notify()
+
+        while True:
+            try:
+                self._blocks.get_nowait()
+            except queue.Empty:
+                break
+
+    def get(self, height):
+        """Return the block at height, waiting until it's fetched. It must
+        not be greater than the target.
+
+        Raises:
+            Exception: Any error raised while fetching the block
+        """
+        assert height <= self._target
+
+        if height != self._expected:
+            self._reset(height)
+
+        while True:
+            generation, fetched_height, block = self._blocks.get()
+            if generation == self._generation and fetched_height == height:
+                break
+
+        self._expected = height+1
+        if isinstance(block, Exception):
+            raise block
+
+        return block
+
+    def close(self, timeout=None):
+        self._close_flag.set()
+        with self._cond:
+            self._cond.notify()
+        self._thread.join(timeout)
@@ -0,0 +1,168 @@
+"""
+registry
+
+Monitored addresses interned as small integer ids, shared by the
+subscriptions and the transaction monitor.
+"""
+from array import array
+
+from bitcoin.core.script import CScript
+from bitcoin.wallet import CBitcoinAddress
+
+from .scanner import address_script, p2pkh_script
+
+
+class AddressRegistry(object):
+    """Reference counted addresses by id. Addresses are stored as their
+    scriptPubKey (the 20 or 32 byte hash plus the template opcodes), so
+    transaction outputs are matched with a single lookup, and the address
+    string is only encoded for the matches. Addresses not valid for the
+    selected chain, that can't be paid to, are stored as strings.
+
+    It can be used in place of the {script: addr} dict of monitored scripts.
+    """
+
+    def __init__(self):
+        # Address id by key {script|addr: id}
+        self._ids = {}
+
+        # Key by address id, None for released ids
+        self._keys = []
+
+        # Number of references by address id
+        self._refs = array('I')
+
+        # Released ids available for reuse
+        self._free = []
+
+    @staticmethod
+    def address_key(addr):
+        """
+        Arguments:
+            addr (str): Bitcoin address
+
+        Returns:
+            bytes|str: scriptPubKey or the address itself if it isn't valid
+        """
+        script = address_script(addr)
+        return script if script is not None else addr
+
+    @staticmethod
+    def key_address(key):
+        """Inverse of address_key"""
+        if isinstance(key, str):
+            return key
+        return str(CBitcoinAddress.from_scriptPubKey(CScript(key)))
+
+    def acquire_key(self, key):
+        """Add a reference to an address key, allocating an id if needed
+
+        Arguments:
+            key (bytes|str): Key returned by address_key
+
+        Returns:
+            int: Address id
+        """
+        addr_id = self._ids.get(key, None)
+        if addr_id is None:
+            if self._free:
+                addr_id = self._free.pop()
+                self._keys[addr_id] = key
+            else:
+                addr_id = len(self._keys)
+                self._keys.append(key)
+                self._refs.append(0)
+            self._ids[key] = addr_id
+
+        self._refs[addr_id] += 1
+        return addr_id
+
+    def acquire(self, addr):
+        """Add a reference to an address
+
+        Arguments:
+            addr (str): Bitcoin address
+
+        Returns:
+            int: Address id
+        """
+        return self.acquire_key(self.address_key(addr))
+
+    def release(self, addr_id):
+        """Remove a reference to an address
+
+        Arguments:
+            addr_id (int):
+
+        Returns:
+            bytes|str|None: The address key if it was the last reference
+                and the address was removed, None otherwise.
+        """
+        self._refs[addr_id] -= 1
+        if self._refs[addr_id]:
+            return None
+
+        key = self._keys[addr_id]
+        del self._ids[key]
+        self._keys[addr_id] = None
+        self._free.append(addr_id)
+        return key
+
+    def id(self, addr):
+        """
+        Returns:
+            int|None: Address id or None if it isn't registered
+        """
+        return self._ids.get(self.address_key(addr), None)
+
+    def key(self, addr_id):
+        return self._keys[addr_id]
+
+    def address(self, addr_id):
+        return self.key_address(self._keys[addr_id])
+
+    def addresses(self):
+        """Generate all registered addresses"""
+        for key in self._ids:
+            yield self.key_address(key)
+
+    def _script_key(self, script):
+        """Registered key matching a scriptPubKey, P2PK scripts match the
+        P2PKH address for the same key.
+
+        Returns:
+            bytes|None: None if not registered
+        """
+        if script in self._ids:
+            return script
+
+        script = p2pkh_script(script)
+        if script is not None and script in self._ids:
+            return script
+        return None
+
+    def get(self, script, default=None):
+        """Registered address paying to a scriptPubKey
+
+        Arguments:
+            script (bytes): scriptPubKey
+
+        Returns:
+            str: Address or default if not registered
+        """
+        key = self._script_key(script)
+        if key is None:
+            return default
+        return self.key_address(key)
+
+    def __getitem__(self, script):
+        addr = self.get(script, None)
+        if addr is None:
+            raise KeyError(script)
+        return addr
+
+    def __contains__(self, script):
+        return self._script_key(script) is not None
+
+    def __len__(self):
+        return len(self._ids)
@@ -0,0 +1,120 @@
+"""
+rescan.py
+
+Historical block range scan split across a pool of worker processes
+"""
+import multiprocessing
+
+from .monitor import TransactionMonitor
+from .rpc import BatchProxy, DEFAULT_BATCH_SIZE
+
+# Default number of worker processes
+DEFAULT_RESCAN_WORKERS = 4
+
+# Default number of consecutive blocks scanned by each worker task
+DEFAULT_RESCAN_CHUNK_SIZE = 10
+
+
+# Worker process settings and transaction monitor, initialized by _init_worker
+_worker_settings = None
+_worker_monitor = None
+
+def _init_worker(service_url, batch_size, addresses, block_prevouts):
+    """Worker process initialization, it must not fail or the pool would
+    keep replacing the worker, the connection is made by the first task."""
+    global _worker_settings, _worker_monitor
+    _worker_settings = (service_url, batch_size, addresses, block_prevouts)
+    _worker_monitor = None
+
+def _get_worker_monitor():
+    """Worker transaction monitor, each worker has its own bitcoind
+    connection and TxOutCache"""
+    global _worker_monitor
+    if _worker_monitor is not None:
+        return _worker_monitor
+
+    service_url, batch_size, addresses, block_prevouts = _worker_settings
+    proxy = BatchProxy(service_url=service_url, batch_size=batch_size)
+
+    # Inputs spending outputs from blocks scanned by other workers can't
+    # be found in the worker outpoint index, so TxOutCache is required.
+    monitor = TransactionMonitor(proxy, start_block=0, txout_cache=True)
+    if block_prevouts:
+        monitor.detect_block_prevouts()
+
+    monitor.add_addrs(addresses)
+
+    _worker_monitor = monitor
+    return monitor
+
+def _rescan_chunk(heights):
+    """Worker task
+
+    Arguments:
+        heights (tuple): (first, last) block heights
+
+    Returns:
+        tuple: (first, last, [Transaction, ...])
+    """
+    first, last = heights
+    return first, last, _get_worker_monitor().get_block_range(first, last)
+
+
+
+class ParallelRescan(object):
+    """Scan a block range for transactions involving a set of addresses.
+    The range is split into chunks processed by a pool of worker processes,
+    and the results are returned in block order as they become available."""
+
+    def __init__(self, service_url, addresses, first, last,
+                 workers=DEFAULT_RESCAN_WORKERS, chunk_size=DEFAULT_RESCAN_CHUNK_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, block_prevouts=False):
+        """
+        Arguments:
+            service_url (str): bitcoind JSON-RPC service url
+            addresses (iterable): Bitcoin addresses to look for
+            first (int): First block height
+            last (int): Last block height (included)
+            workers (int): Number of worker processes
+            chunk_size (int): Number of blocks for each worker task
+            batch_size (int): Max number of calls for each batch request
+            block_prevouts (bool): Use getblock prevouts when bitcoind
+                supports them.
+        """
+        assert workers > 0 and chunk_size > 0
+        assert 0 <= first <= last
+
+        self._pool = multiprocessing.Pool(
+            workers,
+            initializer=_init_worker,
+            initargs=(service_url, batch_size, list(addresses), block_prevouts))
+
+        chunks = [(start, min(start+chunk_size-1, last))
+                  for start in range(first, last+1, chunk_size)]
+
+        # Results are generated in the same order as the chunks
+        self._results = self._pool.imap(_rescan_chunk, chunks)
+
+    def get(self, timeout=0):
+        """Get the next scanned chunk in block order
+
+        Arguments:
+            timeout (float): Max seconds waiting for the chunk
+
+        Returns:
+            tuple|None: (first, last, [Transaction, ...]) or None if it
+                isn't ready yet.
+
+        Raises:
+            StopIteration: All the chunks were already returned
+            Exception: Any error raised by the worker processing the chunk
+        """
+        try:
+            return self._results.next(timeout)
+        except multiprocessing.TimeoutError:
+            return None
+
+    def close(self):
+        """Stop all workers, pending chunks are discarded"""
+        self._pool.terminate()
+        self._pool.join()
@@ -0,0 +1,270 @@
+"""
+rpc.py
+
+bitcoind JSON-RPC proxy with support for batch requests
+"""
+import queue
+import bitcoin.rpc
+from bitcoin.core import CTransaction, b2lx, lx
+from bitcoin.rpc import JSONRPCError, unhexlify_str
+
+from ..thread_pool import ThreadPool
+
+# Max number of calls sent in a single batch request
+DEFAULT_BATCH_SIZE = 500
+
+# Default number of connections used to request transactions concurrently
+DEFAULT_RPC_CONNECTIONS = 4
+
+# bitcoind error code for unknown transactions/blocks
+RPC_INVALID_ADDRESS_OR_KEY = -5
+
+
+def get_block_hashes(proxy, heights):
+    """Get hashes for several blocks, using a single batch call when
+    the proxy supports it.
+
+    Arguments:
+        proxy: bitcoin.rpc proxy object
+        heights (range): block numbers
+
+    Returns:
+        list: [blockhash, blockhash, ...]
+    """
+    if len(heights) > 1 and hasattr(proxy, 'getblockhashes'):
+        return proxy.getblockhashes(list(heights))
+    return [proxy.getblockhash(height) for height in heights]
+
+
+class BatchProxy(bitcoin.rpc.Proxy):
+    """bitcoin.rpc.Proxy extended with JSON-RPC batch requests, several
+    calls are sent in a single HTTP request and their results matched back
+    by id"""
+
+    def __init__(self, service_url=None, batch_size=DEFAULT_BATCH_SIZE, **kwargs):
+        """
+        Arguments:
+            service_url (str): bitcoind JSON-RPC service url
+            batch_size (int): Max number of calls for each HTTP request
+        """
+        assert batch_size > 0
+        super(BatchProxy, self).__init__(service_url=service_url, **kwargs)
+        self._batch_size = batch_size
+        self._batch_id = 0
+
+    def _batch_chunk(self, calls):
+        """Send a single batch request
+
+        Arguments:
+            calls (list): [(method, params), ...]
+
+        Returns:
+            list: [response, response, ...] in the same order as calls
+        """
+        first_id = self._batch_id
+        self._batch_id += len(calls)
+
+        request = [{'version': '1.1', 'method': method, 'params': params,
+                    'id': first_id+n} for n, (method, params) in enumerate(calls)]
+
+        responses = self._batch(request)
+        if not isinstance(responses, list):
+            # The whole batch failed (auth, malformed request, ...)
+            err = responses.get('error') or {}
+            raise JSONRPCError({
+                'code': err.get('code', -344),
+                'message': err.get('message', 'batch request failed')})
+
+        ordered = [None]*len(calls)
+        for response in responses:
+            ordered[response['id']-first_id] = response
+
+        return ordered
+
+    def batch(self, calls, ignore_codes=()):
+        """Send several calls as JSON-RPC batch requests of at most
+        batch_size calls each.
+
+        Arguments:
+            calls (list): [(method, params), ...] where params is a list
+                of JSON encodable arguments.
+            ignore_codes (tuple): Error codes returned as a None result
+                instead of raising an exception.
+
+        Returns:
+            list: [result, result, ...] in the same order as calls
+
+        Raises:
+            JSONRPCError: If any of the calls failed
+        """
+        results = []
+        for start in range(0, len(calls), self._batch_size):
+            chunk = calls[start:start+self._batch_size]
+            for response in self._batch_chunk(chunk):
+                if response is None:
+                    raise JSONRPCError({
+                        'code': -343, 'message': 'missing JSON-RPC result'})
+                err = response.get('error')
+                if err is not None and err.get('code') in ignore_codes:
+                    results.append(None)
+                    continue
+                if err is not None:
+                    raise JSONRPCError(
+                        {'code': err.get('code', -345),
+                         'message': err.get('message', 'error message not specified')})
+                results.append(response['result'])
+
+        return results
+
+    def getblockhashes(self, heights):
+        """Batch equivalent of getblockhash
+
+        Arguments:
+            heights (list): Block heights
+
+        Returns:
+            list: block hashes (bytes) in the same order as heights
+        """
+        calls = [('getblockhash', [height]) for height in heights]
+        try:
+            return [lx(h) for h in self.batch(calls)]
+        except JSONRPCError as ex:
+            raise IndexError('{}.getblockhashes(): {}'.format(
+                self.__class__.__name__, ex.error['message']))
+
+    def getrawtransactions(self, txids, ignore_missing=False):
+        """Batch equivalent of getrawtransaction
+
+        Arguments:
+            txids (iterable): Transaction hashes (bytes)
+            ignore_missing (bool): Leave out transactions not found instead
+                of failing, i.e. mempool transactions already evicted.
+
+        Returns:
+            dict: {txid: bitcoin.core.CTransaction, ...}
+
+        Raises:
+            IndexError: If any of the transactions wasn't found
+        """
+        txids = list(txids)
+        calls = [('getrawtransaction', [b2lx(txid), 0]) for txid in txids]
+        ignore_codes = (RPC_INVALID_ADDRESS_OR_KEY,) if ignore_missing else ()
+        try:
+            results = self.batch(calls, ignore_codes)
+        except JSONRPCError as ex:
+            if ex.error['code'] != RPC_INVALID_ADDRESS_OR_KEY:
+                raise
+            raise IndexError('{}.getrawtransactions(): {}'.format(
+                self.__class__.__name__, ex.error['message']))
+
+        return {txid: CTransaction.deserialize(unhexlify_str(raw))
+                for txid, raw in zip(txids, results) if raw is not None}
+
+
+
+class ProxyPool(object):
+    """Bounded pool of bitcoind connections, used to request several
+    transactions concurrently. The requested transactions are split evenly
+    between the connections, and each one is used by a single thread at
+    a time. It has the same getrawtransaction(s) interface as BatchProxy."""
+
+    def __init__(self, proxy_factory, size=DEFAULT_RPC_CONNECTIONS):
+        """
+        Arguments:
+            proxy_factory (function): Returns a new bitcoin.rpc.Proxy or
+                BatchProxy connection
+            size (int): Number of connections and threads
+        """
+        assert size > 0
+        self._size = size
+
+        # Idle connections
+        self._proxies = queue.Queue()
+        for _ in range(size):
+            self._proxies.put(proxy_factory())
+
+        self._thread_pool = ThreadPool(size, ProxyPool._request_func,
+                                       args=(self._proxies,))
+
+    @staticmethod
+    def _request_func(job, proxies):
+        """Thread pool worker function
+
+        Arguments:
+            job (tuple): (txids, ignore_missing, result queue)
+            proxies (queue.Queue): Idle connections
+        """
+        txids, ignore_missing, result_q = job
+        proxy = proxies.get()
+        try:
+            result = ProxyPool._getrawtransactions(proxy, txids, ignore_missing)
+        except Exception as err:
+            # Raised by the thread waiting for the results
+            result = err
+        finally:
+            proxies.put(proxy)
+
+        result_q.put(result)
+
+    @staticmethod
+    def _getrawtransactions(proxy, txids, ignore_missing):
+        """Request transactions with batch calls when the proxy supports them"""
+        if hasattr(proxy, 'getrawtransactions'):
+            return proxy.getrawtransactions(txids, ignore_missing=ignore_missing)
+
+        txs = {}
+        for txid in txids:
+            try:
+                txs[txid] = proxy.getrawtransaction(txid)
+            except IndexError:
+                if not ignore_missing:
+                    raise
+        return txs
+
+    def getrawtransaction(self, txid):
+        proxy = self._proxies.get()
+        try:
+            return proxy.getrawtransaction(txid)
+        finally:
+            self._proxies.put(proxy)
+
+    def getrawtransactions(self, txids, ignore_missing=False):
+        """Request transactions concurrently using all the connections
+
+        Arguments:
+            txids (iterable): Transaction hashes (bytes)
+            ignore_missing (bool): Leave out transactions not found
+
+        Returns:
+            dict: {txid: bitcoin.core.CTransaction, ...}
+
+        Raises:
+            IndexError: If any of the transactions wasn't found
+        """
+        txids = list(txids)
+        if not txids:
+            return {}
+
+        chunk_size = -(-len(txids)//self._size)
+        result_q = queue.Queue()
+        chunks = 0
+        for start in range(0, len(txids), chunk_size):
+            self._thread_pool.add_job((txids[start:start+chunk_size],
+                                       ignore_missing, result_q))
+            chunks += 1
+
+        txs, error = {}, None
+        for _ in range(chunks):
+            result = result_q.get()
+            if isinstance(result, Exception):
+                error = result
+            else:
+                txs.update(result)
+
+        if error is not None:
+            raise error
+
+        return txs
+
+    def close(self):
+        self._thread_pool.close()
@@ -0,0 +1,114 @@
+from struct import unpack_from
+
+from bitcoin.core import Hash160
+from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
+
+# Serialized block header length
+BLOCK_HEADER_SIZE = 80
+
+
+
+def address_script(addr):
+    """scriptPubKey bytes paying to an address
+
+    Arguments:
+        addr (str): Bitcoin address
+
+    Returns:
+        bytes|None: Script or None if the address isn't valid for the
+            selected chain
+    """
+    try:
+        return bytes(CBitcoinAddress(addr).to_scriptPubKey())
+    except (CBitcoinAddressError, ValueError):
+        return None
+
+def p2pkh_script(script):
+    """P2PKH scriptPubKey for the key of a P2PK (bare checksig) script, they
+    are credited to the P2PKH address as CBitcoinAddress.from_scriptPubKey
+    does.
+
+    Arguments:
+        script (bytes): scriptPubKey
+
+    Returns:
+        bytes|None: P2PKH script or None if it isn't a P2PK script
+    """
+    # Push of a 33 (compressed) or 65 byte public key followed by OP_CHECKSIG
+    size = len(script)
+    if (size == 35 or size == 67) and script[0] == size-2 and script[-1] == 0xac:
+        return b'\x76\xa9\x14'+Hash160(bytes(script[1:-1]))+b'\x88\xac'
+    return None
+
+def _read_varint(raw, pos):
+    """Read bitcoin variable length integer
+
+    Returns:
+        tuple: (value, position after the integer)
+    """
+    n = raw[pos]
+    if n < 0xfd:
+        return n, pos+1
+    elif n == 0xfd:
+        return unpack_from('<H', raw, pos+1)[0], pos+3
+    elif n == 0xfe:
+        return unpack_from('<I', raw, pos+1)[0], pos+5
+    else:
+        return unpack_from('<Q', raw, pos+1)[0], pos+9
+
+def scan_block(raw, scripts, outpoints=()):
+    """Walk a serialized block looking for transactions with an output paying
+    to one of the scripts, or spending one of the outpoints, without
+    deserializing them.
+
+    Transactions are generated lazily, so the outpoints container can be
+    updated with the outputs of each transaction before the next one is
+    scanned.
+
+    Arguments:
+        raw (bytes): Serialized block
+        scripts (set|dict): Monitored scriptPubKeys (bytes)
+        outpoints (container): Monitored (txid, n) outputs
+
+    Returns:
+        generator: (start, end) positions of each matching transaction
+    """
+    pos = BLOCK_HEADER_SIZE
+    ntx, pos = _read_varint(raw, pos)
+
+    for _ in range(ntx):
+        start = pos
+        match = False
+
+        # Version and segwit marker and flag (bip-0144)
+        pos += 4
+        segwit = raw[pos] == 0 and raw[pos+1] == 1
+        if segwit:
+            pos += 2
+
+        nin, pos = _read_varint(raw, pos)
+        for _ in range(nin):
+            if not match and outpoints:
+                outpoint = (raw[pos:pos+32], unpack_from('<I', raw, pos+32)[0])
+                match = outpoint in outpoints
+            script_len, pos = _read_varint(raw, pos+36)
+            pos += script_len+4 # scriptSig and sequence
+
+        nout, pos = _read_varint(raw, pos)
+        for _ in range(nout):
+            script_len, pos = _read_varint(raw, pos+8)
+            if not match:
+                match = raw[pos:pos+script_len] in scripts
+            pos += script_len
+
+        if segwit:
+            for _ in range(nin):
+                nitems, pos = _read_varint(raw, pos)
+                for _ in range(nitems):
+                    item_len, pos = _read_varint(raw, pos)
+                    pos += item_len
+
+        pos += 4 # nLockTime
+
+        if match:
+            yield start, pos
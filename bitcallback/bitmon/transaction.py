@@ -8,33 +8,62 @@ class Transaction(object):
 
     __slots__ = ('hash', 'tout', 'tin')
 
-    def __init__(self, tx, txout_cache):
+    def __init__(self, tx, txout_cache=None, outpoint_index=None, prevouts=None,
+                 scripts=None):
         """
         Arguments:
             tran (bitcoin.core.CTransaction): Transaction to construct
-            txout_cache (TxOutCache):
+            txout_cache (TxOutCache|None): Used to resolve inputs not found
+                in the outpoint index, None to ignore them.
+            outpoint_index (OutpointIndex|None): Outputs for monitored
+                addresses, the ones spent by the transaction are removed.
+            prevouts (list|None): Outputs spent by each input [(addr, value), ...]
+                when they are already known, txout_cache isn't used.
+            scripts (dict|None): Monitored addresses by scriptPubKey, when
+                provided only outputs paying to them are included in tout,
+                and only inputs resolved by txout_cache spending them in tin.
         """ 
         # GetTxid instead of GetHash for segwit support (bip-0141)
         self.hash = b2lx(tx.GetTxid())
 
-        self.tout = self._process_outputs(tx)
-        self.tin = self._process_inputs(tx, txout_cache)
+        self.tout = self._process_outputs(tx, scripts)
+        self.tin = self._process_inputs(tx, txout_cache, outpoint_index, prevouts, scripts)
 
-    def _process_inputs(self, tx, cache):
+    def _process_inputs(self, tx, cache, index, prevouts, scripts=None):
         inputs = {}
         
         if tx.is_coinbase():
             return inputs
+
+        if prevouts is None:
+            prevouts = [None]*len(tx.vin)
     
-        for tin in tx.vin:
-            addr, value = cache.txout(tin.prevout.hash, tin.prevout.n)
+        for tin, txout in zip(tx.vin, prevouts):
+            # Indexed outputs have to be removed even if they are already known
+            if index is not None:
+                txout = index.spend(tin.prevout.hash, tin.prevout.n) or txout
+            if txout is None and cache is not None:
+                txout = cache.txout(tin.prevout.hash, tin.prevout.n, scripts=scripts)
+            if txout is None:
+                continue
+
+            addr, value = txout
             if value is not None:
                 inputs[addr] = inputs.get(addr, 0)+value
 
         return inputs
 
-    def _process_outputs(self, tx):
+    def _process_outputs(self, tx, scripts):
         outputs = {}
+
+        # Match script bytes, there is no need to encode the address
+        # of outputs that aren't monitored.
+        if scripts is not None:
+            for txout in tx.vout:
+                addr = scripts.get(txout.scriptPubKey)
+                if addr is not None:
+                    outputs[addr] = outputs.get(addr, 0)+txout.nValue
+            return outputs
         
         for txout in tx.vout:
             try:
@@ -1,11 +1,21 @@
 from multiprocessing import Process, Queue
-from collections import defaultdict
+from collections import defaultdict, deque
 import datetime
 import time
 import logging
-import heapq
+import os
 import pickle
 from .bitmon import TransactionMonitor
+from .bitmon.index import OutpointIndex
+from .bitmon.registry import AddressRegistry
+from .bitmon.cache import DEFAULT_CACHE_BYTES
+from .bitmon.diskcache import DiskTxOutCache, DEFAULT_DISK_CACHE_BYTES
+from .bitmon.mempool import MempoolTracker, DEFAULT_DECODED_SIZE
+from .bitmon.rpc import BatchProxy, ProxyPool, DEFAULT_BATCH_SIZE, DEFAULT_RPC_CONNECTIONS
+from .bitmon.prefetch import DEFAULT_PREFETCH_WINDOW
+from .bitmon.notify import BlockNotifier
+from .bitmon.rescan import ParallelRescan, DEFAULT_RESCAN_WORKERS, DEFAULT_RESCAN_CHUNK_SIZE
+from bitcoin.core import b2lx, lx
 import bitcoin
 import queue
 import json
@@ -13,14 +23,44 @@ import sqlalchemy
 
 
 from bitcallback.common import unique_id
-from bitcallback.models import Block, Callback, Subscription, SubscriptionState
-from bitcallback.commands import (EXIT_TASK, NEW_SUBSCRIPTION, CANCEL_SUBSCRIPTION,
-                                  NEW_CALLBACK, SubscriptionData, CallbackData)
+from bitcallback.expiration import ExpirationSchedule
+from bitcallback.subscription_table import SubscriptionTable, NO_ROW, to_micros, from_micros
+from bitcallback.snapshot import Snapshot, write_snapshot, DEFAULT_SNAPSHOT_INTERVAL
+from bitcallback.models import Block, Callback, Outpoint, Subscription, SubscriptionState
+from bitcallback.commands import (EXIT_TASK, NEW_SUBSCRIPTION, NEW_SUBSCRIPTIONS,
+                                  CANCEL_SUBSCRIPTION, NEW_BLOCK, NEW_CALLBACK, RESCAN,
+                                  SubscriptionData, CallbackData, RescanData)
 from bitcallback.database import make_session_scope, configure_db
 
 #
 BITCOIN_UPDATE_PERIOD = 5 # second between updates
 
+# Seconds between updates when block notifications are enabled, polling is
+# only a fallback for lost notifications.
+NOTIFY_UPDATE_PERIOD = 60
+
+# Default max number of blocks processed on each update while catching up
+MAX_BLOCKS_PER_POLL = 100
+
+# Seconds between mempool polls when mempool monitoring is enabled
+MEMPOOL_UPDATE_PERIOD = 5
+
+# Max number of subscriptions marked as expired with a single query
+EXPIRE_BATCH_SIZE = 500
+
+# Number of subscriptions fetched from the database at a time on reload
+RELOAD_BATCH_SIZE = 10000
+
+# Subscription expiration resolution in seconds, the ones expiring within
+# the same tick are expired together.
+EXPIRATION_TICK = 60
+
+# Max number of queued commands processed at once
+COMMAND_BATCH_SIZE = 10000
+
+# Seconds between checks for rescanned blocks while a rescan is running
+RESCAN_POLL_PERIOD = 1
+
 
 
 logger = logging.getLogger("Bitcoin")
@@ -39,37 +79,135 @@ class SubscriptionManager(object):
             db_session (scoped_session):
             db_reload (bool): Reload subscriptions from database
         """
+        # Subscribed addresses, shared with the transaction monitor so
+        # they are only stored once.
+        self._registry = AddressRegistry()
 
-        # Subscriptions by address
-        self._subs_by_addr = defaultdict(set)
+        # Subscriptions by id and address
+        self._subscriptions = SubscriptionTable(self._registry)
 
-        #
-        self._subs_by_id = dict()
+        # Subscription table rows scheduled by expiration date
+        self._expiration_table = ExpirationSchedule(EXPIRATION_TICK)
 
         #
         self.set_transaction_monitor(monitor)
 
         self._db_session = db_session
 
-        # Subscription list sorted by expiration date
-        self._expiration_table = []
-        heapq.heapify(self._expiration_table)
-
         # Load stil active subscriptions from db
-        if not db_reload:
-            return
+        if db_reload:
+            self._load_subscriptions()
+
+    def _load_subscriptions(self):
+        """Load all active subscriptions from the database, streaming them
+        in batches, and build the indexes in bulk."""
+        start = time.time()
+
+        # Expired subscriptions will be discarded the first time poll_bitcoin
+        # is called
+        self._load_active_subscriptions()
+
+        logger.info("Loaded {} subscriptions for {} addresses in {:.2f} seconds".format(
+            len(self._subscriptions), len(self._registry), time.time()-start))
+
+    def _load_active_subscriptions(self, after_id=None):
+        """Stream active subscriptions from the database into the indexes
 
+        Arguments:
+            after_id (int|None): Only load subscriptions with a greater id
+        """
+        # Only the needed columns are queried, so no model instances or
+        # joined callbacks are created.
         with make_session_scope(self._db_session) as session:
-            active_subs = session.query(Subscription).filter_by(
-                    state=SubscriptionState.active).all()
-        
-        for sub in active_subs:
-            # Expired subscriptions will be discarded the first time poll_bitcoin
-            # is called
-            logger.debug("Loaded Subscription: {}".format(sub))
-            sub_data = SubscriptionData(sub.id, sub.address, 
-                                        sub.callback_url, sub.expiration)
-            self.add_subscription(sub_data)   
+            query = session.query(Subscription.id, Subscription.address,
+                                  Subscription.callback_url, Subscription.expiration).\
+                    filter_by(state=SubscriptionState.active)
+            if after_id is not None:
+                query = query.filter(Subscription.id > after_id)
+
+            self.add_subscriptions(SubscriptionData(*row)
+                                   for row in query.yield_per(RELOAD_BATCH_SIZE))
+
+    def load_snapshot(self, records):
+        """Load subscriptions from a snapshot, plus the ones created after it
+        was written. If the result doesn't match the active subscriptions in
+        the database, the snapshot is discarded and they are reloaded from
+        the database instead. It must be called before the transaction
+        monitor is set.
+
+        Arguments:
+            records (iterable): Snapshot subscription records, as returned
+                by SubscriptionTable.records()
+
+        Returns:
+            bool: True if the snapshot was loaded
+        """
+        start = time.time()
+        try:
+            self._add_records(records)
+        except ValueError as err:
+            logger.error("Invalid snapshot: {}".format(err))
+            self._reset()
+            self._load_subscriptions()
+            return False
+
+        self._load_active_subscriptions(self._subscriptions.max_id())
+
+        with make_session_scope(self._db_session) as session:
+            active = session.query(sqlalchemy.func.count(Subscription.id)).\
+                    filter_by(state=SubscriptionState.active).scalar()
+
+        if active != len(self._subscriptions):
+            logger.info("Snapshot doesn't match database ({} active subscriptions, "
+                        "{} loaded)".format(active, len(self._subscriptions)))
+            self._reset()
+            self._load_subscriptions()
+            return False
+
+        logger.info("Loaded {} subscriptions from snapshot in {:.2f} seconds".format(
+            len(self._subscriptions), time.time()-start))
+        return True
+
+    def _add_records(self, records):
+        """Add subscriptions from raw records, the addresses aren't decoded
+
+        Arguments:
+            records (iterable): [(id, address key, callback_url, expiration
+                microseconds), ...]
+        """
+        def index(records):
+            for record in records:
+                yield self._add_record(*record), from_micros(record[3])
+
+        self._expiration_table.schedule_many(index(records))
+
+    def _add_record(self, sub_id, key, callback_url, expiration):
+        """Add subscription to the table, replacing any with the same id.
+        It isn't added to the expiration table.
+
+        Returns:
+            int: Subscription table row
+        """
+        if sub_id in self._subscriptions:
+            self.cancel_subscription(sub_id)
+
+        addr_id = self._registry.acquire_key(key)
+        return self._subscriptions.add(sub_id, addr_id, callback_url, expiration)
+
+    def _reset(self):
+        """Discard all subscriptions, before the transaction monitor is set"""
+        self._registry = AddressRegistry()
+        self._subscriptions = SubscriptionTable(self._registry)
+        self._expiration_table = ExpirationSchedule(EXPIRATION_TICK)
+
+    def subscription_records(self):
+        """Raw records for all the active subscriptions, in the format
+        expected by load_snapshot.
+
+        Returns:
+            generator: (id, address key, callback_url, expiration microseconds)
+        """
+        return self._subscriptions.records()
 
     @property
     def current_block(self):
@@ -86,8 +224,7 @@ class SubscriptionManager(object):
         
         # When connection is lost it can be None until a reconnect
         if monitor is not None:
-            for addr in self._subs_by_addr.keys():
-                monitor.add_addr(addr)
+            monitor.set_registry(self._registry)
 
     def add_subscription(self, subscription=SubscriptionData):
         """
@@ -95,99 +232,151 @@ class SubscriptionManager(object):
             subscription (SubscriptionData):
         """
         assert isinstance(subscription, SubscriptionData)
+        row = self._add_record(subscription.id, AddressRegistry.address_key(subscription.address),
+                               subscription.callback_url, to_micros(subscription.expiration))
 
-        if self._monitor is not None and subscription.address not in self._subs_by_addr:
-            self._monitor.add_addr(subscription.address)
-
-        self._subs_by_addr[subscription.address].add(subscription)
-        self._subs_by_id[subscription.id] = subscription
-        
         # Add subscription to expiration table sorted by expiration datetime
-        heapq.heappush(self._expiration_table,
-                       (subscription.expiration, subscription.id))
+        self._expiration_table.schedule(row, subscription.expiration)
+
+    def add_subscriptions(self, subscriptions):
+        """Add several subscriptions, the expiration table is updated in bulk
+
+        Arguments:
+            subscriptions (iterable): SubscriptionData
+        """
+        self._add_records((sub.id, AddressRegistry.address_key(sub.address),
+                           sub.callback_url, to_micros(sub.expiration))
+                          for sub in subscriptions)
+
+    def _remove_subscription(self, subscription_id):
+        """Remove subscription from the table and the expiration table
+
+        Returns:
+            str|None: The subscription address if it was the only remaining
+                subscription for it, and it's no longer monitored.
+        """
+        row = self._subscriptions.row(subscription_id)
+        if row == NO_ROW:
+            logger.debug("Unable to cancel unknown subscription {}".format(subscription_id))
+            return None
+
+        # Unscheduled before the row is freed, and reused
+        self._expiration_table.cancel(row)
+
+        addr_id = self._subscriptions.address_id(subscription_id)
+        subscription = self._subscriptions.remove(subscription_id)
+
+        if self._registry.release(addr_id) is None:
+            return None
+        return subscription.address
 
     def cancel_subscription(self, subscription_id):
         """
         Arguments:
             subscription_id (int):
         """
-        try:
-            subscription = self._subs_by_id.pop(subscription_id)
-            self._subs_by_addr[subscription.address].remove(subscription)
-           
-            # if it's the only remainig subscription for the address
-            # stop monitoring
-            if not len(self._subs_by_addr[subscription.address]):
-                if self._monitor is not None:
-                    self._monitor.del_addr(subscription.address)
-                del self._subs_by_addr[subscription.address]
-
-        except KeyError:
-            logger.debug("Unable to cancel unknown subscription {}".format(subscription_id))
+        # if it's the only remainig subscription for the address, discard
+        # the outputs indexed for it.
+        addr = self._remove_subscription(subscription_id)
+        if addr is not None and self._monitor is not None:
+            self._monitor.discard_addr(addr)
 
-    def _remove_expired_subscriptions(self):
+    def cancel_subscriptions(self, subscription_ids):
+        """Cancel several subscriptions, the outputs indexed for the addresses
+        no longer monitored are discarded at once.
+
+        Arguments:
+            subscription_ids (iterable): Subscription ids (int)
         """
+        discarded = [self._remove_subscription(sub_id) for sub_id in subscription_ids]
+        if self._monitor is not None:
+            self._monitor.discard_addrs(addr for addr in discarded if addr is not None)
+
+    def next_expiration(self):
+        """
+        Returns:
+            datetime.datetime|None: When the next subscriptions expire (UTC),
+                None if there are no active subscriptions.
         """
-        expired = []
+        return self._expiration_table.next_expiration()
 
-        now = datetime.datetime.utcnow()
+    def _remove_expired_subscriptions(self):
+        """Stop monitoring expired subscriptions, and mark them as expired
+        in the database.
 
-        # Remove expired subscriptions
-        while self._expiration_table and self._expiration_table[0][0]<now:
-            expiration, sub_id = heapq.heappop(self._expiration_table)
+        Returns:
+            list: Expired subscription ids
+        """
+        # Cancelled subscriptions are removed from the table, so all
+        # the expired ones are still active.
+        rows = self._expiration_table.pop_expired(datetime.datetime.utcnow())
+        if not rows:
+            return []
 
-            # If the subscription isn't canceled store id
-            if sub_id in self._subs_by_id:
-                expired.append(sub_id)
-            
-            self.cancel_subscription(sub_id)
+        expired = [self._subscriptions.id(row) for row in rows]
 
-        if not expired:
-            return 
+        # Stop monitoring for all the subscription
+        self.cancel_subscriptions(expired)
 
-        # Change status to expired for all expired and still active subscriptions
+        # Change status to expired for all expired subscriptions, in as few
+        # queries as possible within a single transaction.
         with make_session_scope(self._db_session) as session:
-            session.query(Subscription).filter(Subscription.id.in_(expired)).\
-                    update({'state':SubscriptionState.expired}, synchronize_session=False)
-        
-        # Stop monitoring for all the subscription
-        for sub_id in expired:
-            self.cancel_subscription(sub_id)
+            for start in range(0, len(expired), EXPIRE_BATCH_SIZE):
+                batch = expired[start:start+EXPIRE_BATCH_SIZE]
+                session.query(Subscription).filter(Subscription.id.in_(batch)).\
+                        update({'state':SubscriptionState.expired}, synchronize_session=False)
 
-    def _transaction_to_callbacks(self, transaction):
+        logger.debug("Expired {} subscriptions".format(len(expired)))
+        return expired
+
+    def _transaction_to_callbacks(self, transaction, confirmed=True, subscriptions=None):
         """Split transaction into as many callbacks as needed to
         notify all the subscriptions
 
         Arguments:
             transaction (bitmon.Transaction)
+            confirmed (bool): False for transactions seen in the mempool
+            subscriptions (dict|None): {addr: set(SubscriptionData)} to
+                notify, None for all the active subscriptions.
         """
         thash = transaction.hash
-        subscriptions = self._subs_by_addr
+        if subscriptions is None:
+            address_subscriptions = self._address_subscriptions
+        else:
+            address_subscriptions = lambda addr: subscriptions.get(addr, ())
         callbacks = []
 
         # Generate callbacks required for each transaction. 
         for addr, amount in transaction.tout.items():
-            # Have to check because it's a defaultdict and will populate
-            # with empty sets otherwise
-            if addr not in subscriptions:
+            change = amount - transaction.tin.get(addr, 0)
+            if not change:
                 continue
 
-            for subs in subscriptions[addr]:
-                change = amount - transaction.tin.get(addr, 0)
-                if change:
-                    callback = CallbackData(unique_id(), subs, thash, amount)
-                    callbacks.append(callback)
+            for subs in address_subscriptions(addr):
+                callback = CallbackData(unique_id(), subs, thash, amount, confirmed)
+                callbacks.append(callback)
 
         for addr, amount in transaction.tin.items():
-            if addr not in subscriptions or addr in transaction.tout:
+            if addr in transaction.tout:
                 continue
 
-            for subs in subscriptions[addr]:
-                callback = CallbackData(unique_id(), subs, thash, -amount)
+            for subs in address_subscriptions(addr):
+                callback = CallbackData(unique_id(), subs, thash, -amount, confirmed)
                 callbacks.append(callback)
 
         return callbacks
 
+    def _address_subscriptions(self, addr):
+        """Active subscriptions for an address
+
+        Returns:
+            iterable: SubscriptionData
+        """
+        addr_id = self._registry.id(addr)
+        if addr_id is None:
+            return ()
+        return self._subscriptions.by_address(addr_id)
+
     def poll_bitcoin(self):
         """Poll bitcoin blockchain for transactions to or from one of
         the monitored addresses"""
@@ -195,27 +384,37 @@ class SubscriptionManager(object):
         self._remove_expired_subscriptions()
 
         logger.debug("BLOCK: {}".format(self._monitor.current_block))
-        #
-        transactions = self._monitor.get_confirmed()
 
+        # Transactions are converted as they are generated, so they don't
+        # have to be kept until all pending blocks are processed.
         callbacks = []
-        for tran in transactions:
+        for tran in self._monitor.iter_confirmed():
             callbacks.extend(self._transaction_to_callbacks(tran))
         return callbacks
 
+    def poll_mempool(self):
+        """Poll bitcoin mempool for new unconfirmed transactions to or from
+        one of the monitored addresses"""
+        transactions = self._monitor.get_unconfirmed()
+
+        callbacks = []
+        for tran in transactions:
+            callbacks.extend(self._transaction_to_callbacks(tran, confirmed=False))
+        return callbacks
+
     def close(self):
         return 
 
     def __contains__(self, key):
         """Return True if the id or address is being monitored"""
         if isinstance(key, int):
-            return key in self._subs_by_id
+            return key in self._subscriptions
         else:
-            return key in self._subs_by_addr
+            return self._registry.id(key) is not None
 
     def __len__(self):
         """Return number of active subscriptions"""
-        return len(self._subs_by_id)
+        return len(self._subscriptions)
 
 
 
@@ -240,6 +439,42 @@ class BitmonTask(object):
         """Initialize task after process is forked"""
         # Last time bitcoind was polled or reconnect tried
         self._last_update = time.perf_counter()
+
+        # Seconds between bitcoind polls (changes if block notifications are enabled)
+        self._update_period = BITCOIN_UPDATE_PERIOD
+
+        # Subscribed to new block notifications, initialized by _start_notifier
+        self._notifier = None
+
+        # Mempool snapshot, kept between reconnects so transactions
+        # aren't reported twice.
+        self._mempool = None
+        if self._settings.get('MEMPOOL', False):
+            self._mempool = MempoolTracker(self._settings.get('MEMPOOL_DECODED_SIZE',
+                                                              DEFAULT_DECODED_SIZE))
+
+        # Last time the mempool was polled
+        self._last_mempool_update = time.perf_counter()
+
+        # Rescans waiting to start (RescanData)
+        self._rescan_pending = deque()
+
+        # Current rescan (RescanData with the next block to scan), and
+        # its worker pool while running.
+        self._rescan_job = None
+        self._rescan = None
+
+        # Rescanned subscriptions by address
+        self._rescan_subs = None
+
+        # In memory state snapshot file (None if disabled), and last time
+        # it was written.
+        self._snapshot_path = self._settings.get('SNAPSHOT_FILE', None)
+        self._last_snapshot = time.perf_counter()
+
+        # TxOutCache entries restored from the snapshot, loaded into the
+        # cache once connected.
+        self._snapshot_txouts = None
  
         # We need to create a new DB session for the process, because the
         # one used by flask can be only be share between threads.
@@ -258,28 +493,106 @@ class BitmonTask(object):
                     # so there is no need to log the exception
                     pass
         
+        # Unspent outputs for monitored addresses, kept between reconnects
+        self._outpoint_index = OutpointIndex()
+        with make_session_scope(self._db_session) as session:
+            self._outpoint_index.load(
+                (lx(o.txid), o.n, o.address, o.value) for o in session.query(Outpoint))
+
+        # Resume interrupted rescan from the last checkpoint
+        self._rescan_job = self._load_rescan()
+
+        # Persistent transaction output cache, kept between reconnects
+        self._disk_cache = None
+        if self._settings.get('TXOUT_DISK_CACHE', None):
+            self._disk_cache = DiskTxOutCache(
+                self._settings['TXOUT_DISK_CACHE'],
+                self._settings.get('TXOUT_DISK_CACHE_BYTES', DEFAULT_DISK_CACHE_BYTES))
+
         # bitcoin lib chain selection
         bitcoin.SelectParams(self._settings['CHAIN'])
     
         # It will be initialized later by reconnect code
         self._monitor = None
  
+        # Restore state from the snapshot when it's up to date, instead of
+        # reloading subscriptions from the database.
+        snapshot = self._open_snapshot()
+        db_reload = settings['RELOAD_SUBSCRIPTIONS']
+
         # Transaction monitor is not provided so it is not initialized here
         # so it's treated later as if the connection was lost.
         self._subscription_manager = SubscriptionManager(
                                         self._monitor, # Init later
                                         self._db_session,
-                                        settings['RELOAD_SUBSCRIPTIONS'])
+                                        db_reload and snapshot is None)
+
+        if snapshot is not None:
+            if db_reload:
+                self._subscription_manager.load_snapshot(snapshot.subscriptions())
+            try:
+                self._snapshot_txouts = list(snapshot.txouts())
+            except ValueError as err:
+                logger.error("Invalid snapshot: {}".format(err))
+            snapshot.close()
+
+    def _open_snapshot(self):
+        """Open snapshot file if it was written at the last saved block
+
+        Returns:
+            Snapshot|None: None if disabled, missing or stale
+        """
+        path = self._snapshot_path
+        if not path or self._current_block < 0 or not os.path.exists(path):
+            return None
+
+        try:
+            snapshot = Snapshot(path)
+        except (OSError, ValueError) as err:
+            logger.error("Discarding snapshot {}: {}".format(path, err))
+            return None
+
+        if snapshot.block_number != self._current_block:
+            logger.info("Discarding stale snapshot (block {}, last block {})".format(
+                snapshot.block_number, self._current_block))
+            snapshot.close()
+            return None
+
+        return snapshot
+
+    def _write_snapshot(self):
+        """Write in memory state snapshot, if enabled"""
+        self._last_snapshot = time.perf_counter()
+        if not self._snapshot_path or self._current_block < 0:
+            return
+
+        cache = self._monitor.txout_cache if self._monitor is not None else None
+        if cache is not None:
+            txouts = cache.items()
+        else:
+            txouts = self._snapshot_txouts or ()
+
+        start = time.time()
+        try:
+            write_snapshot(self._snapshot_path, self._current_block,
+                           self._subscription_manager.subscription_records(), txouts)
+            logger.debug("Snapshot written in {:.2f} seconds".format(time.time()-start))
+        except OSError as err:
+            logger.error("Unable to write snapshot {}: {}".format(self._snapshot_path, err))
 
     def _save_block_number(self, block_number):
         """Save block number into db, create row if it doesn't exist, update
-        if it does.
+        if it does. Outpoint index changes are saved in the same transaction
+        so they are always consistent with the block number, and only
+        committed to the index once saved.
         
         Arguments:
             block_number (int): positive integer
         """
         assert isinstance(block_number, int) and block_number>=0
 
+        added, spent = self._outpoint_index.changes()
+
         with make_session_scope(self._db_session) as session:
             try:
                 block = session.query(Block).one()
@@ -289,6 +602,181 @@ class BitmonTask(object):
                 block = Block(block_number=block_number)
                 session.add(block)
 
+            for txid, n in spent:
+                session.query(Outpoint).filter_by(txid=b2lx(txid), n=n).\
+                        delete(synchronize_session=False)
+
+            session.bulk_insert_mappings(Outpoint, [
+                {'txid': b2lx(txid), 'n': n, 'address': addr, 'value': value}
+                for (txid, n), (addr, value) in added.items()])
+
+        self._outpoint_index.commit()
+
+    def _load_rescan(self):
+        """Load interrupted rescan checkpoint
+
+        Returns:
+            RescanData|None: None if there wasn't any rescan running
+        """
+        with make_session_scope(self._db_session) as session:
+            try:
+                block = session.query(Block).one()
+            except sqlalchemy.orm.exc.NoResultFound:
+                return None
+
+            if block.rescan_block is None:
+                return None
+
+            subscriptions = [int(sub_id) for sub_id in block.rescan_subscriptions.split(',')]
+            return RescanData(subscriptions, block.rescan_block, block.rescan_end)
+
+    def _save_rescan(self, rescan):
+        """Save rescan checkpoint into db
+
+        Arguments:
+            rescan (RescanData|None): Rescan with the next block to scan,
+                None to clear it once finished.
+        """
+        with make_session_scope(self._db_session) as session:
+            try:
+                block = session.query(Block).one()
+            except sqlalchemy.orm.exc.NoResultFound:
+                block = Block(block_number=self._current_block)
+
+            if rescan is None:
+                block.rescan_block = None
+                block.rescan_end = None
+                block.rescan_subscriptions = None
+            else:
+                block.rescan_block = rescan.start_block
+                block.rescan_end = rescan.end_block
+                block.rescan_subscriptions = ','.join(str(s) for s in rescan.subscriptions)
+            session.add(block)
+
+    def _start_rescan(self):
+        """Start the interrupted rescan or the next pending one, once
+        bitcoind is connected"""
+        # Only blocks already monitored can be rescanned
+        last_block = self._monitor.current_block-self._settings['CONFIRMATIONS']
+
+        if self._rescan_job is None:
+            if not self._rescan_pending:
+                return
+
+            # By default scan until the last block already monitored
+            job = self._rescan_pending.popleft()
+            if job.end_block is None:
+                job = job._replace(end_block=last_block)
+
+            if job.start_block < 0 or job.start_block > job.end_block or \
+                    job.end_block > last_block:
+                logger.error("Invalid rescan range {}-{} (last block {})".format(
+                    job.start_block, job.end_block, last_block))
+                return
+
+            self._save_rescan(job)
+            self._rescan_job = job
+
+        job = self._rescan_job
+
+        # Checkpoint saved after the last chunk, or past the blocks monitored
+        # by the current bitcoind node.
+        if job.start_block > job.end_block:
+            self._finish_rescan()
+            return
+        if job.end_block > last_block:
+            logger.error("Rescan range {}-{} past last block {}, discarded".format(
+                job.start_block, job.end_block, last_block))
+            self._finish_rescan()
+            return
+
+        # Only still active subscriptions are rescanned
+        with make_session_scope(self._db_session) as session:
+            subscriptions = [sub.to_subscription_data() for sub in
+                             session.query(Subscription).filter(
+                                 Subscription.id.in_(job.subscriptions),
+                                 Subscription.state == SubscriptionState.active)]
+
+        if not subscriptions:
+            self._finish_rescan()
+            return
+
+        self._rescan_subs = defaultdict(set)
+        for sub in subscriptions:
+            self._rescan_subs[sub.address].add(sub)
+
+        logger.info("Rescan blocks {}-{} ({} subscriptions)".format(
+            job.start_block, job.end_block, len(subscriptions)))
+
+        self._rescan = ParallelRescan(
+            self._settings['BITCOIND_URL'],
+            self._rescan_subs.keys(),
+            job.start_block,
+            job.end_block,
+            self._settings.get('RESCAN_WORKERS', DEFAULT_RESCAN_WORKERS),
+            self._settings.get('RESCAN_CHUNK_SIZE', DEFAULT_RESCAN_CHUNK_SIZE),
+            self._settings.get('RPC_BATCH_SIZE', DEFAULT_BATCH_SIZE),
+            self._settings.get('BLOCK_PREVOUTS', True))
+
+    def _finish_rescan(self):
+        """Stop rescan workers and clear the checkpoint"""
+        self._close_rescan()
+        self._rescan_job = None
+        self._save_rescan(None)
+
+    def _close_rescan(self):
+        if self._rescan is not None:
+            self._rescan.close()
+        self._rescan = None
+        self._rescan_subs = None
+
+    def _process_rescan(self):
+        """Send callbacks for the rescanned blocks ready, in block order,
+        checkpointing the progress after each chunk"""
+        if self._rescan is None:
+            return
+
+        while True:
+            try:
+                result = self._rescan.get()
+            except StopIteration:
+                logger.info("Rescan finished")
+                self._finish_rescan()
+                return
+            except (json.JSONDecodeError, ConnectionError, bitcoin.rpc.InWarmupError) as err:
+                # Restarted from the last checkpoint on the next update
+                logger.info("Rescan interrupted: {}".format(err.__class__.__name__))
+                self._close_rescan()
+                return
+            except Exception as err:
+                # It would fail again if restarted, i.e. blocks out of range
+                logger.error(err, exc_info=True)
+                self._finish_rescan()
+                return
+
+            if result is None:
+                return
+
+            first, last, transactions = result
+            for tran in transactions:
+                for cback in self._subscription_manager._transaction_to_callbacks(
+                        tran, subscriptions=self._rescan_subs):
+                    # Skip subscriptions canceled since the rescan started
+                    if cback.subscription.id not in self._subscription_manager:
+                        continue
+                    logger.debug("New rescan callback: {}".format(cback.id))
+                    self._callback_task.new_callback(cback)
+
+            # Saved after the callbacks are sent, as with the block number
+            self._rescan_job = self._rescan_job._replace(start_block=last+1)
+            self._save_rescan(self._rescan_job)
+
+    def _new_proxy(self):
+        """Create new bitcoind JSON-RPC connection"""
+        return BatchProxy(service_url=self._settings['BITCOIND_URL'],
+                          batch_size=self._settings.get('RPC_BATCH_SIZE',
+                                                        DEFAULT_BATCH_SIZE))
+
     def _connect_bitcoind(self):
         """
         Try to reconnect to bitcoind server
@@ -296,10 +784,41 @@ class BitmonTask(object):
         Returns:
             (bool): True if was reconnected false otherwise
         """
+        monitor = None
+        rpc_pool = None
         try:
-            proxy = bitcoin.rpc.Proxy(service_url=self._settings['BITCOIND_URL'])
-            monitor = TransactionMonitor(proxy, self._settings['CONFIRMATIONS'], 
-                                         self._current_block)
+            # Blocks are downloaded ahead using a second connection
+            prefetch_window = self._settings.get('PREFETCH_BLOCKS', DEFAULT_PREFETCH_WINDOW)
+            prefetch_proxy = self._new_proxy() if prefetch_window else None
+
+            # Spent outputs are requested concurrently over several connections
+            rpc_connections = self._settings.get('RPC_CONNECTIONS', DEFAULT_RPC_CONNECTIONS)
+            rpc_pool = ProxyPool(self._new_proxy, rpc_connections) if rpc_connections > 1 else None
+
+            monitor = TransactionMonitor(self._new_proxy(),
+                                         self._settings['CONFIRMATIONS'], 
+                                         self._current_block,
+                                         self._settings.get('MAX_BLOCKS_PER_POLL',
+                                                            MAX_BLOCKS_PER_POLL),
+                                         self._settings.get('TXOUT_CACHE', True),
+                                         self._outpoint_index,
+                                         prefetch_proxy,
+                                         prefetch_window or DEFAULT_PREFETCH_WINDOW,
+                                         self._mempool,
+                                         self._settings.get('TXOUT_CACHE_BYTES',
+                                                            DEFAULT_CACHE_BYTES),
+                                         self._disk_cache,
+                                         rpc_pool)
+
+            # Use spent outputs included in getblock responses when available
+            if self._settings.get('BLOCK_PREVOUTS', True) and monitor.detect_block_prevouts():
+                logger.info("Using getblock prevouts to resolve inputs")
+
+            # Restore TxOutCache entries from the snapshot
+            if self._snapshot_txouts is not None and monitor.txout_cache is not None:
+                monitor.txout_cache.load(self._snapshot_txouts)
+            self._snapshot_txouts = None
+
             self._subscription_manager.set_transaction_monitor(monitor)
             self._monitor = monitor
             logger.info("Bitcoind connected")
@@ -308,9 +827,22 @@ class BitmonTask(object):
             logger.debug("Bitcoind reconnect error: {}".format(err.__class__.__name__))
         except Exception as err:
             logger.error(err, exc_info=True)
+
+        if monitor is not None:
+            monitor.close()
+        elif rpc_pool is not None:
+            rpc_pool.close()
         
         return False
 
+    def _disconnect_bitcoind(self):
+        """Discard transaction monitor after the connection was lost, it will
+        be reconnected on the next update"""
+        self._subscription_manager.set_transaction_monitor(None)
+        if self._monitor is not None:
+            self._monitor.close()
+        self._monitor = None
+
     def _send_confirmed(self):
         """Look for new confirmed transactions, and send corresponding callbacks
         to callback task
@@ -320,13 +852,17 @@ class BitmonTask(object):
 
         except (json.JSONDecodeError, ConnectionError) as err:
             # This error is raised when connection to bitcoind is lost.
-            subscription_manager.set_transaction_monitor(None)
-            monitor_connected = False
+            # The blocks are processed again once reconnected, so outpoint
+            # index changes made while processing them are discarded.
+            self._disconnect_bitcoind()
+            self._outpoint_index.rollback()
             logger.info("Bitcoind connection lost")
+            return
         except Exception as err:
-            subscription_manager.set_transaction_monitor(None)
-            monitor_connected = False
+            self._disconnect_bitcoind()
+            self._outpoint_index.rollback()
             logger.error(err, exc_info=True)
+            return
 
         # Send Callbacks to notification task
         for cback in callbacks:
@@ -341,41 +877,217 @@ class BitmonTask(object):
             self._save_block_number(new_block)
             self._current_block = new_block
 
+            cache = self._monitor.txout_cache
+            if cache is not None:
+                logger.debug("TxOutCache: {} bytes, {} hits, {} misses, {} evictions".format(
+                    cache.size, cache.hits, cache.misses, cache.evictions))
+
+        # While catching up don't wait for the next update period, the
+        # remaining blocks are processed as fast as bitcoind allows.
+        lag = self._monitor.lag
+        if lag:
+            logger.info("Catching up: block {} ({} blocks behind)".format(new_block, lag))
+            self._last_update = time.perf_counter()-self._update_period
+
+    def _send_unconfirmed(self):
+        """Look for new mempool transactions, and send corresponding callbacks
+        to callback task
+        """
+        try:
+            callbacks = self._subscription_manager.poll_mempool()
+
+        except (json.JSONDecodeError, ConnectionError) as err:
+            self._disconnect_bitcoind()
+            logger.info("Bitcoind connection lost")
+            return
+        except Exception as err:
+            self._disconnect_bitcoind()
+            logger.error(err, exc_info=True)
+            return
+
+        for cback in callbacks:
+            logger.debug("New unconfirmed callback: {}".format(cback.id))
+            self._callback_task.new_callback(cback)
+
+    def _start_notifier(self, input_q):
+        """Subscribe to bitcoind new block notifications, each one is added
+        to the input queue as a NEW_BLOCK command to wake the task.
+
+        Arguments:
+            input_q (multiprocessing.Queue): Command input queue
+        """
+        url = self._settings.get('BLOCK_NOTIFY_URL', None)
+        if not url:
+            return
+
+        def notify(topic, body):
+            input_q.put((NEW_BLOCK, topic.decode()))
+
+        try:
+            self._notifier = BlockNotifier(url, notify)
+            self._update_period = self._settings.get('NOTIFY_UPDATE_PERIOD',
+                                                     NOTIFY_UPDATE_PERIOD)
+            logger.info("Subscribed to block notifications {}".format(url))
+        except (ImportError, ValueError) as err:
+            logger.error("Block notifications disabled: {}".format(err))
+
+    def _get_commands(self, input_q, timeout):
+        """Wait for a command, and return it along with the ones already
+        queued, up to COMMAND_BATCH_SIZE.
+
+        Arguments:
+            input_q (multiprocessing.Queue): Command input queue
+            timeout (float): Max seconds to wait for the first command
+
+        Returns:
+            list: [(cmd, data), ...], empty if the timeout expired
+        """
+        try:
+            commands = [input_q.get(block=True, timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        batch_size = self._settings.get('COMMAND_BATCH_SIZE', COMMAND_BATCH_SIZE)
+        while len(commands) < batch_size:
+            try:
+                commands.append(input_q.get_nowait())
+            except queue.Empty:
+                break
+
+        return commands
+
+    def _process_commands(self, commands):
+        """Process a batch of commands. Subscriptions added and cancelled
+        within the batch are merged, and the rest are added or cancelled
+        in bulk.
+
+        Arguments:
+            commands (list): [(cmd, data), ...]
+
+        Returns:
+            bool: True if EXIT_TASK was received
+        """
+        # New subscriptions {id: SubscriptionData}, and cancelled ids
+        added = {}
+        cancelled = []
+        exit_task = False
+
+        for cmd, data in commands:
+            if cmd == NEW_SUBSCRIPTION:
+                logger.debug("New Subscription (id: {})".format(data.id))
+                added[data.id] = data
+
+            elif cmd == NEW_SUBSCRIPTIONS:
+                logger.debug("New Subscriptions ({})".format(len(data)))
+                for subscription in data:
+                    added[subscription.id] = subscription
+
+            elif cmd == CANCEL_SUBSCRIPTION:
+                logger.debug("Cancel Subscription (id: {})".format(data))
+                # Subscriptions added in the same batch are never added
+                if added.pop(data, None) is None or data in self._subscription_manager:
+                    cancelled.append(data)
+
+            elif cmd == RESCAN:
+                logger.debug("Rescan from block {}".format(data.start_block))
+                self._rescan_pending.append(data)
+
+            elif cmd == NEW_BLOCK:
+                # Update now instead of waiting for the next poll
+                logger.debug("New block notification ({})".format(data))
+                self._last_update = time.perf_counter()-self._update_period
+
+            elif cmd == EXIT_TASK:
+                exit_task = True
+                break
+
+            else:
+                logger.debug("Unknown command {}".format(cmd))
+
+        # Cancelled first, in case an id is cancelled and added again
+        if cancelled:
+            self._subscription_manager.cancel_subscriptions(cancelled)
+        if added:
+            self._subscription_manager.add_subscriptions(added.values())
+
+        return exit_task
+
+    def _next_timeout(self):
+        """Seconds until the next bitcoind update, mempool poll, snapshot or
+        subscription expiration is due"""
+        now = time.perf_counter()
+        deadlines = [self._last_update+self._update_period]
+
+        if self._mempool is not None and self._monitor is not None:
+            deadlines.append(self._last_mempool_update+self._settings.get(
+                'MEMPOOL_UPDATE_PERIOD', MEMPOOL_UPDATE_PERIOD))
+
+        if self._snapshot_path:
+            deadlines.append(self._last_snapshot+self._settings.get(
+                'SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL))
+
+        expiration = self._subscription_manager.next_expiration()
+        if expiration is not None:
+            deadlines.append(now+(expiration-datetime.datetime.utcnow()).total_seconds())
+
+        if self._rescan is not None:
+            deadlines.append(now+RESCAN_POLL_PERIOD)
+
+        return max(min(deadlines)-now, 0)
+
+    def _expire_subscriptions(self):
+        """Remove expired subscriptions as soon as they are due, instead
+        of waiting for the next bitcoind update"""
+        expiration = self._subscription_manager.next_expiration()
+        if expiration is None or expiration > datetime.datetime.utcnow():
+            return
+
+        try:
+            self._subscription_manager._remove_expired_subscriptions()
+        except Exception as err:
+            logger.error(err, exc_info=True)
+
     def bitcoin_task(self, input_q, callback_task, settings):
         """
         Arguments:
             input_q (multiprocessing.Queue): Command input queue
-                NEW_SUBSCRIPTION, CANCEL_SUBSCRIPTION, EXIT_TASK
+                NEW_SUBSCRIPTION, NEW_SUBSCRIPTIONS, CANCEL_SUBSCRIPTION, EXIT_TASK
             callback_task (.callback_task.CallbackTask): callback delivery task
             settings(dict): Configurations settings/constants
         """
         self._init_task(self._settings)
+        self._start_notifier(input_q)
         logger.debug("Task running")
 
-        # Main dispatch loop
+        # Main dispatch loop, it waits for commands until the next update,
+        # poll or expiration is due, and then processes all the queued ones.
         while True:
 
-            try:
-                cmd, data = input_q.get(block=True, timeout=1)
-                if cmd == NEW_SUBSCRIPTION:
-                    logger.debug("New Subscription (id: {})".format(data.id))
-                    self._subscription_manager.add_subscription(data)
+            commands = self._get_commands(input_q, self._next_timeout())
+            if self._process_commands(commands):
+                break
 
-                elif cmd == CANCEL_SUBSCRIPTION:
-                    logger.debug("Cancel Subscription (id: {})".format(data.id))
-                    self._subscription_manager.cancel_subscription(data)
+            self._expire_subscriptions()
 
-                elif cmd == EXIT_TASK:
-                    break
+            # Send callbacks for rescanned blocks as soon as they are ready
+            self._process_rescan()
 
-                else:
-                    logger.debug("Unknown command {}".format(cmd))
+            # Mempool is polled more often than blocks when notifications
+            # are enabled.
+            if self._mempool is not None and self._monitor is not None and \
+                    time.perf_counter()-self._last_mempool_update >= \
+                    self._settings.get('MEMPOOL_UPDATE_PERIOD', MEMPOOL_UPDATE_PERIOD):
+                self._last_mempool_update = time.perf_counter()
+                self._send_unconfirmed()
 
-            except queue.Empty:
-                pass
+            # Periodic snapshots, so the state is recovered after a crash
+            # unless a new block was processed since.
+            if time.perf_counter()-self._last_snapshot >= \
+                    self._settings.get('SNAPSHOT_INTERVAL', DEFAULT_SNAPSHOT_INTERVAL):
+                self._write_snapshot()
 
             # Only periodical bitcoin updates and reconnect attempts
-            if time.perf_counter()-self._last_update < BITCOIN_UPDATE_PERIOD:
+            if time.perf_counter()-self._last_update < self._update_period:
                 continue
             else:
                 self._last_update = time.perf_counter()
@@ -388,7 +1100,26 @@ class BitmonTask(object):
             # Send confirmed callbacks if any
             self._send_confirmed()
 
-        # Close resource before exiting
+            # Start pending or interrupted rescan
+            if self._rescan is None and self._monitor is not None and \
+                    (self._rescan_job is not None or self._rescan_pending):
+                try:
+                    self._start_rescan()
+                except Exception as err:
+                    logger.error(err, exc_info=True)
+                    self._close_rescan()
+
+        # Close resource before exiting, an unfinished rescan is resumed
+        # on the next execution. The snapshot is written before the monitor
+        # is closed, so it includes TxOutCache entries.
+        self._close_rescan()
+        self._write_snapshot()
+        if self._notifier is not None:
+            self._notifier.close()
+        if self._monitor is not None:
+            self._monitor.close()
+        if self._disk_cache is not None:
+            self._disk_cache.close()
         input_q.close()
         exit(0)
     
@@ -398,9 +1129,23 @@ class BitmonTask(object):
     def new_subscription(self, subscription_data):
         self._input_q.put((NEW_SUBSCRIPTION, subscription_data))
 
+    def new_subscriptions(self, subscriptions_data):
+        """Send several new subscriptions with a single command
+
+        Arguments:
+            subscriptions_data (list): SubscriptionData
+        """
+        self._input_q.put((NEW_SUBSCRIPTIONS, list(subscriptions_data)))
+
     def cancel_subscription(self, subscription_id):
         self._input_q.put((CANCEL_SUBSCRIPTION, subscription_id))
 
+    def rescan(self, subscription_ids, start_block, end_block=None):
+        """Scan past blocks for transactions involving the subscriptions
+        addresses, end_block None for the last block monitored"""
+        self._input_q.put((RESCAN, RescanData(list(subscription_ids),
+                                              start_block, end_block)))
+
     def close(self):
         self._input_q.put((EXIT_TASK, None))
         self._input_q.close()
@@ -1,21 +1,39 @@
 import threading
 from multiprocessing import Process, Queue
 from datetime import datetime, timedelta
+import asyncio
 import collections
+import http.client
 import logging
 import pickle
-import requests
 import queue
-import json
 
+from sqlalchemy.orm import joinedload
+
+from bitcallback import async_http
 from bitcallback.models import Callback, Subscription
 from bitcallback.commands import (NEW_CALLBACK, ACK_CALLBACK, EXIT_TASK)
 from bitcallback.database import make_session_scope, configure_db
+from bitcallback.async_pool import AsyncPool, DEFAULT_CONCURRENCY
+from bitcallback.http_pool import (HTTPConnectionPool, DEFAULT_POOL_SIZE,
+                                   DEFAULT_IDLE_TIMEOUT, DEFAULT_DNS_TTL)
+from bitcallback.payload_cache import (PayloadCache, DEFAULT_PAYLOAD_CACHE_BYTES,
+                                       build_payload, render_payload)
+from bitcallback.retry_schedule import RetrySchedule
 from bitcallback.thread_pool import ThreadPool
 
 
 CALLBACK_REQUEST_TIMEOUT = 1 # In seconds
 
+# Max seconds the update thread waits for a running send to finish, when
+# the send pool is full.
+UPDATE_PERIOD = 1
+
+# Callback delivery engines, a pool of threads each sending one request
+# at a time, or concurrent requests on an asyncio event loop.
+ENGINE_THREADS = 'threads'
+ENGINE_ASYNCIO = 'asyncio'
+
 
 CallbackRecord = collections.namedtuple('CallbackRecord', ['id', 'retries', 'last_retry'])
 
@@ -27,22 +45,49 @@ class CallbackManager(object):
     def __init__(self,
                  db_session,
                  retries=3, retry_period=120,
-                 nthreads=10, recover_db=True):
+                 nthreads=10, recover_db=True,
+                 engine=ENGINE_THREADS, concurrency=DEFAULT_CONCURRENCY,
+                 pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 dns_ttl=DEFAULT_DNS_TTL,
+                 payload_cache_bytes=DEFAULT_PAYLOAD_CACHE_BYTES):
+        """
+        Arguments:
+            db_session (scoped_session):
+            retries (int): Max number of retries before acknowledgment
+            retry_period (int): Seconds between retries
+            nthreads (int): Number of sending threads (threads engine)
+            recover_db (bool): Load unfinished callbacks from DB
+            engine (str): Delivery engine ENGINE_THREADS or ENGINE_ASYNCIO
+            concurrency (int): Max concurrent requests (asyncio engine)
+            pool_size (int): Max idle keep-alive connections per host
+                (threads engine)
+            idle_timeout (float): Seconds idle connections are kept
+            dns_ttl (float): Seconds resolved host addresses are cached
+            payload_cache_bytes (int): Max memory used by the cached
+                callback payloads, the rest are rebuilt from the DB.
+        """
         # Dictionary containing all callback indexed by (txid, addr)
         self._callbacks = {}
 
-        # Queue of callbacks ids to retry ordered by last retry time
-        self._retry_q = collections.deque()
+        # Callback ids ordered by next delivery attempt time
+        self._retry_schedule = RetrySchedule()
+
+        # Serialized requests and urls of the callbacks {id: (payload, url)}
+        self._payloads = PayloadCache(payload_cache_bytes)
 
         # SQLAlchemy session
         self._db_session = db_session
 
-        # Queue where ThreadPool threads stores the ids of sent callbacks
-        self._sent_q = queue.Queue()
+        # Ids of the callbacks sent by the send pool, not processed yet
+        self._sent = collections.deque()
 
         # Lock for every thing excepts DB access
         self._lock = threading.Lock()
 
+        # Notifies the update thread a callback was added, sent or
+        # acknowledged, or the manager is closing.
+        self._wakeup = threading.Condition(self._lock)
+
         # DB access lock
         self._db_lock = threading.Lock()
 
@@ -52,18 +97,30 @@ class CallbackManager(object):
         # Wait between sucessive unacknowledged callback tries
         self.retry_period = retry_period
 
-        # Start request thread pool
-        self._thread_pool = ThreadPool(
-            nthreads=nthreads,
-            func=CallbackManager._send_thread_func,
-            args=(self._sent_q,))
+        # Start request sending pool, both call _callback_sent with the
+        # ids of the sent callbacks.
+        self._http_pool = None
+        if engine == ENGINE_THREADS:
+            # Keep-alive connections shared by all the threads
+            self._http_pool = HTTPConnectionPool(pool_size, idle_timeout, dns_ttl)
+            self._send_pool = ThreadPool(
+                nthreads=nthreads,
+                func=CallbackManager._send_thread_func,
+                args=(self._callback_sent, self._http_pool))
+        elif engine == ENGINE_ASYNCIO:
+            self._send_pool = AsyncPool(
+                concurrency=concurrency,
+                func=CallbackManager._send_async_func,
+                args=(self._callback_sent,))
+        else:
+            raise ValueError("Unknown callback engine {}".format(engine))
 
         # Flag used to notify update_thread to stop
         self._close_flag = threading.Event()
 
         # Start update thread
         self._update_thread = threading.Thread(
-            target=CallbackManager._update_func,
+            target=self._update_func,
             args=(self,),
             daemon=True)
         self._update_thread.start()
@@ -72,38 +129,94 @@ class CallbackManager(object):
         if not recover_db:
             return
 
-        # Load unfinished callbacks from DB
+        # Load unfinished callbacks from DB, along with their payloads.
+        # The ones retried first are cached last so they are the last
+        # evicted if they don't fit.
         with self._db_lock:
             with make_session_scope(self._db_session) as session:
-                pending = session.query(Callback).filter(
-                    Callback.acknowledged == False,
-                    Callback.retries > 0).all()
-
-        # Add unfinished to retry queue.
-        pending = sorted(pending, key=lambda c: c.last_retry)
+                pending = session.query(Callback)\
+                        .options(joinedload(Callback.subscription))\
+                        .filter(Callback.acknowledged == False,
+                                Callback.retries > 0)\
+                        .order_by(Callback.last_retry.desc()).all()
+                payloads = [self._build_payload(cback) for cback in pending]
+
+        # Schedule unfinished for a retry
+        retry_period = timedelta(seconds=self.retry_period)
         with self._lock:
-            for cback in pending:
+            for cback, (payload, url) in zip(pending, payloads):
                 record = CallbackRecord(cback.id, cback.retries, cback.last_retry)
                 self._callbacks[record.id] = record
-                self._retry_q.append(record.id)
+                self._payloads.put(record.id, payload, url)
+                self._retry_schedule.schedule(record.id, record.last_retry+retry_period)
+            self._wakeup.notify()
 
     def _get_session(self):
         return self._db_session()
 
     @staticmethod
-    def _send_thread_func(job, sent_q):
-        """Function used by ThreadPool to send callbacks, one sent
-        it places its id on sent_q"""
-        callback_id, json, url = job
+    def _build_payload(callback):
+        """
+        Arguments:
+            callback (Callback): Callback attached to a session
+
+        Returns:
+            tuple: (payload, url) cached for the callback
+        """
+        return build_payload(callback.to_request()), callback.subscription.callback_url
+
+    def _load_payload(self, callback_id):
+        """Rebuild payload from DB of a callback evicted from the cache
+
+        Returns:
+            tuple: (payload, url)
+        """
+        with self._db_lock:
+            with make_session_scope(self._db_session) as session:
+                callback = session.query(Callback).get(callback_id)
+                payload, url = self._build_payload(callback)
+
+        with self._lock:
+            if callback_id in self._callbacks:
+                self._payloads.put(callback_id, payload, url)
+        return payload, url
+
+    def _callback_sent(self, callback_id):
+        """Called by the send pool once a callback is sent"""
+        with self._wakeup:
+            self._sent.append(callback_id)
+            self._wakeup.notify()
+
+    @staticmethod
+    def _send_thread_func(job, on_sent, http_pool):
+        """Function used by ThreadPool to send callbacks, once sent
+        it calls on_sent with its id"""
+        callback_id, body, url = job
 
         try:
-            requests.post(url, json=json, timeout=CALLBACK_REQUEST_TIMEOUT)
-        except requests.RequestException:
+            http_pool.post(url, data=body, timeout=CALLBACK_REQUEST_TIMEOUT)
+        except (OSError, http.client.HTTPException, ValueError):
+            # Delivery failures are retried, they are expected
             pass
         except Exception:
+            logger.exception("Unexpected error sending callback {}".format(callback_id))
+
+        on_sent(callback_id)
+
+    @staticmethod
+    async def _send_async_func(job, on_sent):
+        """Coroutine used by AsyncPool to send callbacks, as _send_thread_func"""
+        callback_id, body, url = job
+
+        try:
+            await async_http.post(url, data=body, timeout=CALLBACK_REQUEST_TIMEOUT)
+        except (async_http.HTTPError, OSError, asyncio.TimeoutError):
+            # Delivery failures are retried, they are expected
             pass
+        except Exception:
+            logger.exception("Unexpected error sending callback {}".format(callback_id))
 
-        sent_q.put(callback_id)
+        on_sent(callback_id)
 
     def ack_callback(self, callback_id):
         """Mark callback as acknolewdged, return False if it didn't exist
@@ -117,6 +230,12 @@ class CallbackManager(object):
             # Check there was a callback with the given id
             if callback is None:
                 return False
+            self._payloads.discard(callback_id)
+
+            # Its schedule entry is removed lazily, the update thread
+            # recomputes its deadline.
+            self._retry_schedule.discard(callback_id)
+            self._wakeup.notify()
 
         with self._db_lock:
             with make_session_scope(self._db_session) as session:
@@ -132,115 +251,183 @@ class CallbackManager(object):
         with self._db_lock:
             with make_session_scope(self._db_session) as session:
                 session.add(callback)
+                session.flush()
+                payload, url = self._build_payload(callback)
 
         with self._lock:
             record = CallbackRecord(callback.id,
                                     callback.retries,
                                     callback.last_retry)
             self._callbacks[callback.id] = record
-            # Set callback as next for delivery
-            self._retry_q.appendleft(callback.id)
+            self._payloads.put(callback.id, payload, url)
+            # Set callback as due for delivery
+            self._retry_schedule.schedule(callback.id, datetime.utcnow())
+            self._wakeup.notify()
 
     def close(self, timeout=None):
         """Close all allocated resources"""
-        self._thread_pool.close()
-        self._close_flag.set() # To notify update thread
+        self._send_pool.close()
+        with self._wakeup:
+            self._close_flag.set() # To notify update thread
+            self._wakeup.notify()
         self._update_thread.join(timeout)
+        logger.debug("Payload cache hits: {} misses: {} evictions: {}".format(
+            self._payloads.hits, self._payloads.misses, self._payloads.evictions))
+        if self._http_pool is not None:
+            logger.debug("HTTP pool stats: {}".format(self.http_stats()))
+            self._http_pool.close()
         self._db_session.close()
 
+    def http_stats(self):
+        """Keep-alive connections and DNS cache hit rates
+
+        Returns:
+            dict|None: HTTPConnectionPool.stats(), None for the asyncio engine
+        """
+        if self._http_pool is None:
+            return None
+        return self._http_pool.stats()
+
     def _next_sent(self):
-        """Deque an return first callback record ready for delivery or None"""
-        retry_limit = datetime.utcnow()-timedelta(seconds=self.retry_period)
+        """Remove first callback due for delivery from the schedule
+
+        Returns:
+            tuple|None: (CallbackRecord, cached (payload, url) or None), None
+                if there isn't any callback due.
+        """
+        now = datetime.utcnow()
         with self._lock:
-            callback_id = self._retry_q[0]
+            while True:
+                callback_id = self._retry_schedule.pop_due(now)
+                if callback_id is None:
+                    return None
+
+                record = self._callbacks.get(callback_id, None)
+                if record is not None:
+                    return record, self._payloads.get(callback_id)
+
+    def _wait(self, pool_full):
+        """Wait until a callback is sent, the next one is due, or the
+        manager is closing.
+
+        Arguments:
+            pool_full (bool): The send pool was full on the last update,
+                don't wait for due callbacks.
 
-            # Check if callback was acknowledged
-            callback_record = self._callbacks.get(callback_id, None)
-            if callback_record is None:
-                return None
+        Returns:
+            list: Ids of the sent callbacks
+        """
+        with self._wakeup:
+            while not self._sent and not self._close_flag.is_set():
+                if pool_full:
+                    # Either a running send finishes or it's retried
+                    # after UPDATE_PERIOD.
+                    self._wakeup.wait(UPDATE_PERIOD)
+                    break
 
-            # Check head of the callback is ready to be sent
-            if callback_record.last_retry > retry_limit:
-                return None
+                next_due = self._retry_schedule.next_due()
+                if next_due is None:
+                    timeout = None
+                else:
+                    timeout = (next_due-datetime.utcnow()).total_seconds()
+                    if timeout <= 0:
+                        break
+                self._wakeup.wait(timeout)
 
-            callback_record = self._retry_q.popleft()
+            sent = list(self._sent)
+            self._sent.clear()
 
-        return callback_record
+        return sent
 
     def _send_ready(self):
-        """Enqueue ready to send callbacks into thread_pool job queue"""
+        """Enqueue ready to send callbacks into send pool job queue
+
+        Returns:
+            bool: False if the pool was full before all were enqueued
+        """
 
         # Send callbacks ready for a retry
-        while len(self._retry_q):
+        while True:
 
-            callback_id = self._next_sent()
-            if not callback_id:
+            next_sent = self._next_sent()
+            if next_sent is None:
                 break
 
-            # Construct callback request json
-            with self._db_lock:
-                with make_session_scope(self._db_session) as session:
-                    callback = session.query(Callback).get(callback_id)
-                    json = callback.to_request()
-                    url = callback.subscription.callback_url
+            # Complete the cached payload with the current retries, it's
+            # only rebuilt from DB when it was evicted.
+            record, cached = next_sent
+            callback_id = record.id
+            payload, url = cached if cached else self._load_payload(callback_id)
+            body = render_payload(payload, record.last_retry, record.retries)
 
-            # Add to thread pool job queue
+            # Add to send pool job queue
             try:
-                job = (callback_id, json, url)
-                self._thread_pool.add_job(job, block=False)
+                job = (callback_id, body, url)
+                self._send_pool.add_job(job, block=False)
             except queue.Full:
                 with self._lock:
-                    # If the queue if full wait until next update
-                    self._retry_q.appendleft(callback_id)
-                    break
+                    # If the queue if full wait until next update, unless it
+                    # was acknowledged meanwhile.
+                    if callback_id in self._callbacks:
+                        self._retry_schedule.schedule(callback_id, datetime.utcnow())
+                return False
 
-    def _process_sent(self):
-        """Process callbacks marked as sent by the thread_pool"""
-        # Process all callbacks marked as sent by thread_pool
-        while True:
-            try:
-                callback_id = self._sent_q.get(block=True, timeout=1)
+        return True
 
-                with self._lock:
-                    # If callback was acknowledged while being sent discard it
-                    # and keep looping
-                    record = self._callbacks.get(callback_id, None)
-                    if not record:
-                        continue
-
-                    # Update callback and enqueue for a retry if there are any remaining,
-                    # otherwise discard it.
-                    if record.retries > 0:
-                        record = CallbackRecord(
-                            callback_id,
-                            record.retries-1,
-                            datetime.utcnow())
-                        self._callbacks[callback_id] = record
-                        self._retry_q.append(callback_id)
-                    else:
-                        del self._callbacks[callback_id]
-
-                # Save all changes to db
-                with self._db_lock:
-                    with make_session_scope(self._db_session) as session:
-                        update_fields = {
-                            'retries': record.retries,
-                            'last_retry': record.last_retry}
-                        session.query(Callback).filter_by(id=record.id)\
-                            .update(update_fields)
+    def _process_sent(self, sent):
+        """Process callbacks marked as sent by the send pool
 
-            except queue.Empty:
-                # No callbacks remainig at the queue
-                break
+        Arguments:
+            sent (list): Sent callback ids
+        """
+        updated = []
+        with self._lock:
+            for callback_id in sent:
+                # If callback was acknowledged while being sent discard it
+                record = self._callbacks.get(callback_id, None)
+                if not record:
+                    continue
+
+                # Update callback and enqueue for a retry if there are any remaining,
+                # otherwise discard it.
+                if record.retries > 0:
+                    record = CallbackRecord(
+                        callback_id,
+                        record.retries-1,
+                        datetime.utcnow())
+                    self._callbacks[callback_id] = record
+                    self._retry_schedule.schedule(
+                        callback_id,
+                        record.last_retry+timedelta(seconds=self.retry_period))
+                else:
+                    del self._callbacks[callback_id]
+                    self._payloads.discard(callback_id)
+                updated.append(record)
+
+        if not updated:
+            return
+
+        # Save all changes to db
+        with self._db_lock:
+            with make_session_scope(self._db_session) as session:
+                for record in updated:
+                    update_fields = {
+                        'retries': record.retries,
+                        'last_retry': record.last_retry}
+                    session.query(Callback).filter_by(id=record.id)\
+                        .update(update_fields)
 
     @staticmethod
     def _update_func(callback_manager):
-        """Function used by periodic update thread"""
+        """Function used by update thread, it sleeps until there is
+        something to do."""
+        pool_full = False
         while True:
+            sent = callback_manager._wait(pool_full)
             if callback_manager._close_flag.is_set():
                 break
-            callback_manager._send_ready()
-            callback_manager._process_sent()
+            callback_manager._process_sent(sent)
+            pool_full = not callback_manager._send_ready()
 
     def __len__(self):
         return len(self._callbacks)
@@ -284,7 +471,16 @@ class CallbackTask(object):
                                 db_session=db_session,
                                 retries=settings['RETRIES'], 
                                 retry_period=settings['RETRY_PERIOD'],
-                                nthreads=settings['NTHREADS'])
+                                nthreads=settings['NTHREADS'],
+                                engine=settings.get('ENGINE', ENGINE_THREADS),
+                                concurrency=settings.get('CONCURRENCY',
+                                                         DEFAULT_CONCURRENCY),
+                                pool_size=settings.get('POOL_SIZE', DEFAULT_POOL_SIZE),
+                                idle_timeout=settings.get('POOL_IDLE_TIMEOUT',
+                                                          DEFAULT_IDLE_TIMEOUT),
+                                dns_ttl=settings.get('DNS_TTL', DEFAULT_DNS_TTL),
+                                payload_cache_bytes=settings.get(
+                                    'PAYLOAD_CACHE_BYTES', DEFAULT_PAYLOAD_CACHE_BYTES))
 
         # Main dispatch loop
         while True:
@@ -12,7 +12,10 @@ START_TASK = "start"  # Restart paused task
 
 # Bitcoin monitoring task
 NEW_SUBSCRIPTION = "new_subscription"    # Start monitoring bitcoin address
+NEW_SUBSCRIPTIONS = "new_subscriptions"  # Start monitoring several addresses at once
 CANCEL_SUBSCRIPTION = "cancel_subscription"    # Stop monitoring bitcoin address
+NEW_BLOCK = "new_block"  # bitcoind notified a new block, update immediately
+RESCAN = "rescan"  # Scan past blocks for transactions to subscribed addresses
 
 # Callback task
 NEW_CALLBACK = "new_callback"  # New callback ready to send
@@ -20,5 +23,12 @@ ACK_CALLBACK = "ack_callback"  # A callback was ackd by the client
 
 # Inmutable command data
 SubscriptionData = namedtuple('SubscriptionData', ['id', 'address', 'callback_url', 'expiration'])
-CallbackData = namedtuple('CallbackData', ['id', 'subscription', 'txid', 'amount'])
+CallbackData = namedtuple('CallbackData', ['id', 'subscription', 'txid', 'amount', 'confirmed'])
+
+# Transactions are confirmed unless they were seen in the mempool
+CallbackData.__new__.__defaults__ = (True,)
+
+# Subscriptions ids and block range (included), end_block None for the
+# last block monitored.
+RescanData = namedtuple('RescanData', ['subscriptions', 'start_block', 'end_block'])
 
@@ -0,0 +1,205 @@
+"""
+expiration
+
+Schedule of subscription expirations, with constant time cancellation.
+"""
+from array import array
+import datetime
+import heapq
+
+# Expiration resolution in seconds, all the slots expiring within the same
+# tick are stored and expired together.
+DEFAULT_TICK = 1
+
+# Min number of stale ticks before the tick heap is compacted
+MIN_COMPACT_SIZE = 1024
+
+# Marks the end of a bucket list, or a slot that isn't scheduled
+NO_SLOT = -1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+class ExpirationSchedule(object):
+    """Slots grouped into buckets by expiration tick. A heap of pending ticks
+    is used to find the expired buckets, cancelling a slot only removes it
+    from its bucket, and emptied buckets are dropped. Ticks left in the
+    heap by dropped buckets are discarded when they reach the top, or all
+    at once when they outnumber the live ones, so memory usage only
+    depends on the number of scheduled slots.
+
+    Slots are small non negative integers allocated and reused by the owner
+    (SubscriptionTable rows). Each bucket is a doubly linked list of slots
+    stored in arrays indexed by slot, so a scheduled slot takes a few bytes
+    instead of a set entry and an int object."""
+
+    def __init__(self, tick=DEFAULT_TICK):
+        """
+        Arguments:
+            tick (int|float): Expiration resolution in seconds
+        """
+        self._tick = tick
+
+        # First slot expiring in each tick {tick: slot}
+        self._buckets = dict()
+
+        # Heap of ticks, may contain ticks without bucket
+        self._heap = []
+
+        # Expiration tick, previous and next slot in the bucket, by slot
+        self._ticks = array('q')
+        self._prev = array('i')
+        self._next = array('i')
+
+        # Number of scheduled slots
+        self._count = 0
+
+    def _to_tick(self, when):
+        """Convert datetime into tick, rounded up so slots never expire
+        before their expiration datetime"""
+        seconds = (when-EPOCH).total_seconds()
+        tick = int(seconds//self._tick)
+        if tick*self._tick < seconds:
+            tick += 1
+        return tick
+
+    def _compact(self):
+        """Rebuild the heap from the live buckets"""
+        self._heap = list(self._buckets.keys())
+        heapq.heapify(self._heap)
+
+    def _add(self, slot, when):
+        """Add slot to its bucket, replacing any previous expiration
+
+        Returns:
+            int|None: Tick if a new bucket was created for it
+        """
+        if slot >= len(self._ticks):
+            grow = slot+1-len(self._ticks)
+            self._ticks.extend([NO_SLOT]*grow)
+            self._prev.extend([NO_SLOT]*grow)
+            self._next.extend([NO_SLOT]*grow)
+        else:
+            self.cancel(slot)
+
+        tick = self._to_tick(when)
+        head = self._buckets.get(tick, NO_SLOT)
+        self._buckets[tick] = slot
+        self._ticks[slot] = tick
+        self._prev[slot] = NO_SLOT
+        self._next[slot] = head
+        if head != NO_SLOT:
+            self._prev[head] = slot
+        self._count += 1
+
+        return tick if head == NO_SLOT else None
+
+    def schedule(self, slot, when):
+        """Schedule slot expiration, replacing any previous one
+
+        Arguments:
+            slot (int):
+            when (datetime.datetime): Expiration datetime (UTC)
+        """
+        tick = self._add(slot, when)
+        if tick is not None:
+            heapq.heappush(self._heap, tick)
+
+    def schedule_many(self, items):
+        """Schedule several slots, when they add many ticks the heap is
+        rebuilt once instead of pushing them one at a time.
+
+        Arguments:
+            items (iterable): [(slot, datetime.datetime), ...]
+        """
+        ticks = []
+        for slot, when in items:
+            tick = self._add(slot, when)
+            if tick is not None:
+                ticks.append(tick)
+
+        if len(ticks) > len(self._heap)//8:
+            self._compact()
+        else:
+            for tick in ticks:
+                heapq.heappush(self._heap, tick)
+
+    def cancel(self, slot):
+        """Remove slot from the schedule
+
+        Arguments:
+            slot (int):
+
+        Returns:
+            bool: True if the slot was scheduled
+        """
+        if slot not in self:
+            return False
+
+        tick = self._ticks[slot]
+        prev_slot, next_slot = self._prev[slot], self._next[slot]
+        if next_slot != NO_SLOT:
+            self._prev[next_slot] = prev_slot
+        if prev_slot != NO_SLOT:
+            self._next[prev_slot] = next_slot
+        elif next_slot != NO_SLOT:
+            self._buckets[tick] = next_slot
+        else:
+            del self._buckets[tick]
+
+            if len(self._heap) > max(2*len(self._buckets), MIN_COMPACT_SIZE):
+                self._compact()
+
+        self._ticks[slot] = NO_SLOT
+        self._count -= 1
+        return True
+
+    def pop_expired(self, now=None):
+        """Remove and return all the slots that expired before now
+
+        Arguments:
+            now (datetime.datetime|None): Current datetime (UTC)
+
+        Returns:
+            list: Expired slots
+        """
+        if now is None:
+            now = datetime.datetime.utcnow()
+        seconds = (now-EPOCH).total_seconds()
+
+        expired = []
+        while self._heap and self._heap[0]*self._tick < seconds:
+            tick = heapq.heappop(self._heap)
+            slot = self._buckets.pop(tick, NO_SLOT)
+            while slot != NO_SLOT:
+                expired.append(slot)
+                self._ticks[slot] = NO_SLOT
+                slot = self._next[slot]
+
+        self._count -= len(expired)
+        return expired
+
+    def next_expiration(self):
+        """
+        Returns:
+            datetime.datetime|None: Expiration of the first tick with
+                scheduled slots, None if empty.
+        """
+        # Discard ticks of dropped buckets
+        while self._heap and self._heap[0] not in self._buckets:
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return None
+        return EPOCH+datetime.timedelta(seconds=self._heap[0]*self._tick)
+
+    @property
+    def heap_size(self):
+        """Number of ticks in the heap, including stale ones"""
+        return len(self._heap)
+
+    def __contains__(self, slot):
+        return 0 <= slot < len(self._ticks) and self._ticks[slot] != NO_SLOT
+
+    def __len__(self):
+        return self._count
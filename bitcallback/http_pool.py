@@ -0,0 +1,293 @@
+"""
+http_pool
+
+Keep-alive HTTP connections shared by the callback sending threads, pooled
+by scheme, host and port, with a small DNS resolver cache.
+"""
+from collections import deque
+import http.client
+import json as jsonlib
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Default max idle connections kept for each scheme/host/port
+DEFAULT_POOL_SIZE = 4
+
+# Default seconds an idle connection is kept before it's closed
+DEFAULT_IDLE_TIMEOUT = 30
+
+# Default seconds a resolved host address is cached
+DEFAULT_DNS_TTL = 60
+
+
+class ResolverCache(object):
+    """Cache of resolved host addresses, so they aren't resolved for each
+    new connection."""
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL):
+        """
+        Arguments:
+            ttl (float): Seconds resolved addresses are cached
+        """
+        self._ttl = ttl
+
+        # Resolved addresses {(host, port): (expiration, [(family, sockaddr), ...])}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+        # Expired entries are removed at most once per ttl
+        self._next_purge = time.monotonic()+ttl
+
+        self.hits = 0
+        self.misses = 0
+
+    def _purge(self, now):
+        """Remove expired entries, so hosts no longer used aren't kept"""
+        expired = [key for key, (expiration, _) in self._cache.items() if expiration <= now]
+        for key in expired:
+            del self._cache[key]
+        self._next_purge = now+self._ttl
+
+    def resolve(self, host, port):
+        """
+        Returns:
+            list: [(family, sockaddr), ...] for all the resolved addresses,
+                in getaddrinfo order
+
+        Raises:
+            OSError: Resolution failed
+        """
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key, None)
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        addresses = [(family, sockaddr) for family, _, _, _, sockaddr
+                     in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)]
+        with self._lock:
+            if now >= self._next_purge:
+                self._purge(now)
+            self._cache[key] = (now+self._ttl, addresses)
+        return addresses
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class _ResolvedConnectionMixin(object):
+    """Connect to the addresses from the resolver cache, the request Host
+    header and TLS server name are still the original host."""
+
+    def _connect_resolved(self):
+        """Try each resolved address in turn, as socket.create_connection
+
+        Raises:
+            OSError: The error connecting to the last address
+        """
+        err = None
+        for family, sockaddr in self._resolver.resolve(self.host, self.port):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(self.timeout)
+                sock.connect(sockaddr)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                return sock
+            except OSError as exc:
+                sock.close()
+                err = exc
+
+        if err is None:
+            err = OSError("getaddrinfo returns an empty list")
+        raise err
+
+
+class HTTPConnection(_ResolvedConnectionMixin, http.client.HTTPConnection):
+
+    def __init__(self, host, port, timeout, resolver):
+        super().__init__(host, port, timeout=timeout)
+        self._resolver = resolver
+
+    def connect(self):
+        self.sock = self._connect_resolved()
+
+
+class HTTPSConnection(_ResolvedConnectionMixin, http.client.HTTPSConnection):
+
+    def __init__(self, host, port, timeout, resolver, context):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._resolver = resolver
+        self._ssl_context = context
+
+    def connect(self):
+        sock = self._connect_resolved()
+        self.sock = self._ssl_context.wrap_socket(sock, server_hostname=self.host)
+
+
+class HTTPConnectionPool(object):
+    """Idle keep-alive connections by (scheme, host, port). Connections are
+    taken from the pool for a single request and returned once the response
+    is read, so they can be shared by several threads."""
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 dns_ttl=DEFAULT_DNS_TTL):
+        """
+        Arguments:
+            pool_size (int): Max idle connections kept for each host
+            idle_timeout (float): Seconds before idle connections are closed
+            dns_ttl (float): Seconds resolved addresses are cached
+        """
+        self._pool_size = pool_size
+        self._idle_timeout = idle_timeout
+        self._resolver = ResolverCache(dns_ttl)
+        self._ssl_context = None
+
+        # Idle connections, most recently used last {key: deque((last_used, conn))}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+        # Requests sent over a reused connection (hits) or a new one (misses)
+        self.hits = 0
+        self.misses = 0
+
+    def _new_connection(self, scheme, host, port, timeout):
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            return HTTPSConnection(host, port, timeout, self._resolver, self._ssl_context)
+        return HTTPConnection(host, port, timeout, self._resolver)
+
+    def _get(self, key):
+        """Take the most recently used idle connection for a key
+
+        Returns:
+            HTTPConnection|None: None if there isn't one
+        """
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, None)
+            if idle:
+                # Oldest connections are first, discard the expired ones
+                while idle and now-idle[0][0] > self._idle_timeout:
+                    expired.append(idle.popleft()[1])
+                if idle:
+                    conn = idle.pop()[1]
+
+        for old in expired:
+            old.close()
+        return conn
+
+    def _put(self, key, conn):
+        """Return connection to the pool, it's closed if the pool is full"""
+        with self._lock:
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self._pool_size:
+                idle.append((time.monotonic(), conn))
+                return
+        conn.close()
+
+    def _request(self, conn, path, body, headers):
+        conn.request('POST', path, body=body, headers=headers)
+        response = conn.getresponse()
+
+        # The response must be fully read before the connection is reused
+        response.read()
+        return response
+
+    def post(self, url, data=None, json=None, timeout=None):
+        """POST json to url, reusing an idle connection to the same host
+        if there is one.
+
+        Arguments:
+            url (str):
+            data (bytes|None): Request body, already serialized json
+            json: Object serialized as the request body, when there is
+                no data
+            timeout (float|None): Connection and read timeout
+
+        Returns:
+            int: Response status code
+
+        Raises:
+            ValueError: Unsupported url
+            OSError|http.client.HTTPException: Request failed
+        """
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError("Unsupported url {}".format(url))
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+
+        path = parts.path or '/'
+        if parts.query:
+            path += '?'+parts.query
+        body = data if data is not None else jsonlib.dumps(json).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+
+        conn = self._get(key)
+        if conn is not None:
+            with self._lock:
+                self.hits += 1
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            try:
+                response = self._request(conn, path, body, headers)
+            except (ConnectionError, http.client.RemoteDisconnected,
+                    http.client.CannotSendRequest):
+                # Closed by the server while idle, retried once with a
+                # new connection.
+                conn.close()
+                conn = None
+            except Exception:
+                conn.close()
+                raise
+
+        if conn is None:
+            with self._lock:
+                self.misses += 1
+            conn = self._new_connection(parts.scheme, parts.hostname, port, timeout)
+            try:
+                response = self._request(conn, path, body, headers)
+            except Exception:
+                conn.close()
+                raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(key, conn)
+        return response.status
+
+    def stats(self):
+        """
+        Returns:
+            dict: Connection reuse and DNS cache hits, misses and hit rates
+        """
+        def rate(hits, misses):
+            return hits/(hits+misses) if hits+misses else 0.0
+
+        resolver = self._resolver
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': rate(self.hits, self.misses),
+                'dns_hits': resolver.hits,
+                'dns_misses': resolver.misses,
+                'dns_hit_rate': rate(resolver.hits, resolver.misses)}
+
+    def close(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+
+        for connections in idle.values():
+            for _, conn in connections:
+                conn.close()
@@ -37,6 +37,7 @@ callback_fields = {
     'subscription': fields.Nested(nested_subscription_fields),
     'txid': fields.String,
     'amount': fields.Integer,
+    'confirmed': fields.Boolean,
     'created': IsoDateTime,
     'last_retry': IsoDateTime,
     'retries': fields.Integer,
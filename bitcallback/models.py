@@ -5,6 +5,8 @@ from flask_restplus import marshal
 from datetime import datetime, timedelta
 import enum
 
+import sqlalchemy
+
 
 from bitcallback.marshalling import callback_fields
 from bitcallback.common import unique_id
@@ -34,6 +36,14 @@ class CallbackState(enum.Enum):
 
 db = SQLAlchemy()
 
+def default_created():
+    """Subscription creation date default"""
+    return datetime.utcnow().replace(microsecond=0)
+
+def default_expiration():
+    """Subscription expiration date default, 30 days after creation"""
+    return (datetime.utcnow()+timedelta(days=30)).replace(microsecond=0)
+
 class Subscription(db.Model):
     # TODO: THIS MODEL IS INMUTABLE and once it's created the client
     # can only change state to canceled
@@ -48,12 +58,10 @@ class Subscription(db.Model):
     callback_url = db.Column(db.Unicode(1024), default='')
 
     # Date of creation
-    created = db.Column(db.DateTime,
-                     default=lambda: datetime.utcnow().replace(microsecond=0))
+    created = db.Column(db.DateTime, default=default_created)
 
     # Date this subscription is terminated
-    expiration = db.Column(db.DateTime,
-            default=lambda: (datetime.utcnow()+timedelta(days=30)).replace(microsecond=0))
+    expiration = db.Column(db.DateTime, default=default_expiration)
 
     #
     state = db.Column(db.Enum(SubscriptionState),
@@ -97,6 +105,9 @@ class Callback(db.Model):
     # Callback was acknowledged
     acknowledged = db.Column(db.Boolean, default=False)
 
+    # Transaction was confirmed, False when it was seen in the mempool
+    confirmed = db.Column(db.Boolean, default=True)
+
     def to_request(self, sign_key=None):
         """Generate json callback request
 
@@ -123,7 +134,8 @@ class Callback(db.Model):
             'id': callback_data.id,
             'subscription_id': callback_data.subscription.id,
             'txid': callback_data.txid,
-            'amount': callback_data.amount}
+            'amount': callback_data.amount,
+            'confirmed': callback_data.confirmed}
 
         cb_kwargs.update(kwargs)
 
@@ -139,4 +151,68 @@ class Block(db.Model):
     # Height for the last monitored block
     block_number = db.Column(db.Integer) 
 
-    #
+    # Running rescan checkpoint, next block to scan, last block and
+    # comma separated subscription ids (NULL when there is no rescan)
+    rescan_block = db.Column(db.Integer, nullable=True)
+    rescan_end = db.Column(db.Integer, nullable=True)
+    rescan_subscriptions = db.Column(db.Text, nullable=True)
+
+
+class Outpoint(db.Model):
+    """Unspent transaction outputs paying to monitored addresses"""
+    __tablename__ = 'outpoints'
+
+    # Transaction hash (hexadecimal) and output number
+    txid = db.Column(db.String(64), primary_key=True)
+    n = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+    # Output address and value in satoshis
+    address = db.Column(db.String(40))
+    value = db.Column(db.BigInteger)
+
+    
+
+
+# Columns added to tables that may have been created by previous versions,
+# and the value set for the existing rows (None to leave them NULL).
+ADDED_COLUMNS = (
+    (Callback, 'confirmed', True),
+    (Block, 'rescan_block', None),
+    (Block, 'rescan_end', None),
+    (Block, 'rescan_subscriptions', None))
+
+
+def upgrade_schema(engine):
+    """Add the columns missing from existing tables, create_all() only
+    creates the missing tables.
+
+    Arguments:
+        engine (sqlalchemy.engine.Engine):
+
+    Returns:
+        list: Added columns ['table.column', ...]
+    """
+    inspector = sqlalchemy.inspect(engine)
+    tables = set(inspector.get_table_names())
+    columns = {}
+
+    added = []
+    for model, name, value in ADDED_COLUMNS:
+        table = model.__table__
+        if table.name not in tables:
+            continue
+
+        if table.name not in columns:
+            columns[table.name] = set(c['name'] for c in inspector.get_columns(table.name))
+        if name in columns[table.name]:
+            continue
+
+        column = table.c[name]
+        with engine.begin() as conn:
+            conn.execute("ALTER TABLE {} ADD COLUMN {} {}".format(
+                table.name, column.name, column.type.compile(dialect=engine.dialect)))
+            if value is not None:
+                conn.execute(table.update().values({name: value}))
+        added.append('{}.{}'.format(table.name, name))
+
+    return added
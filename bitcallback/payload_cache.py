@@ -0,0 +1,126 @@
+"""
+payload_cache
+
+Serialized callback requests kept in memory by the callback manager, so
+they don't have to be rebuilt from the DB for each retry.
+"""
+from collections import OrderedDict
+import json
+
+from bitcallback.fields import IsoDateTime
+
+# Default max cache memory usage in bytes
+DEFAULT_PAYLOAD_CACHE_BYTES = 32*1024*1024
+
+# Estimated memory used by each entry besides its payload and url (dict
+# slot, key, tuple and bytes objects)
+ENTRY_OVERHEAD = 250
+
+# Request fields updated each time the callback is sent, they are appended
+# to the cached payload when it's rendered.
+RETRY_FIELDS = ('last_retry', 'retries')
+
+_last_retry_field = IsoDateTime()
+
+
+def build_payload(request):
+    """Serialize callback request without its retry fields
+
+    Arguments:
+        request (dict): Callback.to_request()
+
+    Returns:
+        bytes: Request JSON object, missing the closing brace
+    """
+    request = {key: value for key, value in request.items() if key not in RETRY_FIELDS}
+    return json.dumps(request).encode('utf-8')[:-1]
+
+def render_payload(payload, last_retry, retries):
+    """Complete payload from build_payload with the retry fields
+
+    Arguments:
+        payload (bytes):
+        last_retry (datetime.datetime):
+        retries (int):
+
+    Returns:
+        bytes: Request body
+    """
+    fields = ', "last_retry": {}, "retries": {}}}'.format(
+        json.dumps(_last_retry_field.format(last_retry)), int(retries))
+    return payload+fields.encode('utf-8')
+
+
+class PayloadCache(object):
+    """Callback payloads and urls LRU cache, limited by memory usage.
+    Evicted entries have to be rebuilt from the DB."""
+
+    def __init__(self, max_bytes=DEFAULT_PAYLOAD_CACHE_BYTES):
+        """
+        Arguments:
+            max_bytes (int): Max estimated memory used by the cache
+        """
+        self._cache = OrderedDict()
+        self._max_bytes = max_bytes
+
+        # Estimated memory used
+        self._size = 0
+
+        # Lookups found in the cache, or missing because they were evicted
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(entry):
+        payload, url = entry
+        return ENTRY_OVERHEAD+len(payload)+len(url)
+
+    def put(self, callback_id, payload, url):
+        """Insert callback payload, discarding the least recently used
+        until it fits.
+
+        Arguments:
+            callback_id (str):
+            payload (bytes): build_payload() output
+            url (str): Callback url
+        """
+        self.discard(callback_id)
+        entry = (payload, url)
+        self._cache[callback_id] = entry
+        self._size += self._entry_size(entry)
+
+        while self._size > self._max_bytes and self._cache:
+            _, evicted = self._cache.popitem(last=False)
+            self._size -= self._entry_size(evicted)
+            self.evictions += 1
+
+    def get(self, callback_id):
+        """
+        Returns:
+            tuple|None: (payload, url) or None if it isn't cached
+        """
+        entry = self._cache.get(callback_id, None)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._cache.move_to_end(callback_id)
+        return entry
+
+    def discard(self, callback_id):
+        entry = self._cache.pop(callback_id, None)
+        if entry is not None:
+            self._size -= self._entry_size(entry)
+
+    @property
+    def size(self):
+        """Estimated memory used in bytes"""
+        return self._size
+
+    def __contains__(self, callback_id):
+        return callback_id in self._cache
+
+    def __len__(self):
+        return len(self._cache)
@@ -0,0 +1,104 @@
+"""
+retry_schedule
+
+Schedule of callback delivery attempts ordered by next attempt time.
+"""
+import heapq
+import itertools
+
+# Min number of removed entries before the heap is compacted
+MIN_COMPACT_SIZE = 1024
+
+
+class RetrySchedule(object):
+    """Keys ordered by next attempt time in a heap, so scheduling and
+    taking the next due key is O(log n). Removed and rescheduled keys leave
+    their old entry in the heap, it's skipped once it reaches the top, or
+    all of them are dropped when they outnumber the scheduled keys.
+
+    It isn't thread safe, the owner must hold its lock."""
+
+    def __init__(self):
+        # Heap of (when, seq, key), seq keeps keys scheduled at the same
+        # time in FIFO order.
+        self._heap = []
+        self._seq = itertools.count()
+
+        # Current entry for each scheduled key {key: (when, seq)}
+        self._scheduled = {}
+
+    def _is_live(self, entry):
+        when, seq, key = entry
+        return self._scheduled.get(key, None) == (when, seq)
+
+    def _prune(self):
+        """Discard removed entries from the top of the heap"""
+        heap = self._heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+
+    def _compact(self):
+        """Rebuild the heap when removed entries outnumber the live ones"""
+        if len(self._heap) > max(2*len(self._scheduled), MIN_COMPACT_SIZE):
+            self._heap = [(when, seq, key) for key, (when, seq) in self._scheduled.items()]
+            heapq.heapify(self._heap)
+
+    def schedule(self, key, when):
+        """Schedule key attempt, replacing any previous one
+
+        Arguments:
+            key (hashable):
+            when (datetime.datetime): Next attempt time
+        """
+        seq = next(self._seq)
+        self._scheduled[key] = (when, seq)
+        heapq.heappush(self._heap, (when, seq, key))
+        self._compact()
+
+    def discard(self, key):
+        """Remove key from the schedule, its entry is removed from the
+        heap lazily.
+
+        Returns:
+            bool: True if the key was scheduled
+        """
+        if self._scheduled.pop(key, None) is None:
+            return False
+        self._compact()
+        return True
+
+    def next_due(self):
+        """
+        Returns:
+            datetime.datetime|None: Next attempt time, None if empty
+        """
+        self._prune()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """Remove and return the first key due at now
+
+        Arguments:
+            now (datetime.datetime):
+
+        Returns:
+            hashable|None: None if there isn't any key due
+        """
+        self._prune()
+        if not self._heap or self._heap[0][0] > now:
+            return None
+
+        _, _, key = heapq.heappop(self._heap)
+        del self._scheduled[key]
+        return key
+
+    @property
+    def heap_size(self):
+        """Number of heap entries, including removed ones"""
+        return len(self._heap)
+
+    def __contains__(self, key):
+        return key in self._scheduled
+
+    def __len__(self):
+        return len(self._scheduled)
@@ -0,0 +1,145 @@
+"""
+snapshot
+
+Compact binary snapshot of the bitmon task in memory state (subscriptions
+with their expiration, current block and TxOutCache entries), so it can be
+restored on startup without rebuilding it from the database and bitcoind.
+
+File layout:
+    header: magic, block number, subscription count, txout entry count,
+        txout entries offset
+    subscriptions: record (id, expiration, address key type, address key
+        length, url length) followed by the address key (scriptPubKey or
+        utf-8 address) and url utf-8 encoded
+    txouts: record (txid, entry length) followed by the packed outputs
+"""
+import mmap
+import os
+import struct
+
+# Default seconds between snapshots while running
+DEFAULT_SNAPSHOT_INTERVAL = 600
+
+# Snapshot format identifier and version
+MAGIC = b'BCBSNAP2'
+
+HEADER = struct.Struct('<8sqQQQ')
+SUBSCRIPTION_RECORD = struct.Struct('<qqBHH')
+TXOUT_RECORD = struct.Struct('<32sI')
+
+# Subscription address key types
+KEY_SCRIPT = 0
+KEY_ADDRESS = 1
+
+
+def write_snapshot(path, block_number, subscriptions, txouts):
+    """Write snapshot file, it's written into a temporary file and then
+    renamed so an existing snapshot is never left half written.
+
+    Arguments:
+        path (str): Snapshot file
+        block_number (int): Current block
+        subscriptions (iterable): Active subscriptions records (id, address
+            key, callback_url, expiration microseconds)
+        txouts (iterable): TxOutCache entries [(txid, bytearray), ...]
+    """
+    tmp_path = path+'.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(bytes(HEADER.size))
+
+        nsubs = 0
+        for sub_id, key, callback_url, expiration in subscriptions:
+            if isinstance(key, str):
+                key_type, key = KEY_ADDRESS, key.encode('utf-8')
+            else:
+                key_type = KEY_SCRIPT
+            callback_url = callback_url.encode('utf-8')
+            f.write(SUBSCRIPTION_RECORD.pack(sub_id, expiration, key_type,
+                                             len(key), len(callback_url)))
+            f.write(key)
+            f.write(callback_url)
+            nsubs += 1
+
+        txouts_offset = f.tell()
+        ntxouts = 0
+        for txid, entry in txouts:
+            f.write(TXOUT_RECORD.pack(txid, len(entry)))
+            f.write(entry)
+            ntxouts += 1
+
+        # The header is written last, an incomplete file has no magic
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, block_number, nsubs, ntxouts, txouts_offset))
+
+    os.replace(tmp_path, path)
+
+
+class Snapshot(object):
+    """Memory mapped snapshot file, records are decoded as they are read"""
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path (str): Snapshot file
+
+        Raises:
+            OSError: The file couldn't be read
+            ValueError: Not a valid snapshot
+        """
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < HEADER.size:
+                raise ValueError("Snapshot too short")
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.block_number, self._nsubs, self._ntxouts, self._txouts_offset = \
+                HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or self._txouts_offset > len(self._mmap):
+            self.close()
+            raise ValueError("Invalid snapshot")
+
+    def subscriptions(self):
+        """Generate snapshot subscription records
+
+        Returns:
+            generator: (id, address key, callback_url, expiration microseconds)
+        """
+        data = self._mmap
+        offset = HEADER.size
+        try:
+            for _ in range(self._nsubs):
+                sub_id, expiration, key_type, key_len, url_len = \
+                        SUBSCRIPTION_RECORD.unpack_from(data, offset)
+                offset += SUBSCRIPTION_RECORD.size
+                if offset+key_len+url_len > len(data):
+                    raise struct.error("record exceeds file size")
+                key = data[offset:offset+key_len]
+                if key_type == KEY_ADDRESS:
+                    key = key.decode('utf-8')
+                offset += key_len
+                callback_url = data[offset:offset+url_len].decode('utf-8')
+                offset += url_len
+                yield sub_id, key, callback_url, expiration
+        except struct.error as err:
+            raise ValueError("Truncated snapshot: {}".format(err))
+
+    def txouts(self):
+        """Generate snapshot TxOutCache entries
+
+        Returns:
+            generator: (txid, bytearray)
+        """
+        data = self._mmap
+        offset = self._txouts_offset
+        try:
+            for _ in range(self._ntxouts):
+                txid, length = TXOUT_RECORD.unpack_from(data, offset)
+                offset += TXOUT_RECORD.size
+                if offset+length > len(data):
+                    raise struct.error("entry exceeds file size")
+                yield txid, bytearray(data[offset:offset+length])
+                offset += length
+        except struct.error as err:
+            raise ValueError("Truncated snapshot: {}".format(err))
+
+    def close(self):
+        self._mmap.close()
@@ -0,0 +1,253 @@
+"""
+subscription_table
+
+Compact storage for the active subscriptions of the bitmon task.
+"""
+from array import array
+import datetime
+import sys
+
+from bitcallback.commands import SubscriptionData
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Marks the end of an address subscription list, or a free row
+NO_ROW = -1
+
+# Subscription ids per page of the row index
+PAGE_BITS = 10
+PAGE_SIZE = 1 << PAGE_BITS
+PAGE_MASK = PAGE_SIZE-1
+
+
+def to_micros(when):
+    """Convert datetime into microseconds since epoch"""
+    delta = when-EPOCH
+    return (delta.days*86400+delta.seconds)*1000000+delta.microseconds
+
+def from_micros(micros):
+    return EPOCH+datetime.timedelta(microseconds=micros)
+
+
+class SubscriptionTable(object):
+    """Subscriptions stored by row in parallel arrays, instead of an object
+    for each one. Addresses are stored as AddressRegistry ids, and rows for
+    the same address are linked in a doubly linked list so they can be
+    found, and removed, without scanning the table. SubscriptionData is
+    only built when a subscription is read.
+
+    Rows are indexed by subscription id in pages of PAGE_SIZE ids, database
+    ids are sequential so the active ones are packed in a few pages, and
+    pages are released once all their subscriptions are removed."""
+
+    def __init__(self, registry):
+        """
+        Arguments:
+            registry (AddressRegistry): Registry where the address ids are
+                allocated, used to convert them back into addresses.
+        """
+        self._registry = registry
+
+        # Row index pages {id >> PAGE_BITS: array(row)}, and number of
+        # subscriptions in each page
+        self._pages = {}
+        self._page_counts = {}
+        self._count = 0
+
+        # Subscription columns
+        self._ids = array('q')
+        self._addr_ids = array('i')
+        self._expirations = array('q')
+        self._callback_urls = []
+
+        # Previous and next row with the same address
+        self._prev = array('i')
+        self._next = array('i')
+
+        # First row for each address id
+        self._first = array('i')
+
+        # Removed rows available for reuse
+        self._free = []
+
+    def add(self, sub_id, addr_id, callback_url, expiration):
+        """Add subscription, it must not be already in the table
+
+        Arguments:
+            sub_id (int): Subscription id
+            addr_id (int): Address id, already acquired from the registry
+            callback_url (str):
+            expiration (int): Expiration in microseconds since epoch
+
+        Returns:
+            int: Subscription row, valid until it's removed
+        """
+        if self._free:
+            row = self._free.pop()
+            self._ids[row] = sub_id
+            self._addr_ids[row] = addr_id
+            self._expirations[row] = expiration
+            self._callback_urls[row] = sys.intern(callback_url)
+        else:
+            row = len(self._ids)
+            self._ids.append(sub_id)
+            self._addr_ids.append(addr_id)
+            self._expirations.append(expiration)
+            self._callback_urls.append(sys.intern(callback_url))
+            self._prev.append(NO_ROW)
+            self._next.append(NO_ROW)
+
+        if addr_id >= len(self._first):
+            self._first.extend([NO_ROW]*(addr_id+1-len(self._first)))
+
+        # Insert at the start of the address list
+        head = self._first[addr_id]
+        self._prev[row] = NO_ROW
+        self._next[row] = head
+        if head != NO_ROW:
+            self._prev[head] = row
+        self._first[addr_id] = row
+
+        page_no = sub_id >> PAGE_BITS
+        page = self._pages.get(page_no, None)
+        if page is None:
+            page = self._pages[page_no] = array('i', [NO_ROW])*PAGE_SIZE
+            self._page_counts[page_no] = 0
+        page[sub_id & PAGE_MASK] = row
+        self._page_counts[page_no] += 1
+        self._count += 1
+        return row
+
+    def row(self, sub_id):
+        """
+        Returns:
+            int: Subscription row or NO_ROW if not found
+        """
+        page = self._pages.get(sub_id >> PAGE_BITS, None)
+        return page[sub_id & PAGE_MASK] if page is not None else NO_ROW
+
+    def _live_rows(self):
+        """Generate the rows in use"""
+        addr_ids = self._addr_ids
+        for row in range(len(addr_ids)):
+            if addr_ids[row] != NO_ROW:
+                yield row
+
+    def remove(self, sub_id):
+        """Remove subscription
+
+        Arguments:
+            sub_id (int): Subscription id
+
+        Returns:
+            SubscriptionData|None: The removed subscription or None if
+                it wasn't found.
+        """
+        row = self.row(sub_id)
+        if row == NO_ROW:
+            return None
+
+        page_no = sub_id >> PAGE_BITS
+        self._pages[page_no][sub_id & PAGE_MASK] = NO_ROW
+        self._page_counts[page_no] -= 1
+        if not self._page_counts[page_no]:
+            del self._pages[page_no]
+            del self._page_counts[page_no]
+        self._count -= 1
+
+        subscription = self._read(row)
+
+        addr_id = self._addr_ids[row]
+        prev_row, next_row = self._prev[row], self._next[row]
+        if prev_row != NO_ROW:
+            self._next[prev_row] = next_row
+        else:
+            self._first[addr_id] = next_row
+        if next_row != NO_ROW:
+            self._prev[next_row] = prev_row
+
+        self._addr_ids[row] = NO_ROW
+        self._callback_urls[row] = None
+        self._free.append(row)
+        return subscription
+
+    def _read(self, row):
+        return SubscriptionData(self._ids[row],
+                                self._registry.address(self._addr_ids[row]),
+                                self._callback_urls[row],
+                                from_micros(self._expirations[row]))
+
+    def id(self, row):
+        """
+        Returns:
+            int: Subscription id stored in the row
+        """
+        return self._ids[row]
+
+    def address_id(self, sub_id):
+        """
+        Returns:
+            int: Subscription address id
+
+        Raises:
+            KeyError: Subscription not found
+        """
+        row = self.row(sub_id)
+        if row == NO_ROW:
+            raise KeyError(sub_id)
+        return self._addr_ids[row]
+
+    def get(self, sub_id):
+        """
+        Returns:
+            SubscriptionData|None: None if not found
+        """
+        row = self.row(sub_id)
+        return self._read(row) if row != NO_ROW else None
+
+    def by_address(self, addr_id):
+        """Generate all the subscriptions for an address
+
+        Arguments:
+            addr_id (int): Address id
+
+        Returns:
+            generator: SubscriptionData
+        """
+        if addr_id >= len(self._first):
+            return
+
+        row = self._first[addr_id]
+        while row != NO_ROW:
+            yield self._read(row)
+            row = self._next[row]
+
+    def records(self):
+        """Generate raw records for all subscriptions, without converting
+        the address and expiration.
+
+        Returns:
+            generator: (id, address key, callback_url, expiration microseconds)
+        """
+        registry = self._registry
+        for row in self._live_rows():
+            yield (self._ids[row], registry.key(self._addr_ids[row]),
+                   self._callback_urls[row], self._expirations[row])
+
+    def max_id(self):
+        if not self._pages:
+            return 0
+        page_no = max(self._pages)
+        page = self._pages[page_no]
+        offset = max(n for n in range(PAGE_SIZE) if page[n] != NO_ROW)
+        return (page_no << PAGE_BITS)+offset
+
+    def __iter__(self):
+        for row in self._live_rows():
+            yield self._read(row)
+
+    def __contains__(self, sub_id):
+        return self.row(sub_id) != NO_ROW
+
+    def __len__(self):
+        return self._count
@@ -21,14 +21,43 @@ def iso8601(time):
     except Exception:
         raise ValueError('{} is not a valid ISO 8601 format'.format(time))
 
-def BitcoinAddress(address):
-    """Bitcoin address validation accepts both testnet and mainnet"""
+def _is_valid_address(address):
     try:
         assert isinstance(address, str)
         assert 25 < len(address) < 36
         addr = CBase58Data(address)
         assert addr.nVersion in BITCOIN_VERSION_BYTES
-        return address
+        return True
     except Exception:
+        return False
+
+def BitcoinAddress(address):
+    """Bitcoin address validation accepts both testnet and mainnet"""
+    if not _is_valid_address(address):
         raise ValueError('{} is not a valid bitcoin address'.format(address))
+    return address
+
+def BitcoinAddresses(addresses):
+    """Batch BitcoinAddress validation, each distinct address is only
+    decoded once.
+
+    Arguments:
+        addresses (list): Addresses to validate
+
+    Returns:
+        list: True for each valid address, False otherwise
+    """
+    valid = {}
+    result = []
+    for address in addresses:
+        if not isinstance(address, str):
+            result.append(False)
+            continue
+
+        is_valid = valid.get(address, None)
+        if is_valid is None:
+            is_valid = valid[address] = _is_valid_address(address)
+        result.append(is_valid)
+
+    return result
 
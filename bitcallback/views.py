@@ -5,16 +5,18 @@ App JSON field views
 """
 
 from copy import copy
+import json
 import pickle
 
 from bitcallback import app
 
-from flask import abort
-from flask_restplus import Resource, Api, reqparse, marshal_with, inputs
+from flask import abort, request
+from flask_restplus import Resource, Api, reqparse, marshal, marshal_with, inputs
 
-from .models import db, Subscription, Callback, SubscriptionState
+from .models import (db, Block, Subscription, Callback, SubscriptionState,
+                     default_created, default_expiration)
 from .commands import *
-from .types import BitcoinAddress, iso8601
+from .types import BitcoinAddress, BitcoinAddresses, iso8601
 from .common import unique_id
 from .marshalling import (subscription_fields, subscription_list_fields,
                           callback_fields, callback_list_fields)
@@ -26,6 +28,12 @@ api = Api(app)
 DEFAULT_PER_PAGE = 10
 DEFAULT_PAGE = 1
 
+# Max number of subscriptions created with a single bulk request
+MAX_BULK_SUBSCRIPTIONS = 50000
+
+# Content types accepted for NDJSON streams, with a subscription per line
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+
 def lower_bool(abool):
     """Convert booleans to lowercase string"""
     return str(abool).lower() if isinstance(abool, bool) else abool
@@ -226,9 +234,147 @@ class SubscriptionList(Resource):
 
         # Send new subscription message to bitcoin monitor task
         subscription_data = subs.to_subscription_data()
-        app.bitmon_task.new_subscripition(subscription_data)
+        app.bitmon_task.new_subscription(subscription_data)
         return subs
 
+
+def parse_bulk_subscriptions():
+    """Parse bulk subscription request body, either a JSON array or a NDJSON
+    stream with a subscription object per line.
+
+    Returns:
+        list: Subscriptions, or the ValueError for NDJSON lines that
+            couldn't be decoded.
+    """
+    if request.mimetype in NDJSON_MIMETYPES:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as err:
+                items.append(err)
+        return items
+
+    items = request.get_json(silent=True)
+    if not isinstance(items, list):
+        abort(400, "Expected a JSON array or NDJSON stream of subscriptions")
+    return items
+
+def validate_bulk_subscription(item, valid_address):
+    """Validate bulk subscription fields, except the address which is
+    validated for all the subscriptions at once.
+
+    Arguments:
+        item (dict|ValueError): Parsed subscription
+        valid_address (bool): Result of the address validation
+
+    Returns:
+        dict: Subscription column values
+
+    Raises:
+        ValueError: Invalid subscription
+    """
+    if isinstance(item, ValueError):
+        raise ValueError("Invalid JSON: {}".format(item))
+    if not isinstance(item, dict):
+        raise ValueError("Subscription must be a JSON object")
+
+    for field in ('address', 'callback_url'):
+        if item.get(field, None) is None:
+            raise ValueError("Missing required field {}".format(field))
+
+    if not valid_address:
+        raise ValueError('{} is not a valid bitcoin address'.format(item['address']))
+
+    # Checked before parsing, the parsers only handle strings
+    for field in ('callback_url', 'expiration'):
+        if item.get(field, None) is not None and not isinstance(item[field], str):
+            raise ValueError("Field {} must be a string".format(field))
+
+    expiration = item.get('expiration', None)
+    return {'address': item['address'],
+            'callback_url': inputs.url(item['callback_url']),
+            'expiration': iso8601(expiration) if expiration is not None else None}
+
+
+def insert_subscriptions(mappings):
+    """Insert subscriptions and set the id of each mapping from the insert
+    itself. With a single multi-row INSERT ... RETURNING where the database
+    supports it, otherwise the ORM inserts them when flushed.
+
+    Arguments:
+        mappings (list): Subscription column values, in insertion order
+    """
+    if db.session.get_bind().dialect.implicit_returning:
+        insert = Subscription.__table__.insert().values(mappings)\
+            .returning(Subscription.__table__.c.id)
+        ids = [row[0] for row in db.session.execute(insert)]
+    else:
+        subscriptions = [Subscription(**mapping) for mapping in mappings]
+        db.session.add_all(subscriptions)
+        db.session.flush()
+        ids = [subs.id for subs in subscriptions]
+
+    for mapping, subs_id in zip(mappings, ids):
+        mapping['id'] = subs_id
+
+
+@subscription_ns.route('/bulk')
+class SubscriptionBulk(Resource):
+    """Create several subscriptions with a single request (POST)"""
+
+    def post(self):
+        """Create new subscriptions from a JSON array or NDJSON stream, the
+        valid ones are created even if others are rejected. The result for
+        each one is returned in the same order they were received."""
+        items = parse_bulk_subscriptions()
+        if len(items) > MAX_BULK_SUBSCRIPTIONS:
+            abort(413, "Max {} subscriptions per request".format(MAX_BULK_SUBSCRIPTIONS))
+
+        # Duplicated addresses are only decoded once
+        valid_addresses = BitcoinAddresses([item.get('address', None) if isinstance(item, dict)
+                                            else None for item in items])
+
+        created = default_created()
+        expiration = default_expiration()
+
+        results = []
+        mappings = []
+        for index, (item, valid_address) in enumerate(zip(items, valid_addresses)):
+            try:
+                mapping = validate_bulk_subscription(item, valid_address)
+            except ValueError as err:
+                results.append({'index': index, 'error': str(err)})
+                continue
+
+            mapping['created'] = created
+            if mapping['expiration'] is None:
+                mapping['expiration'] = expiration
+            mapping['state'] = SubscriptionState.active
+            mappings.append(mapping)
+            results.append({'index': index, 'subscription': mapping})
+
+        if not mappings:
+            return {'created': 0, 'errors': len(results), 'results': results}, 400
+
+        # Inserted in a single transaction, the ids are set in the mappings
+        insert_subscriptions(mappings)
+        db.session.commit()
+
+        # Send all the subscriptions to bitcoin monitor task at once
+        app.bitmon_task.new_subscriptions(
+                SubscriptionData(m['id'], m['address'], m['callback_url'], m['expiration'])
+                for m in mappings)
+
+        for result in results:
+            if 'subscription' in result:
+                result['subscription'] = marshal(result['subscription'], subscription_fields)
+
+        return {'created': len(mappings), 'errors': len(results)-len(mappings),
+                'results': results}, 201
+
 @subscription_ns.route('/<int:subscription_id>', endpoint='subscription_detail')
 class SubscriptionDetail(Resource):
     """Subscription details view"""
@@ -254,6 +400,63 @@ class SubscriptionDetail(Resource):
         return subs
 
 
+# Subscription rescan parser POST
+subscription_rescan_parser = reqparse.RequestParser()
+
+subscription_rescan_parser.add_argument('start_block',
+                                        dest='start_block',
+                                        required=True,
+                                        type=inputs.natural,
+                                        help='First block height')
+
+subscription_rescan_parser.add_argument('end_block',
+                                        dest='end_block',
+                                        required=False,
+                                        type=inputs.natural,
+                                        help='Last block height (default last monitored)')
+
+
+def last_monitored_block():
+    """Last block height processed by the bitmon task
+
+    Returns:
+        int|None: None if it hasn't processed any block yet
+    """
+    block = Block.query.first()
+    if block is None or block.block_number is None:
+        return None
+    return block.block_number-app.config['BITCOIN_CONF']['CONFIRMATIONS']
+
+
+@subscription_ns.route('/<int:subscription_id>/rescan')
+class SubscriptionRescan(Resource):
+    """Scan past blocks for transactions involving the subscription address"""
+
+    @marshal_with(subscription_fields)
+    @api.expect(subscription_rescan_parser, validate=True)
+    def post(self, subscription_id):
+        """Rescan subscription address"""
+        subs = Subscription.query.get_or_404(subscription_id)
+        args = subscription_rescan_parser.parse_args()
+
+        start_block, end_block = args['start_block'], args['end_block']
+        if end_block is not None and end_block < start_block:
+            abort(400)
+
+        # Only blocks already monitored can be rescanned, the bitmon task
+        # checks it again against the blockchain.
+        last_block = last_monitored_block()
+        if last_block is not None and max(start_block, end_block or 0) > last_block:
+            abort(400)
+
+        if subs.state != SubscriptionState.active:
+            abort(409)
+
+        # Send rescan message to bitcoin monitor task
+        app.bitmon_task.rescan([subs.id], start_block, end_block)
+        return subs, 202
+
+
 
 
 
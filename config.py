@@ -52,6 +52,79 @@ BITCOIN_CONF = {
     # 'last'-> Continue where the last execution stoped
     # 'newest'-> Newest block
     'START_BLOCK': 'last',
+
+    # Max number of blocks processed on each update while catching up
+    # with the blockchain (None for no limit)
+    'MAX_BLOCKS_PER_POLL': 100,
+
+    # Max number of calls sent to bitcoind in a single JSON-RPC batch request
+    'RPC_BATCH_SIZE': 500,
+
+    # Number of connections used to request the outputs spent by each
+    # block concurrently (1 to use a single connection)
+    'RPC_CONNECTIONS': 4,
+
+    # Resolve transaction inputs with getrawtransaction when they aren't
+    # found in the index of outputs for monitored addresses. Disabling it
+    # removes almost all RPC traffic, but spends of coins received before
+    # an address was subscribed are no longer reported.
+    'TXOUT_CACHE': True,
+
+    # Max memory used by the transaction output cache in bytes
+    'TXOUT_CACHE_BYTES': 32*1024*1024,
+
+    # sqlite file where transaction outputs evicted from memory are kept,
+    # so the cache survives reconnects and restarts (None to disable)
+    'TXOUT_DISK_CACHE': None,
+
+    # Max transaction output disk cache size in bytes
+    'TXOUT_DISK_CACHE_BYTES': 512*1024*1024,
+
+    # File where subscriptions, current block and transaction output cache
+    # are saved on exit, and periodically, so they are restored on startup
+    # without reloading them (None to disable)
+    'SNAPSHOT_FILE': None,
+
+    # Seconds between snapshots while running
+    'SNAPSHOT_INTERVAL': 600,
+
+    # Max number of queued commands (new/cancelled subscriptions...)
+    # processed at once, before the next bitcoind update.
+    'COMMAND_BATCH_SIZE': 10000,
+
+    # Resolve transaction inputs with the spent outputs returned by getblock
+    # when bitcoind supports it (v23.0 or newer), instead of TXOUT_CACHE.
+    'BLOCK_PREVOUTS': True,
+
+    # Number of blocks downloaded ahead, in a background thread, while the
+    # current one is processed (0 to disable)
+    'PREFETCH_BLOCKS': 4,
+
+    # New block notifications endpoint, bitcoind -zmqpubhashblock address
+    # (tcp://127.0.0.1:28332, requires pyzmq) or unix://path for a local
+    # UnixBlockPublisher. None to poll bitcoind for new blocks.
+    'BLOCK_NOTIFY_URL': None,
+
+    # Seconds between polls, as fallback, when notifications are enabled
+    'NOTIFY_UPDATE_PERIOD': 60,
+
+    # Send callbacks for transactions as soon as they are seen in the mempool,
+    # with confirmed false, besides the ones sent once confirmed.
+    'MEMPOOL': False,
+
+    # Seconds between mempool polls
+    'MEMPOOL_UPDATE_PERIOD': 5,
+
+    # Max number of mempool transactions kept decoded, so their inputs
+    # don't have to be resolved again when they are confirmed.
+    'MEMPOOL_DECODED_SIZE': 50000,
+
+    # Number of worker processes, each with its own bitcoind connection,
+    # used to rescan past blocks.
+    'RESCAN_WORKERS': 4,
+
+    # Number of consecutive blocks scanned by each rescan worker task
+    'RESCAN_CHUNK_SIZE': 10,
     }
 
 
@@ -70,5 +143,25 @@ CALLBACK_CONF = {
     # Number of callback sending threads 
     'NTHREADS': 4,
 
+    # Delivery engine, 'threads' sends one callback at a time from each
+    # of the NTHREADS threads, 'asyncio' sends up to CONCURRENCY callbacks
+    # at once from an event loop.
+    'ENGINE': 'threads',
+
+    # Max concurrent callback requests with the asyncio engine
+    'CONCURRENCY': 1000,
+
+    # Max idle keep-alive connections kept for each callback host, and
+    # seconds before they are closed (threads engine)
+    'POOL_SIZE': 4,
+    'POOL_IDLE_TIMEOUT': 30,
+
+    # Seconds callback host addresses are cached
+    'DNS_TTL': 60,
+
+    # Max memory used by cached callback payloads (bytes), the rest are
+    # rebuilt from the DB each time they are sent.
+    'PAYLOAD_CACHE_BYTES': 32*1024*1024,
+
     # Default callback POST url
     'POST_URL': "http://localhost:8080"}
@@ -0,0 +1,87 @@
+from unittest import TestCase
+import asyncio
+import json
+import queue
+import threading
+from time import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from bitcallback import async_http
+from bitcallback.async_pool import AsyncPool
+
+
+class TestAsyncPool(TestCase):
+
+    @staticmethod
+    async def sleep_func(job, q, running):
+        running.append(job)
+        q.put(len(running))
+        await asyncio.sleep(0.05)
+        running.remove(job)
+
+    def test_concurrency(self):
+        """Test jobs run concurrently up to the concurrency limit"""
+        q = queue.Queue()
+        pool = AsyncPool(concurrency=10, func=TestAsyncPool.sleep_func, args=(q, []))
+
+        start = time()
+        for i in range(40):
+            pool.add_job(i)
+        running = [q.get(timeout=1) for _ in range(40)]
+        pool.close(now=False)
+
+        self.assertEqual(max(running), 10)
+        self.assertLess(time()-start, 0.5)
+
+    def test_queue_length(self):
+        """Test add_job raises queue.Full when all slots are taken"""
+        pool = AsyncPool(concurrency=2, func=TestAsyncPool.sleep_func,
+                         args=(queue.Queue(), []), maxlen=3)
+
+        with self.assertRaises(queue.Full):
+            for i in range(30):
+                pool.add_job(i, block=False)
+
+        self.assertEqual(i, 5)
+        pool.close()
+
+        with self.assertRaises(queue.Full):
+            pool.add_job(1)
+
+
+class TestAsyncHttp(TestCase):
+
+    def setUp(self):
+        self.requests = queue.Queue()
+        requests = self.requests
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                requests.put((self.path, self.headers['Host'],
+                              json.loads(self.rfile.read(length).decode())))
+                self.send_response(201)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = HTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.handle_request, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.server_close()
+
+    def test_post(self):
+        url = 'http://127.0.0.1:{}/callback?a=1'.format(self.port)
+        status = asyncio.run(async_http.post(url, json={'amount': 44}, timeout=1))
+
+        self.assertEqual(status, 201)
+        self.assertEqual(self.requests.get(timeout=1),
+                         ('/callback?a=1', '127.0.0.1:{}'.format(self.port), {'amount': 44}))
+
+    def test_invalid_url(self):
+        with self.assertRaises(async_http.HTTPError):
+            asyncio.run(async_http.post('ftp://127.0.0.1/', json={}))
@@ -1,10 +1,17 @@
+from collections import deque
 from datetime import datetime, timedelta
+import queue
+from types import SimpleNamespace
 from unittest import TestCase
 
-from bitcallback.commands import CallbackData, SubscriptionData
+from bitcallback.commands import (CallbackData, SubscriptionData, RescanData, EXIT_TASK,
+                                  NEW_SUBSCRIPTION, NEW_SUBSCRIPTIONS, CANCEL_SUBSCRIPTION,
+                                  RESCAN)
 from bitcallback.models import Callback, Subscription, SubscriptionState
 
-from bitcallback.bitmon_task import SubscriptionManager
+from bitcallback.bitmon.index import OutpointIndex
+from bitcallback.bitmon.registry import AddressRegistry
+from bitcallback.bitmon_task import BitmonTask, SubscriptionManager
 from bitcallback.database import make_session_scope
 
 from .database import create_memory_db
@@ -14,21 +21,39 @@ from .database import create_memory_db
 class MockTransactionMonitor(object):
 
     def __init__(self):
-        self.monitored = set()
+        self.registry = AddressRegistry()
+        self.discarded = []
         self.added = []
         self.deleted = []
+        self.current_block = 0
+        self.lag = 0
+        self.unconfirmed = []
 
     def get_confirmed(self):
         return []
 
-    def add_addr(self, addr):
-        self.monitored.add(addr)
+    def iter_confirmed(self):
+        return iter(self.get_confirmed())
 
-    def del_addr(self, addr):
-        self.monitored.remove(addr)
+    def get_unconfirmed(self):
+        transactions, self.unconfirmed = self.unconfirmed, []
+        return transactions
+
+    @property
+    def monitored(self):
+        return set(self.registry.addresses())
+
+    def set_registry(self, registry):
+        self.registry = registry
+
+    def discard_addr(self, addr):
+        self.discarded.append(addr)
+
+    def discard_addrs(self, addrs):
+        self.discarded.extend(addrs)
 
     def __len__(self):
-        return len(self.monitored)
+        return len(self.registry)
 
 class TestSubscriptionManager(TestCase):
     
@@ -74,6 +99,8 @@ class TestSubscriptionManager(TestCase):
 
         self.assertEqual(len(subscription_manager), 3)
         self.assertEqual(len(monitor), 2)
+        self.assertEqual(len(subscription_manager._expiration_table), 3)
+        self.assertIn(self.subs1.id, subscription_manager)
 
     def test_expired_are_discarded(self):
         """Test expired subscription are discarded and their state updated in DB"""
@@ -94,6 +121,160 @@ class TestSubscriptionManager(TestCase):
         self.assertEqual(len(subscription_manager), 2)
         self.assertEqual(len(monitor), 2)
 
+    def test_cancelled_are_unscheduled(self):
+        """Test cancelled subscriptions don't remain in the expiration table"""
+        monitor = MockTransactionMonitor()
+        subscription_manager = SubscriptionManager(monitor, self.db_session, False)
+        subscription_manager.add_subscription(self.com2)
+        subscription_manager.cancel_subscription(self.com2.id)
+
+        self.assertEqual(len(subscription_manager._expiration_table), 0)
+        self.assertEqual(subscription_manager._remove_expired_subscriptions(), [])
+
+    def test_cancel_subscriptions(self):
+        """Test addresses without subscriptions are discarded at once"""
+        monitor = MockTransactionMonitor()
+        subscription_manager = SubscriptionManager(monitor, self.db_session)
+        self.assertEqual(subscription_manager.next_expiration(),
+                         subscription_manager._expiration_table.next_expiration())
+
+        subscription_manager.cancel_subscriptions([self.subs1.id, self.subs4.id, 1000])
+        self.assertEqual(len(subscription_manager), 1)
+        self.assertEqual(monitor.discarded, [self.subs4.address])
+
+    def test_process_commands(self):
+        """Test queued commands are drained in a single batch, and
+        subscriptions added and cancelled within it are merged"""
+        monitor = MockTransactionMonitor()
+        subscription_manager = SubscriptionManager(monitor, self.db_session)
+
+        task = BitmonTask.__new__(BitmonTask)
+        task._settings = {'COMMAND_BATCH_SIZE': 4}
+        task._subscription_manager = subscription_manager
+        task._rescan_pending = deque()
+
+        input_q = queue.Queue()
+        for command in [(CANCEL_SUBSCRIPTION, self.subs1.id),
+                        (NEW_SUBSCRIPTION, self.com3),
+                        (CANCEL_SUBSCRIPTION, self.subs3.id),
+                        (RESCAN, RescanData([self.subs4.id], 10, None)),
+                        (EXIT_TASK, None)]:
+            input_q.put(command)
+
+        commands = task._get_commands(input_q, 0)
+        self.assertEqual(len(commands), 4)
+        self.assertFalse(task._process_commands(commands))
+        self.assertNotIn(self.subs1.id, subscription_manager)
+        self.assertNotIn(self.subs3.id, subscription_manager)
+        self.assertEqual(len(task._rescan_pending), 1)
+
+        self.assertTrue(task._process_commands(task._get_commands(input_q, 0)))
+        self.assertEqual(task._get_commands(input_q, 0), [])
+
+        # Bulk subscriptions
+        task._process_commands([(NEW_SUBSCRIPTIONS, [self.com1, self.com3])])
+        self.assertIn(self.subs1.id, subscription_manager)
+        self.assertIn(self.subs3.id, subscription_manager)
+
+    def rescan_task(self, current_block):
+        task = BitmonTask.__new__(BitmonTask)
+        task._settings = {'CONFIRMATIONS': 3}
+        task._db_session = self.db_session
+        task._current_block = current_block
+        task._monitor = SimpleNamespace(current_block=current_block)
+        task._rescan = None
+        task._rescan_subs = None
+        task._rescan_job = None
+        task._rescan_pending = deque()
+        return task
+
+    def test_rescan_range(self):
+        """Test rescans past the last monitored block are discarded"""
+        task = self.rescan_task(20)
+        task._rescan_pending.append(RescanData([self.subs1.id], 10, 18))
+        task._start_rescan()
+        self.assertIsNone(task._rescan_job)
+        self.assertIsNone(task._rescan)
+        self.assertEqual(len(task._rescan_pending), 0)
+
+        # Resumed checkpoint past the last block
+        task._rescan_job = RescanData([self.subs1.id], 10, 30)
+        task._save_rescan(task._rescan_job)
+        task._start_rescan()
+        self.assertIsNone(task._rescan_job)
+        self.assertIsNone(task._load_rescan())
+
+    def test_rescan_errors(self):
+        """Test rescans are resumed after connection errors, and discarded
+        after any other error"""
+        class FailingRescan(object):
+            def __init__(self, err):
+                self.err = err
+            def get(self):
+                raise self.err
+            def close(self):
+                pass
+
+        task = self.rescan_task(20)
+        job = RescanData([self.subs1.id], 10, 15)
+        task._rescan_job = job
+        task._save_rescan(job)
+
+        task._rescan = FailingRescan(ConnectionError("Lost"))
+        task._process_rescan()
+        self.assertIsNone(task._rescan)
+        self.assertEqual(task._rescan_job, job)
+        self.assertEqual(task._load_rescan(), job)
+
+        task._rescan = FailingRescan(IndexError("Block height out of range"))
+        task._process_rescan()
+        self.assertIsNone(task._rescan)
+        self.assertIsNone(task._rescan_job)
+        self.assertIsNone(task._load_rescan())
+
+    def test_poll_failure_rollback(self):
+        """Test outpoint index changes are discarded when polling fails
+        partway, as the blocks will be processed again"""
+        index = OutpointIndex()
+        index.load([(b'a', 0, self.subs1.address, 10)])
+
+        class FailingMonitor(MockTransactionMonitor):
+
+            def iter_confirmed(self):
+                index.spend(b'a', 0)
+                index.add(b'b', 0, 'n2SjFgAhHAv8PcTuq5x2e9sugcXDpMTzX7', 20)
+                raise ConnectionError("Lost")
+                yield
+
+            def close(self):
+                pass
+
+        monitor = FailingMonitor()
+        task = BitmonTask.__new__(BitmonTask)
+        task._subscription_manager = SubscriptionManager(monitor, self.db_session, False)
+        task._monitor = monitor
+        task._outpoint_index = index
+
+        task._send_confirmed()
+        self.assertIsNone(task._monitor)
+        self.assertEqual(index.get(b'a', 0), (self.subs1.address, 10))
+        self.assertIsNone(index.get(b'b', 0))
+        self.assertEqual(index.changes(), ({}, set()))
+
+    def test_poll_mempool(self):
+        """Test mempool transactions generate unconfirmed callbacks"""
+        monitor = MockTransactionMonitor()
+        subscription_manager = SubscriptionManager(monitor, self.db_session, False)
+        subscription_manager.add_subscription(self.com4)
+
+        monitor.unconfirmed = [SimpleNamespace(hash='aa'*32, tin={},
+                                               tout={self.subs4.address: 40})]
+        callbacks = subscription_manager.poll_mempool()
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(callbacks[0].amount, 40)
+        self.assertFalse(callbacks[0].confirmed)
+        self.assertEqual(subscription_manager.poll_mempool(), [])
+
     def test_cancel_subscription(self):
         """Test subscription cancelation"""
         monitor = MockTransactionMonitor()
@@ -0,0 +1,105 @@
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import CMutableTransaction, CMutableTxOut, CScript, lx
+from bitcoin.core.script import OP_CHECKSIG, OP_RETURN
+from bitcoin.wallet import CBitcoinAddress
+
+from bitcallback.bitmon.cache import (TxOutCache, ENTRY_OVERHEAD, TXOUT_RECORD,
+                                      _pack_script, _unpack_script)
+
+from .test_monitor import MockProxy, make_tx, ADDR1, ADDR2, ADDR3
+
+
+class TestTxOutCache(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.proxy = MockProxy()
+
+    def add_tx(self, outputs):
+        txid, tx = make_tx(outputs, [(lx('11'*32), len(self.proxy.transactions))])
+        self.proxy.transactions[txid] = tx
+        return txid
+
+    def test_pack_script(self):
+        """Test addresses are preserved by the compact representation"""
+        scripts = [
+            CBitcoinAddress(ADDR1).to_scriptPubKey(),
+            CScript(b'\xa9\x14'+b'\x33'*20+b'\x87'),
+            CScript(b'\x00\x14'+b'\x22'*20),
+            CScript(b'\x00\x20'+b'\x44'*32),
+            CScript([bytes.fromhex('02'+'11'*32), OP_CHECKSIG])]
+
+        for script in scripts:
+            txout_type, txout_hash = _pack_script(script)
+            self.assertEqual(
+                str(CBitcoinAddress.from_scriptPubKey(_unpack_script(txout_type, txout_hash))),
+                str(CBitcoinAddress.from_scriptPubKey(script)))
+
+        self.assertEqual(_pack_script(CScript([OP_RETURN, b'data']))[0], 0)
+
+    def test_txout(self):
+        """Test lookups and hit/miss counters"""
+        cache = TxOutCache(self.proxy)
+        txid = self.add_tx([(ADDR1, 10), (ADDR2, 20), (ADDR3, 30)])
+
+        self.assertEqual(cache.txout(txid, 1), (ADDR2, 20))
+        self.assertEqual(cache.txout(txid, 0), (ADDR1, 10))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(self.proxy.calls.count('getrawtransaction'), 1)
+
+    def test_out_of_range(self):
+        """Test missing outputs raise IndexError, cached or not"""
+        cache = TxOutCache(self.proxy)
+        txid = self.add_tx([(ADDR1, 10), (ADDR2, 20)])
+
+        for n in (2, -1, 2):
+            with self.assertRaises(IndexError):
+                cache.txout(txid, n)
+        self.assertEqual(cache.txout(txid, 1), (ADDR2, 20))
+
+    def test_spent_are_dropped(self):
+        """Test transactions are discarded once all their outputs are spent"""
+        cache = TxOutCache(self.proxy)
+        txid1 = self.add_tx([(ADDR1, 10)])
+        txid2 = self.add_tx([(ADDR1, 10), (ADDR2, 20)])
+
+        # Single output transactions aren't cached
+        cache.txout(txid1, 0)
+        self.assertNotIn(txid1, cache)
+
+        cache.txout(txid2, 0)
+        self.assertIn(txid2, cache)
+        cache.txout(txid2, 1)
+        self.assertNotIn(txid2, cache)
+        self.assertEqual(cache.size, 0)
+
+        # Lookups that don't spend the output keep it
+        cache.prefetch([txid1])
+        cache.txout(txid1, 0, spend=False)
+        self.assertIn(txid1, cache)
+
+    def test_nonstandard(self):
+        cache = TxOutCache(self.proxy)
+        tx = CMutableTransaction([], [CMutableTxOut(0, CScript([OP_RETURN])),
+                                      CMutableTxOut(5, CBitcoinAddress(ADDR1).to_scriptPubKey())])
+        self.proxy.transactions[tx.GetTxid()] = tx
+        self.assertEqual(cache.txout(tx.GetTxid(), 0), ('NO_STANDARD', None))
+
+    def test_max_bytes(self):
+        """Test least recently used transactions are evicted to fit max_bytes"""
+        entry_size = ENTRY_OVERHEAD+4+2*TXOUT_RECORD.size
+        cache = TxOutCache(self.proxy, max_bytes=3*entry_size)
+        txids = [self.add_tx([(ADDR1, n), (ADDR2, n)]) for n in range(5)]
+
+        cache.prefetch(txids[:3])
+        self.assertEqual(cache.size, 3*entry_size)
+        cache.txout(txids[0], 0, spend=False)
+
+        cache.prefetch(txids[3:])
+        self.assertEqual(cache.evictions, 2)
+        self.assertEqual(len(cache), 3)
+        self.assertIn(txids[0], cache)
+        self.assertNotIn(txids[1], cache)
+        self.assertLessEqual(cache.size, 3*entry_size)
@@ -1,7 +1,7 @@
 from unittest import TestCase
 from queue import Queue
 from datetime import datetime
-from bitcallback.callback_task import CallbackManager
+from bitcallback.callback_task import CallbackManager, ENGINE_ASYNCIO
 from bitcallback.commands import CallbackData, SubscriptionData
 
 import threading
@@ -86,7 +86,7 @@ class TestCallbackRequests(TestCase):
         # Compare request received by fake server
         request = self.requests.get()
         fields = ['id', 'txid', 'acknowledged', 'subscription', 
-                'last_retry', 'created', 'amount', 'retries']
+                'last_retry', 'created', 'amount', 'retries', 'confirmed']
         self.assertEqual(len(request), len(fields))
         for f in fields:
             self.assertTrue(f in request)
@@ -95,6 +95,42 @@ class TestCallbackRequests(TestCase):
         self.assertEqual(request['id'], callback_data.id)
         self.assertEqual(request['amount'], callback_data.amount)
 
+    def test_send_wakeup(self):
+        """Check new callbacks are sent without waiting for the update thread"""
+        callback_data = CallbackData(
+            id='ewb7RZJISGWjGEe-outhEFNB4ZYsLki9',
+            subscription=self.subscription_data,
+            txid='9e830d2f858a9382f5a6d8ec224f0ba4d93752a417063c3af612725112741ba8',
+            amount=44)
+
+        # Let the update thread go to sleep
+        time.sleep(0.2)
+        self.callback_manager.new_callback(callback_data)
+        request = self.requests.get(timeout=0.5)
+        self.assertEqual(request['id'], callback_data.id)
+
+
+
+class TestAsyncCallbackRequests(TestCallbackRequests):
+    """Test callbacks are sent with the asyncio engine"""
+
+    def setUp(self):
+        super().setUp()
+        self.callback_manager.close()
+        self.callback_manager = CallbackManager(
+            self.db_session, retries=3,
+            retry_period=30, engine=ENGINE_ASYNCIO)
+
+
+class TestEvictedCallbackRequests(TestCallbackRequests):
+    """Test callbacks are sent when their payload isn't cached"""
+
+    def setUp(self):
+        super().setUp()
+        self.callback_manager.close()
+        self.callback_manager = CallbackManager(
+            self.db_session, retries=3,
+            retry_period=30, payload_cache_bytes=0)
 
 
 class TestCallbackDB(TestCase):
@@ -132,6 +168,11 @@ class TestCallbackDB(TestCase):
             txid='9e830d2f858a9382f5a6d8ec224f0ba4d93752a417063c3af612725112741ba8',
             amount=44)
 
+        # Stop the update thread, otherwise the callback is sent right away
+        # and its retries decremented.
+        self.callback_manager._close_flag.set()
+        self.callback_manager._update_thread.join()
+
         self.callback_manager.new_callback(callback_data)
         time.sleep(0.1)
 
@@ -173,6 +214,7 @@ class TestCallbackDB(TestCase):
         # Check status has changed
         cb = self.db_session.query(Callback).get(callback_data.id)
         self.assertEqual(cb.acknowledged, True)
+        self.assertNotIn(callback_data.id, self.callback_manager._payloads)
     
     def test_recover_db(self):
         """Check unfinished callbacks are reloaded from db after a restart"""
@@ -193,6 +235,7 @@ class TestCallbackDB(TestCase):
             nthreads=5, retry_period=30,
             recover_db=True)
         self.assertEqual(len(new_manager), 1)
+        self.assertIn(callback_data.id, new_manager._payloads)
         new_manager.close()
 
         # Try once again with recovery disabled
@@ -217,3 +260,30 @@ class TestCallbackDB(TestCase):
 
 
 
+
+
+class FailingPool(object):
+    """HTTP pool raising the given exception for each post"""
+
+    def __init__(self, err):
+        self.err = err
+
+    def post(self, url, data=None, json=None, timeout=None):
+        raise self.err
+
+
+class TestSendErrors(TestCase):
+
+    def test_send_errors(self):
+        """Test failed deliveries are reported as sent, and only unexpected
+        errors logged"""
+        sent = []
+        job = ('callback_id', b'{}', 'http://localhost')
+
+        with self.assertLogs('Callback', level='ERROR') as logs:
+            CallbackManager._send_thread_func(job, sent.append, FailingPool(OSError()))
+            CallbackManager._send_thread_func(job, sent.append, FailingPool(KeyError()))
+
+        self.assertEqual(sent, ['callback_id', 'callback_id'])
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn('callback_id', logs.records[0].getMessage())
@@ -0,0 +1,133 @@
+import os
+import tempfile
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import lx
+
+from bitcallback.bitmon.cache import TxOutCache
+from bitcallback.bitmon.diskcache import DiskTxOutCache, ROW_OVERHEAD
+
+from .test_monitor import MockProxy, make_tx, ADDR1, ADDR2
+
+
+class TestDiskTxOutCache(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.proxy = MockProxy()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'txouts.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_tx(self, n):
+        txid, tx = make_tx([(ADDR1, n), (ADDR2, n)], [(lx('11'*32), n)])
+        self.proxy.transactions[txid] = tx
+        return txid
+
+    def test_put_pop(self):
+        disk = DiskTxOutCache(self.path)
+        disk.put(b'a'*32, bytearray(b'outputs'))
+        self.assertIn(b'a'*32, disk)
+        self.assertEqual(disk.size, ROW_OVERHEAD+7)
+
+        self.assertEqual(disk.pop(b'a'*32), bytearray(b'outputs'))
+        self.assertIsNone(disk.pop(b'a'*32))
+        self.assertEqual(disk.size, 0)
+        disk.close()
+
+    def test_max_bytes(self):
+        """Test oldest entries are discarded"""
+        disk = DiskTxOutCache(self.path, max_bytes=3*(ROW_OVERHEAD+10))
+        for n in range(5):
+            disk.put(bytes([n])*32, bytearray(10))
+
+        self.assertEqual(len(disk), 3)
+        self.assertNotIn(bytes([1])*32, disk)
+        self.assertIn(bytes([2])*32, disk)
+        disk.close()
+
+    def test_persistence(self):
+        """Test flushed entries are used by new cache instances, even after
+        reopening the file, instead of requesting them again"""
+        txids = [self.add_tx(n) for n in range(4)]
+
+        disk = DiskTxOutCache(self.path)
+        cache = TxOutCache(self.proxy, disk_cache=disk)
+        cache.prefetch(txids)
+        cache.txout(txids[0], 0)
+        cache.flush()
+        disk.close()
+        self.assertEqual(self.proxy.calls.count('getrawtransaction'), 4)
+
+        disk = DiskTxOutCache(self.path)
+        self.assertEqual(len(disk), 4)
+        cache = TxOutCache(self.proxy, disk_cache=disk)
+        cache.prefetch(txids[:2])
+        self.assertEqual(cache.txout(txids[1], 1), (ADDR2, 1))
+        self.assertEqual(cache.txout(txids[3], 0), (ADDR1, 3))
+        self.assertEqual(self.proxy.calls.count('getrawtransaction'), 4)
+
+        # Entries are moved into memory, and the spent state is preserved
+        self.assertEqual(len(disk), 1)
+        self.assertEqual(cache.txout(txids[0], 1), (ADDR2, 0))
+        self.assertNotIn(txids[0], cache)
+        disk.close()
+
+    def test_evicted_written_back(self):
+        """Test entries evicted from memory are moved to disk"""
+        disk = DiskTxOutCache(self.path)
+        cache = TxOutCache(self.proxy, max_bytes=1, disk_cache=disk)
+        txids = [self.add_tx(n) for n in range(3)]
+        cache.prefetch(txids)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(len(disk), 2)
+        disk.close()
+
+    def test_pop_without_commit(self):
+        """Test popped entries are only deleted with the next write, so
+        they are kept if the file isn't closed cleanly"""
+        disk = DiskTxOutCache(self.path)
+        disk.put_many([(b'a'*32, bytearray(b'a')), (b'b'*32, bytearray(b'b'))])
+        disk.pop(b'a'*32)
+        self.assertNotIn(b'a'*32, disk)
+        self.assertEqual(len(disk), 1)
+
+        # Another connection still finds it
+        other = DiskTxOutCache(self.path)
+        self.assertEqual(len(other), 2)
+        other.close()
+
+        # Written back after being modified in memory
+        disk.put(b'a'*32, bytearray(b'A'))
+        disk.pop(b'b'*32)
+        disk.put(b'c'*32, bytearray(b'c'))
+        self.assertEqual(disk.size, 2*(ROW_OVERHEAD+1))
+        disk.close()
+
+        disk = DiskTxOutCache(self.path)
+        self.assertEqual(len(disk), 2)
+        self.assertEqual(disk.pop(b'a'*32), bytearray(b'A'))
+        self.assertIsNone(disk.pop(b'b'*32))
+        disk.close()
+
+    def test_database_error(self):
+        """Test the cache starts over empty after database errors"""
+        disk = DiskTxOutCache(self.path)
+        disk.put(b'a'*32, bytearray(b'outputs'))
+        disk._conn.execute("DROP TABLE txouts")
+
+        self.assertIsNone(disk.pop(b'a'*32))
+        self.assertEqual(disk.size, 0)
+        disk.put(b'b'*32, bytearray(b'outputs'))
+        self.assertIn(b'b'*32, disk)
+        disk.close()
+
+        with open(self.path, 'wb') as f:
+            f.write(b'corrupted'*100)
+        disk = DiskTxOutCache(self.path)
+        self.assertEqual(len(disk), 0)
+        disk.close()
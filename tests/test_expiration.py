@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+import tracemalloc
+from unittest import TestCase
+
+from bitcallback.expiration import ExpirationSchedule, MIN_COMPACT_SIZE
+
+
+class TestExpirationSchedule(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2020, 1, 1)
+
+    def test_pop_expired(self):
+        """Test only keys expired before now are returned, once"""
+        schedule = ExpirationSchedule()
+        schedule.schedule(1, self.now-timedelta(seconds=10))
+        schedule.schedule(2, self.now-timedelta(seconds=10))
+        schedule.schedule(3, self.now+timedelta(milliseconds=1))
+        schedule.schedule(4, self.now+timedelta(days=1))
+
+        self.assertEqual(sorted(schedule.pop_expired(self.now)), [1, 2])
+        self.assertEqual(schedule.pop_expired(self.now), [])
+        self.assertEqual(len(schedule), 2)
+
+        # Rounded up to the next tick
+        self.assertEqual(schedule.pop_expired(self.now+timedelta(milliseconds=2)), [])
+        self.assertEqual(schedule.pop_expired(self.now+timedelta(seconds=2)), [3])
+
+    def test_cancel(self):
+        schedule = ExpirationSchedule()
+        schedule.schedule(1, self.now)
+        schedule.schedule(2, self.now)
+        schedule.schedule(3, self.now)
+        self.assertTrue(schedule.cancel(2))
+        self.assertFalse(schedule.cancel(2))
+        self.assertFalse(schedule.cancel(10))
+        self.assertNotIn(2, schedule)
+        self.assertEqual(len(schedule), 2)
+
+        # Rescheduling replaces the previous expiration
+        schedule.schedule(3, self.now+timedelta(days=1))
+        self.assertEqual(schedule.pop_expired(self.now+timedelta(hours=1)), [1])
+        self.assertIn(3, schedule)
+        self.assertEqual(len(schedule), 1)
+
+    def test_schedule_many(self):
+        schedule = ExpirationSchedule()
+        schedule.schedule(1, self.now-timedelta(seconds=5))
+        schedule.schedule_many((key, self.now+timedelta(seconds=key-3)) for key in range(2, 6))
+
+        self.assertEqual(len(schedule), 5)
+        self.assertEqual(sorted(schedule.pop_expired(self.now)), [1, 2])
+        schedule.cancel(4)
+        self.assertEqual(schedule.pop_expired(self.now+timedelta(days=1)), [3, 5])
+
+    def test_next_expiration(self):
+        schedule = ExpirationSchedule(60)
+        self.assertIsNone(schedule.next_expiration())
+
+        schedule.schedule(1, self.now+timedelta(seconds=30))
+        schedule.schedule(2, self.now+timedelta(minutes=5))
+        self.assertEqual(schedule.next_expiration(), self.now+timedelta(minutes=1))
+
+        # Cancelled buckets are skipped
+        schedule.cancel(1)
+        self.assertEqual(schedule.next_expiration(), self.now+timedelta(minutes=5))
+
+    def test_churn_soak(self):
+        """Test memory stays flat when subscriptions are created and cancelled
+        without ever expiring, slots are reused like table rows"""
+        schedule = ExpirationSchedule()
+
+        def churn(start, count):
+            for n in range(start, start+count):
+                if n >= 100:
+                    schedule.cancel(n%100)
+                schedule.schedule(n%100, self.now+timedelta(seconds=n))
+
+        tracemalloc.start()
+        try:
+            churn(0, 20000)
+            baseline = tracemalloc.get_traced_memory()[0]
+            churn(20000, 100000)
+            current = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+
+        self.assertEqual(len(schedule), 100)
+        self.assertLessEqual(schedule.heap_size, 2*MIN_COMPACT_SIZE)
+        self.assertLess(current, baseline*1.5)
@@ -0,0 +1,117 @@
+from unittest import TestCase
+import json
+import queue
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bitcallback.http_pool import HTTPConnectionPool, ResolverCache
+
+
+class TestHTTPConnectionPool(TestCase):
+
+    def setUp(self):
+        self.requests = queue.Queue()
+        requests = self.requests
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive connections
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                length = int(self.headers['Content-Length'])
+                requests.put((self.client_address, json.loads(self.rfile.read(length).decode())))
+                self.send_response(200)
+                self.send_header('Content-Length', '2')
+                self.end_headers()
+                self.wfile.write(b'ok')
+
+                # Closed without telling the client
+                if self.path.endswith('?close'):
+                    self.close_connection = True
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://localhost:{}/callback'.format(self.httpd.server_address[1])
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def test_keep_alive(self):
+        """Test connections are reused, and the host only resolved once"""
+        pool = HTTPConnectionPool()
+        for n in range(3):
+            self.assertEqual(pool.post(self.url, json={'n': n}, timeout=1), 200)
+
+        clients = set(self.requests.get(timeout=1)[0] for _ in range(3))
+        self.assertEqual(len(clients), 1)
+
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+        self.assertAlmostEqual(stats['hit_rate'], 2/3)
+        self.assertEqual((stats['dns_hits'], stats['dns_misses']), (0, 1))
+        pool.close()
+
+    def test_idle_timeout(self):
+        """Test expired idle connections aren't reused, but the resolved
+        address is"""
+        pool = HTTPConnectionPool(idle_timeout=-1)
+        for n in range(3):
+            pool.post(self.url, json={'n': n}, timeout=1)
+
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (0, 3))
+        self.assertEqual((stats['dns_hits'], stats['dns_misses']), (2, 1))
+        pool.close()
+
+    def test_address_fallback(self):
+        """Test the next resolved address is tried when connecting fails"""
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        unused_port = unused.getsockname()[1]
+        unused.close()
+
+        pool = HTTPConnectionPool()
+        port = self.httpd.server_address[1]
+        pool._resolver._cache[('localhost', port)] = (
+            time.monotonic()+60,
+            [(socket.AF_INET, ('127.0.0.1', unused_port)),
+             (socket.AF_INET, ('127.0.0.1', port))])
+
+        self.assertEqual(pool.post(self.url, json={'n': 0}, timeout=1), 200)
+        pool.close()
+
+    def test_server_closed(self):
+        """Test the request is retried when the server closed the idle
+        connection"""
+        pool = HTTPConnectionPool()
+        pool.post(self.url+'?close', json={}, timeout=1)
+        self.requests.get(timeout=1)
+
+        self.assertEqual(pool.post(self.url, json={}, timeout=1), 200)
+        self.assertEqual(pool.stats()['misses'], 2)
+        pool.close()
+
+
+class TestResolverCache(TestCase):
+
+    def test_resolve(self):
+        resolver = ResolverCache()
+        addresses = resolver.resolve('127.0.0.1', 80)
+        self.assertEqual(addresses, [(socket.AF_INET, ('127.0.0.1', 80))])
+        self.assertEqual(resolver.resolve('127.0.0.1', 80), addresses)
+        self.assertEqual((resolver.hits, resolver.misses), (1, 1))
+
+    def test_purge(self):
+        """Test expired entries are removed"""
+        resolver = ResolverCache(ttl=0)
+        for port in range(1, 10):
+            resolver.resolve('127.0.0.1', port)
+        self.assertEqual(len(resolver), 1)
@@ -0,0 +1,40 @@
+from unittest import TestCase
+
+from sqlalchemy import create_engine, inspect
+
+from bitcallback.models import upgrade_schema
+
+
+class TestUpgradeSchema(TestCase):
+
+    def setUp(self):
+        self.engine = create_engine('sqlite:///:memory:')
+
+    def columns(self, table):
+        return set(c['name'] for c in inspect(self.engine).get_columns(table))
+
+    def test_upgrade(self):
+        """Test columns are added to tables created by previous versions"""
+        self.engine.execute("CREATE TABLE callbacks (id VARCHAR(32) PRIMARY KEY)")
+        self.engine.execute("CREATE TABLE lastblock (id INTEGER PRIMARY KEY, block_number INTEGER)")
+        self.engine.execute("INSERT INTO callbacks (id) VALUES ('a')")
+        self.engine.execute("INSERT INTO lastblock (id, block_number) VALUES (1, 100)")
+
+        self.assertEqual(upgrade_schema(self.engine), [
+            'callbacks.confirmed', 'lastblock.rescan_block', 'lastblock.rescan_end',
+            'lastblock.rescan_subscriptions'])
+        self.assertIn('confirmed', self.columns('callbacks'))
+        self.assertIn('rescan_subscriptions', self.columns('lastblock'))
+
+        # Existing callbacks were confirmed, there was no rescan
+        self.assertEqual(list(self.engine.execute("SELECT confirmed FROM callbacks")), [(1,)])
+        self.assertEqual(list(self.engine.execute(
+            "SELECT block_number, rescan_block FROM lastblock")), [(100, None)])
+
+        # Nothing left to do
+        self.assertEqual(upgrade_schema(self.engine), [])
+
+    def test_missing_tables(self):
+        """Test missing tables are left to create_all"""
+        self.assertEqual(upgrade_schema(self.engine), [])
+        self.assertEqual(inspect(self.engine).get_table_names(), [])
@@ -0,0 +1,485 @@
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import (CBlock, CMutableTransaction, CMutableTxIn,
+                          CMutableTxOut, COutPoint, CScript, COIN, lx, b2lx, b2x)
+from bitcoin.core.script import OP_CHECKSIG
+from decimal import Decimal
+from bitcoin.wallet import CBitcoinAddress, CKey, P2PKHBitcoinAddress
+
+from bitcallback.bitmon import TransactionMonitor
+from bitcallback.bitmon.index import OutpointIndex
+from bitcallback.bitmon.mempool import MempoolTracker
+
+
+ADDR1 = 'n2SjFgAhHAv8PcTuq5x2e9sugcXDpMTzX7'
+ADDR2 = 'mjgZHpD1AzEixLgcnncod5df6CntYK4Jpi'
+ADDR3 = 'mnoqv6wv6WEntuYG79YgyoW6ShNUWghsa6'
+
+
+def make_tx(outputs, inputs=(), coinbase=False):
+    """Create transaction paying to the given addresses
+
+    Arguments:
+        outputs (list): [(addr, value), ...]
+        inputs (list): [(txid, n), ...] spent outputs
+        coinbase (bool): Create coinbase transaction
+    """
+    if coinbase:
+        vin = [CMutableTxIn(COutPoint(), CScript([len(outputs)]))]
+    else:
+        vin = [CMutableTxIn(COutPoint(txid, n)) for txid, n in inputs]
+
+    vout = [CMutableTxOut(value, CBitcoinAddress(addr).to_scriptPubKey())
+            for addr, value in outputs]
+    return CMutableTransaction(vin, vout).GetTxid(), CMutableTransaction(vin, vout)
+
+
+class MockProxy(object):
+    """Fake bitcoind proxy serving blocks from memory"""
+
+    def __init__(self, version=220000):
+        self.blocks = []
+        self.transactions = {}
+        self.mempool = []
+        self.calls = []
+        self.version = version
+        self.missing_prevouts = set()
+
+    def add_block(self, vtx):
+        """Add new block with the given transactions to the chain"""
+        for tx in vtx:
+            self.transactions[tx.GetTxid()] = tx
+        block = CBlock(nTime=len(self.blocks), vtx=vtx)
+        self.blocks.append(block)
+        return block
+
+    def getblockcount(self):
+        self.calls.append('getblockcount')
+        return len(self.blocks)-1
+
+    def getblockhash(self, height):
+        self.calls.append('getblockhash')
+        return self.blocks[height].GetHash()
+
+    def getblock(self, block_hash):
+        self.calls.append('getblock')
+        return self._find_block(block_hash)
+
+    def _find_block(self, block_hash):
+        for block in self.blocks:
+            if block.GetHash() == block_hash:
+                return block
+        raise IndexError(b2lx(block_hash))
+
+    def getrawtransaction(self, txid):
+        self.calls.append('getrawtransaction')
+        try:
+            return self.transactions[txid]
+        except KeyError:
+            raise IndexError(b2lx(txid))
+
+    def getrawmempool(self):
+        self.calls.append('getrawmempool')
+        return [tx.GetTxid() for tx in self.mempool]
+
+    def add_mempool(self, tx):
+        self.transactions[tx.GetTxid()] = tx
+        self.mempool.append(tx)
+
+    def call(self, method, *args):
+        if method == 'getnetworkinfo':
+            self.calls.append(method)
+            return {'version': self.version}
+
+        assert method == 'getblock'
+        self.calls.append('getblock/{}'.format(args[1]))
+        block = self._find_block(lx(args[0]))
+        if args[1] == 0:
+            return b2x(block.serialize())
+
+        # getblock verbosity 3
+        txs = []
+        for tx in block.vtx:
+            vin = []
+            for tin in tx.vin:
+                if tx.is_coinbase():
+                    vin.append({'coinbase': b2x(tin.scriptSig)})
+                    continue
+                # Undo data not available
+                if (tin.prevout.hash, tin.prevout.n) in self.missing_prevouts:
+                    vin.append({'txid': b2lx(tin.prevout.hash), 'vout': tin.prevout.n})
+                    continue
+                txout = self.transactions[tin.prevout.hash].vout[tin.prevout.n]
+                vin.append({'prevout': {
+                    'value': Decimal(txout.nValue)/COIN,
+                    'scriptPubKey': {'hex': b2x(txout.scriptPubKey)}}})
+            txs.append({'hex': b2x(tx.serialize()), 'vin': vin})
+        return {'tx': txs}
+
+
+class TestTransactionMonitor(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.proxy = MockProxy()
+
+        # Genesis block
+        self.proxy.add_block([make_tx([(ADDR3, 50)], coinbase=True)[1]])
+
+    def extend_chain(self, nblocks, addr=ADDR3):
+        """Add nblocks to the chain, each with a single coinbase paying addr"""
+        txids = []
+        for _ in range(nblocks):
+            txid, tx = make_tx([(addr, 50)], coinbase=True)
+            # Make every coinbase unique
+            tx.vin[0].scriptSig = CScript([len(self.proxy.blocks)])
+            self.proxy.add_block([tx])
+            txids.append(tx.GetTxid())
+        return txids
+
+    def test_single_block_per_call(self):
+        """Test default budget processes one block per call"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=-1)
+        self.extend_chain(5)
+
+        monitor.get_confirmed()
+        self.assertEqual(monitor.current_block, 1)
+        self.assertEqual(monitor.lag, 4)
+
+    def test_catch_up(self):
+        """Test all pending blocks are processed in a single call"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=None)
+        txids = self.extend_chain(5, ADDR1)
+        monitor.add_addr(ADDR1)
+
+        transactions = monitor.get_confirmed()
+        self.assertEqual(monitor.current_block, 5)
+        self.assertEqual(monitor.lag, 0)
+
+        # Block 5 will be processed once it has another confirmation
+        self.assertEqual(set(t.hash for t in transactions),
+                         set(b2lx(txid) for txid in txids[:-1]))
+
+    def test_catch_up_budget(self):
+        """Test per call block budget"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=3)
+        self.extend_chain(7)
+
+        monitor.get_confirmed()
+        self.assertEqual(monitor.current_block, 3)
+        self.assertEqual(monitor.lag, 4)
+
+        monitor.get_confirmed()
+        self.assertEqual(monitor.current_block, 6)
+        self.assertEqual(monitor.lag, 1)
+
+        monitor.get_confirmed()
+        self.assertEqual(monitor.current_block, 7)
+        self.assertEqual(monitor.lag, 0)
+
+    def test_monitored_inputs_and_outputs(self):
+        """Test transactions spending from or paying to monitored addresses
+        are detected"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=None)
+        monitor.add_addr(ADDR1)
+        monitor.add_addr(ADDR2)
+
+        txid1, tx1 = make_tx([(ADDR1, 30), (ADDR3, 20)], [(lx('11'*32), 0)])
+        txid2, tx2 = make_tx([(ADDR3, 25)], [(txid1, 0)])
+        txid3, tx3 = make_tx([(ADDR3, 25)], [(txid1, 1)])
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR3, 50)])[1]
+        self.proxy.add_block([tx1, tx2, tx3])
+        self.extend_chain(1)
+
+        transactions = monitor.get_confirmed()
+        self.assertEqual(len(transactions), 2)
+
+        tran1, tran2 = transactions
+        self.assertEqual(tran1.hash, b2lx(txid1))
+        self.assertEqual(tran1.tout, {ADDR1: 30})
+        # Only inputs from monitored addresses are resolved
+        self.assertEqual(tran1.tin, {})
+        self.assertEqual(tran2.hash, b2lx(txid2))
+        self.assertEqual(tran2.tin, {ADDR1: 30})
+
+    def test_outpoint_index(self):
+        """Test spends of indexed outputs are detected without requesting
+        the previous transaction"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=-1,
+                                     max_blocks=None, txout_cache=False)
+        monitor.add_addr(ADDR1)
+
+        txid1, tx1 = make_tx([(ADDR1, 30), (ADDR3, 20)], [(lx('11'*32), 0)])
+        txid2, tx2 = make_tx([(ADDR3, 25)], [(txid1, 0), (txid1, 1)])
+        self.proxy.add_block([tx1])
+        self.proxy.add_block([tx2])
+        self.extend_chain(1)
+
+        transactions = monitor.get_confirmed()
+        self.assertEqual([t.hash for t in transactions], [b2lx(txid1), b2lx(txid2)])
+
+        # Without TxOutCache only indexed inputs are resolved
+        self.assertEqual(transactions[0].tin, {})
+        self.assertEqual(transactions[1].tin, {ADDR1: 30})
+        self.assertNotIn('getrawtransaction', self.proxy.calls)
+
+        # Raw blocks are scanned instead of deserialized
+        self.assertNotIn('getblock', self.proxy.calls)
+
+        # Spent outputs are removed from the index
+        self.assertEqual(len(monitor.outpoint_index), 0)
+
+    def test_p2pk_outputs(self):
+        """Test P2PK outputs are credited to the P2PKH address of their key,
+        both when blocks are scanned and decoded"""
+        key = CKey(b'\x01'*32)
+        addr = str(P2PKHBitcoinAddress.from_pubkey(key.pub))
+
+        tx1 = CMutableTransaction([CMutableTxIn(COutPoint(lx('11'*32), 0))],
+                                  [CMutableTxOut(30, CScript([key.pub, OP_CHECKSIG]))])
+        txid2, tx2 = make_tx([(ADDR3, 25)], [(tx1.GetTxid(), 0)])
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR3, 50)])[1]
+        self.proxy.add_block([tx1])
+        self.proxy.add_block([tx2])
+        self.extend_chain(1)
+
+        for txout_cache in (False, True):
+            monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=1,
+                                         max_blocks=None, txout_cache=txout_cache)
+            monitor.add_addr(addr)
+
+            transactions = monitor.get_confirmed()
+            self.assertEqual([t.hash for t in transactions],
+                             [b2lx(tx1.GetTxid()), b2lx(txid2)])
+            self.assertEqual(transactions[0].tout, {addr: 30})
+            self.assertEqual(transactions[1].tin, {addr: 30})
+
+    def test_block_prevouts(self):
+        """Test inputs are resolved from getblock prevouts when supported"""
+        monitor = TransactionMonitor(MockProxy(version=220000))
+        self.assertFalse(monitor.detect_block_prevouts())
+
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=None)
+        self.proxy.version = 230000
+        self.assertTrue(monitor.detect_block_prevouts())
+        monitor.add_addr(ADDR1)
+
+        txid1, tx1 = make_tx([(ADDR1, 30), (ADDR3, 20)], [(lx('11'*32), 0)])
+        txid2, tx2 = make_tx([(ADDR3, 25)], [(txid1, 0), (txid1, 1)])
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR2, 50)])[1]
+        self.proxy.add_block([tx1, tx2])
+        self.extend_chain(1)
+
+        transactions = monitor.get_confirmed()
+        self.assertEqual(len(transactions), 2)
+        self.assertEqual(transactions[0].tin, {})
+        self.assertEqual(transactions[1].tin, {ADDR1: 30})
+        self.assertNotIn('getrawtransaction', self.proxy.calls)
+
+    def test_missing_block_prevouts(self):
+        """Test inputs without getblock prevout are resolved through the
+        TxOutCache, and the rest still match their own inputs"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=None)
+        self.proxy.version = 230000
+        self.assertTrue(monitor.detect_block_prevouts())
+        monitor.add_addr(ADDR1)
+
+        funding_txid, funding_tx = make_tx([(ADDR1, 50)], [(lx('11'*32), 1)])
+        txid1, tx1 = make_tx([(ADDR1, 30), (ADDR3, 20)], [(lx('11'*32), 0)])
+        txid2, tx2 = make_tx([(ADDR3, 75)], [(funding_txid, 0), (txid1, 1), (txid1, 0)])
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR2, 50), (ADDR2, 50)])[1]
+        self.proxy.transactions[funding_txid] = funding_tx
+        self.proxy.missing_prevouts.add((funding_txid, 0))
+        self.proxy.add_block([tx1, tx2])
+        self.extend_chain(1)
+
+        transactions = monitor.get_confirmed()
+        self.assertEqual([t.hash for t in transactions], [b2lx(txid1), b2lx(txid2)])
+        self.assertEqual(transactions[1].tin, {ADDR1: 80})
+        self.assertEqual(len(monitor.outpoint_index), 0)
+
+    def test_iter_confirmed(self):
+        """Test transactions are generated one at a time, and blocks counted
+        once all their transactions are consumed"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1,
+                                     start_block=-1, max_blocks=None)
+        txids = self.extend_chain(2, ADDR1)
+        self.extend_chain(1)
+        monitor.add_addr(ADDR1)
+
+        # Genesis block is processed before the first transaction is found
+        transactions = monitor.iter_confirmed()
+        self.assertEqual(next(transactions).hash, b2lx(txids[0]))
+        self.assertEqual(monitor.current_block, 1)
+        self.assertEqual(next(transactions).hash, b2lx(txids[1]))
+        self.assertEqual(monitor.current_block, 2)
+
+        self.assertEqual(list(transactions), [])
+        self.assertEqual(monitor.current_block, 3)
+
+    def test_prefetch(self):
+        """Test blocks downloaded by the prefetch thread give the same results"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=-1,
+                                     max_blocks=2, prefetch_proxy=self.proxy,
+                                     prefetch_window=2)
+        txids = self.extend_chain(5, ADDR1)
+        monitor.add_addr(ADDR1)
+
+        transactions = monitor.get_confirmed()
+        transactions.extend(monitor.get_confirmed())
+        transactions.extend(monitor.get_confirmed())
+        monitor.close()
+
+        self.assertEqual([t.hash for t in transactions],
+                         [b2lx(txid) for txid in txids[:-1]])
+
+    def test_mempool(self):
+        """Test only new mempool transactions are requested, and their inputs
+        aren't resolved again once confirmed"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=-1,
+                                     max_blocks=None, mempool=MempoolTracker())
+        monitor.add_addr(ADDR1)
+
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR3, 50)])[1]
+        txid1, tx1 = make_tx([(ADDR1, 30), (ADDR3, 20)], [(lx('11'*32), 0)])
+        txid2, tx2 = make_tx([(ADDR2, 25)], [(txid1, 1)])
+        self.proxy.add_mempool(tx1)
+        self.proxy.add_mempool(tx2)
+
+        transactions = monitor.get_unconfirmed()
+        self.assertEqual([t.hash for t in transactions], [b2lx(txid1)])
+        self.assertEqual(transactions[0].tin, {ADDR3: 50})
+
+        # Already seen transactions aren't requested again
+        self.proxy.calls = []
+        self.assertEqual(monitor.get_unconfirmed(), [])
+        self.assertEqual(self.proxy.calls, ['getrawmempool'])
+
+        # Evicted before it was requested
+        self.proxy.mempool.append(make_tx([(ADDR1, 5)], [(lx('22'*32), 0)])[1])
+        self.assertEqual(monitor.get_unconfirmed(), [])
+
+        # Confirmed, the inputs resolved from the mempool are reused
+        self.proxy.mempool = []
+        self.proxy.add_block([tx1, tx2])
+        self.extend_chain(1)
+        self.proxy.calls = []
+        transactions = monitor.get_confirmed()
+        self.assertEqual([t.hash for t in transactions], [b2lx(txid1)])
+        self.assertEqual(transactions[0].tin, {ADDR3: 50})
+        self.assertNotIn('getrawtransaction', self.proxy.calls)
+
+        # The outputs were indexed once confirmed, not while in the mempool
+        self.assertIn((txid1, 0), monitor.outpoint_index)
+
+    def test_mempool_fetch_error(self):
+        """Test new mempool transactions are requested again when fetching
+        them fails"""
+        monitor = TransactionMonitor(self.proxy, confirmations=1, start_block=-1,
+                                     max_blocks=None, mempool=MempoolTracker())
+        monitor.add_addr(ADDR1)
+        txid1, tx1 = make_tx([(ADDR1, 30)], [(lx('11'*32), 0)])
+        self.proxy.transactions[lx('11'*32)] = make_tx([(ADDR3, 50)])[1]
+        self.proxy.add_mempool(tx1)
+
+        def lost(txid):
+            raise ConnectionError("Lost")
+        self.proxy.getrawtransaction = lost
+        with self.assertRaises(ConnectionError):
+            monitor.get_unconfirmed()
+
+        del self.proxy.getrawtransaction
+        transactions = monitor.get_unconfirmed()
+        self.assertEqual([t.hash for t in transactions], [b2lx(txid1)])
+
+    def test_mempool_disabled(self):
+        monitor = TransactionMonitor(self.proxy)
+        self.proxy.add_mempool(make_tx([(ADDR1, 5)], [(lx('22'*32), 0)])[1])
+        monitor.add_addr(ADDR1)
+        self.assertEqual(monitor.get_unconfirmed(), [])
+        self.assertNotIn('getrawmempool', self.proxy.calls)
+
+
+class TestMempoolTracker(TestCase):
+
+    def test_update(self):
+        mempool = MempoolTracker()
+        self.assertEqual(sorted(mempool.update([b'a', b'b'])), [b'a', b'b'])
+        mempool.commit()
+        self.assertEqual(mempool.update([b'b', b'c']), [b'c'])
+
+        # Not committed, compared again with the previous snapshot
+        self.assertEqual(mempool.update([b'b', b'c']), [b'c'])
+        mempool.commit()
+        self.assertEqual(mempool.update([b'b', b'c']), [])
+        self.assertNotIn(b'a', mempool)
+        self.assertEqual(len(mempool), 2)
+
+    def test_decoded_size(self):
+        mempool = MempoolTracker(max_decoded=2)
+        for txid in (b'a', b'b', b'c'):
+            mempool.add_decoded(txid, None, [])
+        self.assertIsNone(mempool.pop_decoded(b'a'))
+        self.assertEqual(mempool.pop_decoded(b'c'), (None, []))
+        self.assertFalse(mempool.is_decoded(b'c'))
+
+
+class TestOutpointIndex(TestCase):
+
+    def test_changes(self):
+        """Test changes are reported until committed, and outputs added and
+        spent between commits are not reported"""
+        index = OutpointIndex()
+        index.load([(b'a', 0, ADDR1, 10)])
+        index.add(b'b', 0, ADDR1, 20)
+        index.add(b'b', 1, ADDR2, 30)
+        index.spend(b'a', 0)
+        index.spend(b'b', 0)
+
+        added, spent = index.changes()
+        self.assertEqual(added, {(b'b', 1): (ADDR2, 30)})
+        self.assertEqual(spent, {(b'a', 0)})
+        index.commit()
+        self.assertEqual(index.changes(), ({}, set()))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get(b'b', 1), (ADDR2, 30))
+
+    def test_rollback(self):
+        """Test staged changes are discarded, and committed ones kept"""
+        index = OutpointIndex()
+        index.load([(b'a', 0, ADDR1, 10)])
+        index.add(b'b', 0, ADDR2, 20)
+        index.commit()
+
+        index.add(b'c', 0, ADDR1, 30)
+        self.assertEqual(index.spend(b'a', 0), (ADDR1, 10))
+        self.assertEqual(index.spend(b'b', 0), (ADDR2, 20))
+        self.assertNotIn((b'a', 0), index)
+        self.assertEqual(len(index), 1)
+
+        index.rollback()
+        self.assertEqual(index.get(b'a', 0), (ADDR1, 10))
+        self.assertEqual(index.get(b'b', 0), (ADDR2, 20))
+        self.assertIsNone(index.get(b'c', 0))
+        self.assertEqual(index.changes(), ({}, set()))
+
+    def test_discard_addr(self):
+        """Test all the outputs for an address are discarded"""
+        index = OutpointIndex()
+        index.add(b'a', 0, ADDR1, 10)
+        index.add(b'a', 1, ADDR1, 20)
+        index.add(b'b', 0, ADDR2, 30)
+        index.commit()
+        index.add(b'c', 0, ADDR1, 40)
+
+        index.discard_addr(ADDR1)
+        self.assertEqual(len(index), 1)
+        self.assertIsNone(index.spend(b'a', 1))
+        self.assertIsNone(index.get(b'c', 0))
+        self.assertEqual(index.changes(), ({}, {(b'a', 0), (b'a', 1)}))
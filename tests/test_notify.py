@@ -0,0 +1,73 @@
+from unittest import TestCase
+import os
+import queue
+import tempfile
+import time
+
+from bitcallback.bitmon.notify import (BlockNotifier, UnixBlockPublisher,
+                                       pack_message, unpack_messages,
+                                       TOPIC_HASHBLOCK, TOPIC_RAWBLOCK)
+
+
+def wait_subscribers(publisher, n, timeout=3):
+    """Wait until n notifiers are connected to the publisher"""
+    start = time.time()
+    while len(publisher) < n and time.time()-start < timeout:
+        time.sleep(0.05)
+
+
+class TestBlockNotifier(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'blocks.sock')
+        self.received = queue.Queue()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def notify(self, topic, body):
+        self.received.put((topic, body))
+
+    def test_unpack_messages(self):
+        """Test only complete messages are extracted from the buffer"""
+        data = pack_message(b'hashblock', b'\x01'*32)+pack_message(b'rawblock', b'\x02'*90)
+        buff = bytearray(data[:-10])
+        self.assertEqual(unpack_messages(buff), [(b'hashblock', b'\x01'*32)])
+        buff.extend(data[-10:])
+        self.assertEqual(unpack_messages(buff), [(b'rawblock', b'\x02'*90)])
+        self.assertEqual(len(buff), 0)
+
+    def test_notifications(self):
+        """Test notifications are received from a Unix socket publisher"""
+        publisher = UnixBlockPublisher(self.path)
+        notifier = BlockNotifier(publisher.url, self.notify)
+        wait_subscribers(publisher, 1)
+
+        publisher.publish_block(b'\x01'*32)
+        publisher.publish(TOPIC_RAWBLOCK, b'\x02'*100) # Not subscribed by default
+        publisher.publish_block(b'\x03'*32)
+
+        self.assertEqual(self.received.get(timeout=2), (TOPIC_HASHBLOCK, b'\x01'*32))
+        self.assertEqual(self.received.get(timeout=2), (TOPIC_HASHBLOCK, b'\x03'*32))
+        self.assertTrue(self.received.empty())
+
+        notifier.close()
+        publisher.close()
+
+    def test_reconnect(self):
+        """Test the notifier reconnects when the publisher is restarted"""
+        notifier = BlockNotifier('unix://'+self.path, self.notify)
+
+        for blockhash in (b'\x01'*32, b'\x02'*32):
+            publisher = UnixBlockPublisher(self.path)
+            wait_subscribers(publisher, 1)
+            publisher.publish_block(blockhash)
+            self.assertEqual(self.received.get(timeout=2), (TOPIC_HASHBLOCK, blockhash))
+            publisher.close()
+
+        notifier.close()
+
+    def test_unsupported_url(self):
+        with self.assertRaises(ValueError):
+            BlockNotifier('http://localhost', self.notify)
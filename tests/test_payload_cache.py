@@ -0,0 +1,63 @@
+from datetime import datetime
+import json
+from unittest import TestCase
+
+from bitcallback.payload_cache import (PayloadCache, ENTRY_OVERHEAD,
+                                       build_payload, render_payload)
+
+
+class TestPayload(TestCase):
+
+    def test_render_payload(self):
+        """Test rendered payload is the original request with new retry fields"""
+        request = {
+            'id': 'ewb7RZJISGWjGEe-outhEFNB4ZYsLki9',
+            'subscription': {'id': 1, 'address': 'n2SjFgAhHAv8PcTuq5x2e9sugcXDpMTzX7'},
+            'txid': '9e830d2f858a9382f5a6d8ec224f0ba4d93752a417063c3af612725112741ba8',
+            'amount': 44,
+            'confirmed': True,
+            'created': '2020-01-01T00:00:00',
+            'last_retry': '2019-12-31T23:50:00',
+            'retries': 4,
+            'acknowledged': False}
+
+        payload = build_payload(request)
+        body = render_payload(payload, datetime(2020, 1, 1, 0, 2, 0, 500), 3)
+
+        expected = dict(request, last_retry='2020-01-01T00:02:00', retries=3)
+        self.assertEqual(json.loads(body.decode('utf-8')), expected)
+
+
+class TestPayloadCache(TestCase):
+
+    def test_get(self):
+        cache = PayloadCache()
+        cache.put('a', b'{"id": "a"', 'http://localhost')
+        self.assertEqual(cache.get('a'), (b'{"id": "a"', 'http://localhost'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.discard('a')
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 0)
+
+    def test_eviction(self):
+        """Test least recently used entries are evicted once full"""
+        payload = b'x'*100
+        url = 'http://localhost'
+        cache = PayloadCache(max_bytes=3*(ENTRY_OVERHEAD+len(payload)+len(url)))
+        for key in 'abc':
+            cache.put(key, payload, url)
+
+        cache.get('a')
+        cache.put('d', payload, url)
+        self.assertNotIn('b', cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertLessEqual(cache.size, cache._max_bytes)
+
+        # Nothing is cached without memory
+        cache = PayloadCache(max_bytes=0)
+        cache.put('a', payload, url)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
@@ -0,0 +1,85 @@
+from unittest import TestCase
+import threading
+import time
+
+from bitcallback.bitmon.prefetch import BlockPrefetcher
+
+
+class HeightProxy(object):
+
+    def getblockhash(self, height):
+        return height
+
+
+class BatchHeightProxy(HeightProxy):
+
+    def __init__(self):
+        self.batches = []
+
+    def getblockhashes(self, heights):
+        self.batches.append(heights)
+        return heights
+
+
+class TestBlockPrefetcher(TestCase):
+
+    def setUp(self):
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def fetch_func(self, proxy, blockhash):
+        with self.lock:
+            self.fetched.append(blockhash)
+        if blockhash == 13:
+            raise ConnectionError("Lost")
+        return "block {}".format(blockhash)
+
+    def test_get(self):
+        """Test blocks are returned in order"""
+        prefetcher = BlockPrefetcher(HeightProxy(), self.fetch_func, window=2)
+        prefetcher.set_target(10)
+        for height in range(5):
+            self.assertEqual(prefetcher.get(height), "block {}".format(height))
+
+        # Jump to a different height
+        self.assertEqual(prefetcher.get(8), "block 8")
+        self.assertEqual(prefetcher.get(9), "block 9")
+        prefetcher.close()
+
+    def test_window(self):
+        """Test blocks are fetched ahead, up to the window size"""
+        prefetcher = BlockPrefetcher(HeightProxy(), self.fetch_func, window=3)
+        prefetcher.set_target(100)
+        prefetcher.get(0)
+        time.sleep(0.2)
+
+        # 3 waiting in the window and one more waiting to be added
+        self.assertEqual(self.fetched, list(range(5)))
+
+        # Blocks past the target are not fetched
+        prefetcher.set_target(6)
+        for height in range(1, 7):
+            prefetcher.get(height)
+        time.sleep(0.2)
+        self.assertEqual(self.fetched, list(range(7)))
+        prefetcher.close()
+
+    def test_errors(self):
+        """Test fetch errors are raised by get"""
+        prefetcher = BlockPrefetcher(HeightProxy(), self.fetch_func, window=2)
+        prefetcher.set_target(20)
+        prefetcher.get(12)
+        with self.assertRaises(ConnectionError):
+            prefetcher.get(13)
+        prefetcher.close()
+
+    def test_batch_hashes(self):
+        """Test block hashes are requested in batches of up to window heights"""
+        proxy = BatchHeightProxy()
+        prefetcher = BlockPrefetcher(proxy, self.fetch_func, window=4)
+        prefetcher.set_target(9)
+        for height in range(10):
+            self.assertEqual(prefetcher.get(height), "block {}".format(height))
+        prefetcher.close()
+
+        self.assertEqual(proxy.batches, [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
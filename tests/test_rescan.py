@@ -0,0 +1,65 @@
+from unittest import TestCase, mock
+
+import bitcoin
+from bitcoin.core import CScript, b2lx
+
+from bitcallback.bitmon import rescan
+from bitcallback.bitmon.rescan import ParallelRescan
+
+from .test_monitor import MockProxy, make_tx, ADDR1, ADDR3
+
+
+class TestParallelRescan(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.proxy = MockProxy()
+
+        # Every third block pays to ADDR1
+        self.txids = []
+        for height in range(30):
+            addr = ADDR1 if height % 3 == 0 else ADDR3
+            txid, tx = make_tx([(addr, 50)], coinbase=True)
+            tx.vin[0].scriptSig = CScript([height])
+            self.proxy.add_block([tx])
+            if addr == ADDR1:
+                self.txids.append(b2lx(tx.GetTxid()))
+
+        # Workers are forked so they inherit the patched proxy
+        patcher = mock.patch.object(rescan, 'BatchProxy',
+                                    lambda service_url, batch_size: self.proxy)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_all(self, scan):
+        results = []
+        while True:
+            try:
+                result = scan.get(timeout=5)
+            except StopIteration:
+                break
+            self.assertIsNotNone(result)
+            results.append(result)
+        scan.close()
+        return results
+
+    def test_block_order(self):
+        """Test chunks are returned in block order with all transactions"""
+        scan = ParallelRescan('http://localhost', [ADDR1], 2, 29,
+                              workers=3, chunk_size=4)
+        results = self.get_all(scan)
+
+        self.assertEqual([(first, last) for first, last, _ in results],
+                         [(2, 5), (6, 9), (10, 13), (14, 17), (18, 21),
+                          (22, 25), (26, 29)])
+        hashes = [t.hash for _, _, transactions in results for t in transactions]
+        self.assertEqual(hashes, self.txids[1:])
+
+    def test_worker_error(self):
+        """Test worker errors are raised when the chunk is requested"""
+        scan = ParallelRescan('http://localhost', [ADDR1], 25, 35,
+                              workers=2, chunk_size=5)
+        self.assertEqual(scan.get(timeout=5)[:2], (25, 29))
+        with self.assertRaises(IndexError):
+            scan.get(timeout=5)
+        scan.close()
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from bitcallback.retry_schedule import RetrySchedule, MIN_COMPACT_SIZE
+
+
+class TestRetrySchedule(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2020, 1, 1)
+
+    def test_pop_due(self):
+        """Test keys are returned by attempt time, only once due"""
+        schedule = RetrySchedule()
+        schedule.schedule('a', self.now+timedelta(seconds=30))
+        schedule.schedule('b', self.now-timedelta(seconds=10))
+        schedule.schedule('c', self.now)
+        schedule.schedule('d', self.now-timedelta(seconds=10))
+
+        # Same attempt time keys are returned in FIFO order
+        self.assertEqual(schedule.pop_due(self.now), 'b')
+        self.assertEqual(schedule.pop_due(self.now), 'd')
+        self.assertEqual(schedule.pop_due(self.now), 'c')
+        self.assertIsNone(schedule.pop_due(self.now))
+        self.assertEqual(len(schedule), 1)
+
+        self.assertEqual(schedule.pop_due(self.now+timedelta(seconds=30)), 'a')
+        self.assertEqual(len(schedule), 0)
+
+    def test_not_due_head(self):
+        """Test a key not due doesn't block the ones scheduled later"""
+        schedule = RetrySchedule()
+        schedule.schedule('retry', self.now+timedelta(seconds=120))
+        schedule.schedule('new', self.now)
+        self.assertEqual(schedule.pop_due(self.now), 'new')
+
+    def test_discard(self):
+        schedule = RetrySchedule()
+        schedule.schedule('a', self.now)
+        schedule.schedule('b', self.now+timedelta(seconds=1))
+        self.assertTrue(schedule.discard('a'))
+        self.assertFalse(schedule.discard('a'))
+        self.assertNotIn('a', schedule)
+        self.assertEqual(len(schedule), 1)
+
+        # Removed keys are skipped
+        self.assertEqual(schedule.next_due(), self.now+timedelta(seconds=1))
+        self.assertIsNone(schedule.pop_due(self.now))
+        self.assertEqual(schedule.pop_due(self.now+timedelta(seconds=1)), 'b')
+
+    def test_reschedule(self):
+        """Test rescheduling replaces the previous attempt time"""
+        schedule = RetrySchedule()
+        schedule.schedule('a', self.now)
+        schedule.schedule('a', self.now+timedelta(seconds=60))
+        self.assertEqual(len(schedule), 1)
+        self.assertIsNone(schedule.pop_due(self.now))
+        self.assertEqual(schedule.next_due(), self.now+timedelta(seconds=60))
+        self.assertEqual(schedule.pop_due(self.now+timedelta(seconds=60)), 'a')
+        self.assertIsNone(schedule.pop_due(self.now+timedelta(days=1)))
+
+    def test_next_due(self):
+        schedule = RetrySchedule()
+        self.assertIsNone(schedule.next_due())
+        schedule.schedule('a', self.now+timedelta(seconds=5))
+        schedule.schedule('b', self.now+timedelta(seconds=2))
+        self.assertEqual(schedule.next_due(), self.now+timedelta(seconds=2))
+
+    def test_compact(self):
+        """Test removed entries don't accumulate in the heap"""
+        schedule = RetrySchedule()
+        for n in range(20*MIN_COMPACT_SIZE):
+            schedule.schedule(n, self.now+timedelta(seconds=n))
+            schedule.discard(n-1)
+
+        self.assertEqual(len(schedule), 1)
+        self.assertLessEqual(schedule.heap_size, MIN_COMPACT_SIZE+1)
+        self.assertEqual(schedule.pop_due(self.now+timedelta(days=1)), 20*MIN_COMPACT_SIZE-1)
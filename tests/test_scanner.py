@@ -0,0 +1,76 @@
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import (CBlock, CMutableTransaction, CMutableTxIn, CMutableTxOut,
+                          COutPoint, CTransaction, CTxWitness, CTxInWitness, lx)
+from bitcoin.core.script import CScript, CScriptWitness, OP_CHECKSIG
+from bitcoin.wallet import CKey, P2PKHBitcoinAddress
+
+from bitcallback.bitmon.scanner import address_script, p2pkh_script, scan_block
+
+from .test_monitor import make_tx, ADDR1, ADDR2, ADDR3
+
+
+def make_segwit_tx(outputs, inputs):
+    """Create transaction with witness data for every input"""
+    vin = [CMutableTxIn(COutPoint(txid, n)) for txid, n in inputs]
+    vout = [CMutableTxOut(value, CScript(script)) for script, value in outputs]
+    witness = CTxWitness([CTxInWitness(CScriptWitness([b'\x01'*72, b'\x02'*33]))
+                          for _ in vin])
+    return CMutableTransaction(vin, vout, witness=witness)
+
+
+class TestScanBlock(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.scripts = {address_script(ADDR1), address_script(ADDR2)}
+
+    def scan(self, block, scripts, outpoints=()):
+        raw = block.serialize()
+        return [CTransaction.deserialize(raw[start:end]).GetTxid()
+                for start, end in scan_block(raw, scripts, outpoints)]
+
+    def test_address_script(self):
+        """Test only addresses for the selected chain are converted"""
+        self.assertEqual(len(address_script(ADDR1)), 25)
+        self.assertIsNone(address_script('1F1tAaz5x1HUXrCNLbtMDqcw6o5GNn4xqX'))
+
+    def test_p2pkh_script(self):
+        """Test P2PK scripts are converted to the P2PKH script for their key"""
+        key = CKey(b'\x01'*32)
+        addr = str(P2PKHBitcoinAddress.from_pubkey(key.pub))
+        self.assertEqual(p2pkh_script(bytes(CScript([key.pub, OP_CHECKSIG]))),
+                         address_script(addr))
+        self.assertIsNone(p2pkh_script(address_script(addr)))
+
+    def test_outputs(self):
+        """Test transactions paying to monitored scripts are found"""
+        coinbase = make_tx([(ADDR3, 50)], coinbase=True)[1]
+        txid1, tx1 = make_tx([(ADDR3, 10), (ADDR1, 20)], [(lx('11'*32), 1)])
+        txid2, tx2 = make_tx([(ADDR3, 10)], [(lx('22'*32), 1)])
+        txid3, tx3 = make_tx([(ADDR2, 30)], [(lx('33'*32), 0), (lx('44'*32), 3)])
+        block = CBlock(vtx=[coinbase, tx1, tx2, tx3])
+
+        self.assertEqual(self.scan(block, self.scripts), [txid1, txid3])
+        self.assertEqual(self.scan(block, set()), [])
+
+    def test_inputs(self):
+        """Test transactions spending monitored outpoints are found"""
+        txid1, tx1 = make_tx([(ADDR3, 10)], [(lx('11'*32), 1)])
+        txid2, tx2 = make_tx([(ADDR3, 10)], [(lx('22'*32), 0), (lx('22'*32), 1)])
+        block = CBlock(vtx=[tx1, tx2])
+
+        outpoints = {(lx('22'*32), 1)}
+        self.assertEqual(self.scan(block, self.scripts, outpoints), [txid2])
+
+    def test_segwit(self):
+        """Test transactions with witness data are correctly skipped"""
+        script = bytes(CScript([0, b'\x05'*20]))
+        tx1 = make_segwit_tx([(script, 10)], [(lx('11'*32), 0), (lx('11'*32), 1)])
+        tx2 = make_segwit_tx([(address_script(ADDR1), 10)], [(lx('22'*32), 0)])
+        tx3 = make_segwit_tx([(script, 10)], [(lx('33'*32), 0)])
+        block = CBlock(vtx=[tx1, tx2, tx3])
+
+        self.assertEqual(self.scan(block, self.scripts), [tx2.GetTxid()])
+        self.assertEqual(self.scan(block, {script}), [tx1.GetTxid(), tx3.GetTxid()])
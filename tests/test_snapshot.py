@@ -0,0 +1,118 @@
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import bitcoin
+from bitcoin.core import lx
+
+from bitcallback.bitmon.cache import TxOutCache
+from bitcallback.bitmon.registry import AddressRegistry
+from bitcallback.bitmon_task import SubscriptionManager
+from bitcallback.commands import SubscriptionData
+from bitcallback.database import make_session_scope
+from bitcallback.models import Subscription
+from bitcallback.snapshot import Snapshot, write_snapshot
+from bitcallback.subscription_table import to_micros
+
+from .database import create_memory_db
+from .test_bitmon_task import MockTransactionMonitor
+from .test_monitor import MockProxy, make_tx, ADDR1, ADDR2
+
+
+class TestSnapshot(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'bitmon.snapshot')
+        self.db_session = create_memory_db()
+
+        expiration = datetime(2030, 1, 1, 12, 30, 15, 500)
+        with make_session_scope(self.db_session) as session:
+            self.subs = [Subscription(address=addr, callback_url='http://localhost:9779/ñ',
+                                      expiration=expiration)
+                         for addr in (ADDR1, ADDR1, ADDR2)]
+            session.add_all(self.subs)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def records(self, subscriptions=None):
+        """Snapshot records for the subscriptions"""
+        if subscriptions is None:
+            subscriptions = [sub.to_subscription_data() for sub in self.subs]
+        return [(sub.id, AddressRegistry.address_key(sub.address), sub.callback_url,
+                 to_micros(sub.expiration)) for sub in subscriptions]
+
+    def test_roundtrip(self):
+        """Test subscriptions and TxOutCache entries are restored"""
+        proxy = MockProxy()
+        txid, tx = make_tx([(ADDR1, 10), (ADDR2, 20)], [(lx('11'*32), 0)])
+        proxy.transactions[txid] = tx
+        cache = TxOutCache(proxy)
+        cache.prefetch([txid])
+        cache.txout(txid, 0)
+
+        write_snapshot(self.path, 120, self.records(), cache.items())
+        self.assertFalse(os.path.exists(self.path+'.tmp'))
+
+        snapshot = Snapshot(self.path)
+        self.assertEqual(snapshot.block_number, 120)
+        self.assertEqual(list(snapshot.subscriptions()), self.records())
+
+        restored = TxOutCache(proxy)
+        restored.load(snapshot.txouts())
+        snapshot.close()
+
+        # Spent state is preserved and no request is needed
+        self.assertEqual(restored.txout(txid, 1), (ADDR2, 20))
+        self.assertNotIn(txid, restored)
+        self.assertEqual(proxy.calls.count('getrawtransaction'), 1)
+
+    def test_invalid(self):
+        write_snapshot(self.path, 120, self.records(), [])
+        with open(self.path, 'r+b') as f:
+            f.write(b'XXXX')
+        with self.assertRaises(ValueError):
+            Snapshot(self.path)
+
+        # Truncated
+        write_snapshot(self.path, 120, self.records(), [(b'a'*32, bytearray(40))])
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path)-10)
+        snapshot = Snapshot(self.path)
+        self.assertEqual(len(list(snapshot.subscriptions())), 3)
+        with self.assertRaises(ValueError):
+            list(snapshot.txouts())
+        snapshot.close()
+
+    def test_load_snapshot(self):
+        """Test subscriptions created after the snapshot are loaded"""
+        write_snapshot(self.path, 120, self.records()[:2], [])
+
+        monitor = MockTransactionMonitor()
+        manager = SubscriptionManager(None, self.db_session, False)
+        snapshot = Snapshot(self.path)
+        self.assertTrue(manager.load_snapshot(snapshot.subscriptions()))
+        snapshot.close()
+
+        manager.set_transaction_monitor(monitor)
+        self.assertEqual(len(manager), 3)
+        self.assertEqual(monitor.monitored, set([ADDR1, ADDR2]))
+        self.assertEqual(len(manager._expiration_table), 3)
+
+    def test_load_stale_snapshot(self):
+        """Test subscriptions are reloaded from the database when the snapshot
+        doesn't match"""
+        stale = SubscriptionData(1000, ADDR2, 'http://localhost', datetime.utcnow())
+        write_snapshot(self.path, 120, self.records()+self.records([stale]), [])
+
+        manager = SubscriptionManager(None, self.db_session, False)
+        snapshot = Snapshot(self.path)
+        self.assertFalse(manager.load_snapshot(snapshot.subscriptions()))
+        snapshot.close()
+
+        self.assertEqual(len(manager), 3)
+        self.assertNotIn(1000, manager)
+        self.assertEqual(len(manager._expiration_table), 3)
@@ -0,0 +1,92 @@
+from datetime import datetime
+from unittest import TestCase
+
+import bitcoin
+
+from bitcallback.bitmon.registry import AddressRegistry
+from bitcallback.bitmon.scanner import address_script
+from bitcallback.subscription_table import SubscriptionTable, PAGE_SIZE, to_micros
+
+from .test_monitor import ADDR1, ADDR2, ADDR3
+
+
+class TestAddressRegistry(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+
+    def test_acquire_release(self):
+        registry = AddressRegistry()
+        addr_id = registry.acquire(ADDR1)
+        self.assertEqual(registry.acquire(ADDR1), addr_id)
+        self.assertNotEqual(registry.acquire(ADDR2), addr_id)
+        self.assertEqual(len(registry), 2)
+
+        # Stored as scriptPubKey, and matched by it
+        script = address_script(ADDR1)
+        self.assertEqual(registry.key(addr_id), script)
+        self.assertEqual(registry[script], ADDR1)
+        self.assertEqual(registry.address(addr_id), ADDR1)
+
+        # Removed with the last reference, and the id reused
+        self.assertIsNone(registry.release(addr_id))
+        self.assertEqual(registry.release(addr_id), script)
+        self.assertNotIn(script, registry)
+        self.assertIsNone(registry.id(ADDR1))
+        self.assertEqual(registry.acquire(ADDR3), addr_id)
+        self.assertEqual(set(registry.addresses()), set([ADDR2, ADDR3]))
+
+    def test_invalid_address(self):
+        """Test addresses that can't be converted into scripts are kept"""
+        registry = AddressRegistry()
+        addr_id = registry.acquire('invalid')
+        self.assertEqual(registry.address(addr_id), 'invalid')
+        self.assertEqual(registry.id('invalid'), addr_id)
+
+
+class TestSubscriptionTable(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.registry = AddressRegistry()
+        self.table = SubscriptionTable(self.registry)
+        self.expiration = datetime(2030, 1, 1, 10, 30, 0, 15)
+
+    def add(self, sub_id, addr):
+        return self.table.add(sub_id, self.registry.acquire(addr), 'http://localhost',
+                              to_micros(self.expiration))
+
+    def test_add_remove(self):
+        for sub_id, addr in ((1, ADDR1), (2, ADDR1), (3, ADDR2), (PAGE_SIZE+5, ADDR1)):
+            self.add(sub_id, addr)
+
+        self.assertEqual(len(self.table), 4)
+        self.assertEqual(self.table.max_id(), PAGE_SIZE+5)
+        sub = self.table.get(2)
+        self.assertEqual((sub.id, sub.address, sub.expiration), (2, ADDR1, self.expiration))
+        by_addr = lambda addr: sorted(sub.id for sub in
+                                      self.table.by_address(self.registry.id(addr)))
+        self.assertEqual(by_addr(ADDR1), [1, 2, PAGE_SIZE+5])
+
+        # Removed from the middle, start and end of the address list
+        self.assertEqual(self.table.remove(2).id, 2)
+        self.assertEqual(by_addr(ADDR1), [1, PAGE_SIZE+5])
+        self.table.remove(PAGE_SIZE+5)
+        self.table.remove(1)
+        self.assertEqual(by_addr(ADDR1), [])
+        self.assertEqual(by_addr(ADDR2), [3])
+
+        self.assertIsNone(self.table.remove(1))
+        self.assertNotIn(1, self.table)
+        self.assertEqual(self.table.max_id(), 3)
+        self.assertEqual([sub.id for sub in self.table], [3])
+
+    def test_row_reuse(self):
+        row = self.add(1, ADDR1)
+        self.add(2, ADDR2)
+        self.table.remove(1)
+        self.assertEqual(self.add(3, ADDR2), row)
+        self.assertEqual(self.table.id(row), 3)
+        self.assertEqual(sorted(sub.id for sub in
+                                self.table.by_address(self.registry.id(ADDR2))), [2, 3])
+        self.assertEqual(sorted(record[0] for record in self.table.records()), [2, 3])
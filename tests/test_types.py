@@ -1,5 +1,5 @@
 from unittest import TestCase
-from bitcallback.types import BitcoinAddress
+from bitcallback.types import BitcoinAddress, BitcoinAddresses
 
 class TestBitcoinAddress(TestCase):
 
@@ -48,3 +48,11 @@ class TestBitcoinAddress(TestCase):
         for address in invalid:
             with self.assertRaises(ValueError):
                 BitcoinAddress(address)
+
+    def test_batch(self):
+        """Test batch validation returns the result for each address"""
+        addresses = ["mjgZHpD1AzEixLgcnncod5df6CntYK4Jpi",
+                     "m1gZHpD1AzEixLgcnncod5df6CntYK4Jpi",
+                     None,
+                     "mjgZHpD1AzEixLgcnncod5df6CntYK4Jpi"]
+        self.assertEqual(BitcoinAddresses(addresses), [True, False, False, True])
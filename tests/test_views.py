@@ -0,0 +1,115 @@
+import json
+from unittest import TestCase
+
+import bitcoin
+
+from bitcallback import app
+from bitcallback.models import db, Subscription
+
+from .test_monitor import ADDR1, ADDR2, ADDR3
+
+
+class MockBitmonTask(object):
+    """Records the subscriptions sent to the bitcoin monitor task"""
+
+    def __init__(self):
+        self.subscriptions = []
+
+    def new_subscriptions(self, subscriptions):
+        self.subscriptions.extend(subscriptions)
+
+
+class TestSubscriptionBulk(TestCase):
+
+    def setUp(self):
+        bitcoin.SelectParams('testnet')
+        self.client = app.test_client()
+        self.bitmon_task = app.bitmon_task
+        app.bitmon_task = MockBitmonTask()
+
+    def tearDown(self):
+        # Remove created subscriptions
+        with app.app_context():
+            ids = [s.id for s in app.bitmon_task.subscriptions]
+            if ids:
+                Subscription.query.filter(Subscription.id.in_(ids)).delete(
+                    synchronize_session=False)
+                db.session.commit()
+        app.bitmon_task = self.bitmon_task
+
+    def post(self, data, content_type='application/json'):
+        response = self.client.post('/subscription/bulk', data=data,
+                                    content_type=content_type)
+        return response.status_code, json.loads(response.get_data(as_text=True))
+
+    def test_create(self):
+        """Test subscriptions are created with their own ids, and sent to
+        the monitor task"""
+        items = [{'address': ADDR1, 'callback_url': 'http://localhost/1'},
+                 {'address': ADDR2, 'callback_url': 'http://localhost/2',
+                  'expiration': '2030-01-01T00:00:00'},
+                 {'address': ADDR1, 'callback_url': 'http://localhost/3'}]
+        status, body = self.post(json.dumps(items))
+
+        self.assertEqual(status, 201)
+        self.assertEqual((body['created'], body['errors']), (3, 0))
+
+        subscriptions = [r['subscription'] for r in body['results']]
+        self.assertEqual([s['callback_url'] for s in subscriptions],
+                         [item['callback_url'] for item in items])
+        self.assertEqual(subscriptions[1]['expiration'], '2030-01-01T00:00:00')
+
+        # Each id belongs to the subscription it was returned for
+        with app.app_context():
+            for subs in subscriptions:
+                stored = Subscription.query.get(subs['id'])
+                self.assertEqual((stored.address, stored.callback_url),
+                                 (subs['address'], subs['callback_url']))
+
+        self.assertEqual([s.id for s in app.bitmon_task.subscriptions],
+                         [s['id'] for s in subscriptions])
+
+    def test_retried_payload(self):
+        """Test the same payload sent twice creates different subscriptions"""
+        items = json.dumps([{'address': ADDR1, 'callback_url': 'http://localhost'}]*2)
+        ids = []
+        for _ in range(2):
+            status, body = self.post(items)
+            self.assertEqual(status, 201)
+            ids.extend(r['subscription']['id'] for r in body['results'])
+
+        self.assertEqual(len(set(ids)), 4)
+        self.assertEqual([s.id for s in app.bitmon_task.subscriptions], ids)
+
+    def test_ndjson(self):
+        lines = [json.dumps({'address': ADDR3, 'callback_url': 'http://localhost'}),
+                 '{"address": ',
+                 '']
+        status, body = self.post('\n'.join(lines), 'application/x-ndjson')
+
+        self.assertEqual(status, 201)
+        self.assertEqual((body['created'], body['errors']), (1, 1))
+        self.assertIn('Invalid JSON', body['results'][1]['error'])
+
+    def test_invalid(self):
+        """Test invalid subscriptions are reported without creating them"""
+        items = [{'address': ADDR1, 'callback_url': 5},
+                 {'address': ADDR1, 'callback_url': 'http://localhost', 'expiration': 5},
+                 {'address': ADDR1},
+                 {'address': 'invalid', 'callback_url': 'http://localhost'},
+                 {'address': ADDR1, 'callback_url': 'not an url'},
+                 {'address': ADDR1, 'callback_url': 'http://localhost',
+                  'expiration': 'not a date'},
+                 []]
+        status, body = self.post(json.dumps(items))
+
+        self.assertEqual(status, 400)
+        self.assertEqual((body['created'], body['errors']), (0, len(items)))
+        self.assertEqual([r['index'] for r in body['results']], list(range(len(items))))
+        self.assertIn('callback_url must be a string', body['results'][0]['error'])
+        self.assertIn('expiration must be a string', body['results'][1]['error'])
+        self.assertEqual(app.bitmon_task.subscriptions, [])
+
+    def test_not_array(self):
+        status, _ = self.post(json.dumps({'address': ADDR1}))
+        self.assertEqual(status, 400)